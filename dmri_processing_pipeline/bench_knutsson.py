@@ -0,0 +1,122 @@
+"""
+Peak memory and runtime of compute_knutsson on a synthetic eigenvector volume: the previous implementation (padded
+copies, float64 Jacobian) versus the current one in step01_calc_knutsson.py. The outputs of both are compared.
+
+Each variant runs in its own process. Peak memory is the growth of the process high-water mark during the call, read
+from VmHWM in /proc/self/status (ru_maxrss elsewhere, which on Linux also counts the parent's peak before the exec).
+
+Usage:
+    python bench_knutsson.py --shape 144 144 96
+"""
+
+
+import os
+import time
+import resource
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+import nibabel as nib
+
+from step01_calc_knutsson import compute_knutsson
+
+
+def reference_compute_knutsson(eigenvector_file, output_prefix):
+    data = nib.load(eigenvector_file)
+    data_np = data.get_fdata()[..., 0:3].astype(np.float32)
+
+    k1 = data_np[:, :, :, 0]**2 - data_np[:, :, :, 1]**2
+    k2 = 2 * data_np[:, :, :, 0] * data_np[:, :, :, 1]
+    k3 = 2 * data_np[:, :, :, 0] * data_np[:, :, :, 2]
+    k4 = 2 * data_np[:, :, :, 1] * data_np[:, :, :, 2]
+    k5 = (2 * data_np[:, :, :, 2]**2 - data_np[:, :, :, 0]**2 - data_np[:, :, :, 1]**2) / np.sqrt(3)
+
+    knutsson_data = np.stack((k1, k2, k3, k4, k5), axis=3)
+    knutsson_image = nib.Nifti1Image(knutsson_data, data.affine, data.header)
+    knutsson_image.set_data_dtype(np.float32)
+    knutsson_image.to_filename(output_prefix + '_knutsson_5D.nii')
+
+    jacobian = np.zeros(knutsson_data.shape[0:3] + (knutsson_data.shape[3] * 3,))
+    for i in range(knutsson_data.shape[3]):
+        east = np.pad(knutsson_data[1:, :, :, i], ((0, 1), (0, 0), (0, 0)), 'constant')
+        west = np.pad(knutsson_data[:-1, :, :, i], ((1, 0), (0, 0), (0, 0)), 'constant')
+        north = np.pad(knutsson_data[:, :-1, :, i], ((0, 0), (1, 0), (0, 0)), 'constant')
+        south = np.pad(knutsson_data[:, 1:, :, i], ((0, 0), (0, 1), (0, 0)), 'constant')
+        forth = np.pad(knutsson_data[:, :, 1:, i], ((0, 0), (0, 0), (0, 1)), 'constant')
+        back = np.pad(knutsson_data[:, :, :-1, i], ((0, 0), (0, 0), (1, 0)), 'constant')
+
+        jacobian[:, :, :, i * 3] = (east - west) / 2
+        jacobian[:, :, :, i * 3 + 1] = (south - north) / 2
+        jacobian[:, :, :, i * 3 + 2] = (forth - back) / 2
+
+    edge = np.sqrt(np.sum(jacobian**2, axis=3))
+    edge_image = nib.Nifti1Image(edge, data.affine, data.header)
+    edge_image.set_data_dtype(np.float32)
+    edge_image.to_filename(output_prefix + '_knutsson_edgemap.nii')
+
+
+def make_eigenvectors(path, shape, seed=0):
+    # smoothly varying unit vectors, saved as float32 like the TORTOISE eigenvector maps
+    rng = np.random.RandomState(seed)
+    grid = np.stack(np.meshgrid(*[np.linspace(0, np.pi, size) for size in shape], indexing='ij'), axis=-1)
+    vectors = np.sin(grid * rng.uniform(1, 3, size=3) + rng.uniform(0, np.pi, size=3))
+    vectors += 0.05 * rng.randn(*vectors.shape)
+    vectors /= np.linalg.norm(vectors, axis=-1, keepdims=True)
+    nib.save(nib.Nifti1Image(vectors.astype(np.float32), np.eye(4)), path)
+
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def run_variant(variant, eigenvector_file, output_prefix, queue):
+    fn = reference_compute_knutsson if variant == 'reference' else compute_knutsson
+    base_rss = peak_rss_mb()
+    start = time.perf_counter()
+    fn(eigenvector_file, output_prefix)
+    elapsed = time.perf_counter() - start
+    queue.put((elapsed, peak_rss_mb() - base_rss))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the Knutsson edge map computation.")
+    parser.add_argument('--shape', type=int, nargs=3, default=[144, 144, 96], help='Size of the eigenvector volume.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        eigenvector_file = os.path.join(tmp_dir, 'synthetic_DT_EV.nii')
+        make_eigenvectors(eigenvector_file, args.shape)
+
+        # each variant runs in a fresh process so that its memory peak is not hidden by the other one
+        context = multiprocessing.get_context('spawn')
+        results, outputs = {}, {}
+        for variant in ['reference', 'current']:
+            output_prefix = os.path.join(tmp_dir, variant)
+            queue = context.Queue()
+            process = context.Process(target=run_variant, args=(variant, eigenvector_file, output_prefix, queue))
+            process.start()
+            results[variant] = queue.get()
+            process.join()
+            outputs[variant] = [np.asarray(nib.load(output_prefix + suffix).dataobj)
+                                for suffix in ['_knutsson_5D.nii', '_knutsson_edgemap.nii']]
+
+    ref_time, ref_peak = results['reference']
+    elapsed, peak = results['current']
+    print('input: {}x3 float32'.format('x'.join(map(str, args.shape))))
+    print('reference: {:.2f} s  peak {:.1f} MB'.format(ref_time, ref_peak))
+    print('current:   {:.2f} s  peak {:.1f} MB  (speedup {:.2f}x, {:.1f}x less memory)'.format(
+        elapsed, peak, ref_time / elapsed, ref_peak / max(peak, 0.1)))
+    diff_5d = np.abs(outputs['current'][0] - outputs['reference'][0]).max()
+    edge_ref = outputs['reference'][1]
+    diff_edge = np.abs(outputs['current'][1] - edge_ref).max()
+    print('5D max abs diff: {:.2e}  edge map max abs diff: {:.2e} (max edge {:.2f})'.format(
+        diff_5d, diff_edge, edge_ref.max()))
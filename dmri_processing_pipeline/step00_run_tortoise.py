@@ -8,21 +8,32 @@ It performs the following steps:
 3. Runs the DR BUDDI tool for EPI distortion correction.
 4. Runs the DIFFCal tool for tensor estimation and creates tensor maps.
 5. Converts TORTOISE B-matrix to FSL B-vectors.
+
+Sessions are processed concurrently by a pool of worker processes. Each session gets a budget of cores, which is
+passed to TORTOISE and ITK through their thread-count environment variables. A step that finishes successfully leaves
+a completion marker in proc/diffusion/.done/, so a rerun skips the finished steps and resumes each session where it
+stopped. A session stops at the first command with a nonzero exit code. The output of every step is written to
+proc/diffusion/logs/<step>.log.
+
+Usage:
+    python step00_run_tortoise.py --src_dir /path/to/mtbi_study --tortoise_dir /path/to/TORTOISE_V3.2.0 \
+                                  --jobs 4 --cores_per_job 8
+For a dry run, --bin_dir can point to a folder of stub executables standing in for the TORTOISE binaries.
 """
 
 
 import os
+import time
+import argparse
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Define paths
 base_path = "/path/to/your/tortoise/installation/TORTOISE_V3.2.0"  # Replace with the path where TORTOISE is installed
 src_dir = "/path/to/your/data/directory"  # Replace with the path to your data directory
 
-# Define environment variables
-os.environ["PATH"] = f"{base_path}/DIFFPREPV320/bin/bin:{os.environ['PATH']}"
-os.environ["PATH"] = f"{base_path}/DIFFCALC/DIFFCALCV320:{os.environ['PATH']}"
-os.environ["PATH"] = f"{base_path}/DRBUDDIV320/bin:{os.environ['PATH']}"
-os.environ["PATH"] = f"{base_path}/DRTAMASV320/bin:{os.environ['PATH']}"
+# Environment variables limiting the threads of one job
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"]
 
 
 # Define checking functions
@@ -38,101 +49,172 @@ def is_valid_session(session_name):
     return session_name in ["v1", "v2", "v3"]
 
 
+# Define environment variables
+def tortoise_env(tortoise_dir, bin_dir=None, cores=None):
+    env = dict(os.environ)
+    paths = [f"{tortoise_dir}/DRTAMASV320/bin", f"{tortoise_dir}/DRBUDDIV320/bin",
+             f"{tortoise_dir}/DIFFCALC/DIFFCALCV320", f"{tortoise_dir}/DIFFPREPV320/bin/bin"]
+    if bin_dir is not None:
+        paths.insert(0, os.path.abspath(bin_dir))
+    env["PATH"] = ":".join(paths + [env.get("PATH", "")])
+    if cores is not None:
+        for var in THREAD_ENV_VARS:
+            env[var] = str(cores)
+    return env
+
+
 # Function to run bash commands
-def run_command(command):
-    print(f"Running: {command}")
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
-    process.wait()
+def run_command(command, env=None, log=None):
+    print(f"Running: {command}", flush=True)
+    if log is not None:
+        log.write(f"$ {command}\n")
+        log.flush()
+    process = subprocess.run(command, shell=True, env=env, stdout=log, stderr=subprocess.STDOUT)
     return process.returncode
 
 
-# Process subjects
-def process_subjects():
-    for subj_dir in os.listdir(src_dir):
-        subj_path = os.path.join(src_dir, subj_dir)
+# Steps of a session, in order; each step is a list of commands
+def session_steps(sess_path):
+    dwi_bmax2500_nifti = f"{sess_path}/nii/*BMAX2500*.nii.gz"
+    dwi_bmax2500_bval = f"{sess_path}/nii/*BMAX2500*.bval"
+    dwi_bmax2500_bvec = f"{sess_path}/nii/*BMAX2500*.bvec"
+    b0_nifti = f"{sess_path}/nii/*B0*.nii.gz"
+    b0_bval = f"{sess_path}/nii/*B0*.bval"
+    b0_bvec = f"{sess_path}/nii/*B0*.bvec"
+
+    out_dir = f"{sess_path}/proc/diffusion"
+    ap_out_dir = f"{out_dir}/AP"
+    pa_out_dir = f"{out_dir}/PA"
+    t2 = f"{sess_path}/proc/*T2*.nii.gz"
+    bet2mask = f"{out_dir}/AP_proc_DRBUDDI_proc/structure_mask.nii.gz"
+    final_list = f"{out_dir}/AP_proc_DRBUDDI_proc/AP*final.list"
+    dt = f"{out_dir}/AP_proc_DRBUDDI_proc/*final_N1_DT.nii"
+    bmtxt = f"{out_dir}/AP_proc_DRBUDDI_proc/AP*final.bmtxt"
+
+    return [
+        ("link", [f"ln -sf {dwi_bmax2500_nifti} {ap_out_dir}",
+                  f"ln -sf {dwi_bmax2500_bval} {ap_out_dir}",
+                  f"ln -sf {dwi_bmax2500_bvec} {ap_out_dir}",
+                  f"ln -sf {b0_nifti} {pa_out_dir}",
+                  f"ln -sf {b0_bval} {pa_out_dir}",
+                  f"ln -sf {b0_bvec} {pa_out_dir}"]),
+        # ********************* ImportNIFTI *********************
+        ("import_nifti", [f"ImportNIFTI -i {dwi_bmax2500_nifti} -b {dwi_bmax2500_bval} -v {dwi_bmax2500_bvec} -p vertical -o {ap_out_dir}",
+                          f"ImportNIFTI -i {b0_nifti} -b {b0_bval} -v {b0_bvec} -p vertical -o {pa_out_dir}"]),
+        # ********************* DIFFPREP *********************
+        ("diffprep_ap", [f"DIFFPREP -i {ap_out_dir}/AP.list -s {t2} --will_be_drbuddied 1 -d for_final --is_human_brain 1 --upsampling all --res 1.0 1.0 1.0 --keep_intermediate 1 --do_QC 0"]),
+        ("diffprep_pa", [f"DIFFPREP -i {pa_out_dir}/PA.list -s {t2} --will_be_drbuddied 1 -d for_final --is_human_brain 1 --upsampling all --res 1.0 1.0 1.0 --keep_intermediate 1 --do_QC 0"]),
+        # ********************* DRBUDDI *********************
+        ("drbuddi", [f"DR_BUDDI_withoutGUI --up_data $(ls {ap_out_dir}/AP_proc.list) --down_data $(ls {pa_out_dir}/PA_proc.list) --structural {t2} --res 1.0 1.0 1.0 -g 1"]),
+        # ********************* DIFFCal *********************
+        ("bet2", [f"bet2 {out_dir}/AP_proc_DRBUDDI_proc/structural.nii {out_dir}/AP_proc_DRBUDDI_proc/structure -m -f 0.3"]),
+        ("estimate_tensor", [f"EstimateTensorNLLS -i {final_list} --save_CS 1 -m {bet2mask}"]),
+        ("tensor_maps", [f"ComputeAllTensorMaps.bash {dt}"]),
+        # ******************** TORTOISEBmatrixToFSLBVecs ********************
+        ("bvecs", [f"TORTOISEBmatrixToFSLBVecs {bmtxt}"]),
+    ]
+
+
+# Process one session, skipping the steps whose completion marker exists
+def process_session(sess_path, tortoise_dir, bin_dir=None, cores=None):
+    sess_id = os.path.relpath(sess_path, os.path.dirname(os.path.dirname(sess_path)))
+    out_dir = f"{sess_path}/proc/diffusion"
+    done_dir = f"{out_dir}/.done"
+    log_dir = f"{out_dir}/logs"
+    for folder in [f"{out_dir}/AP", f"{out_dir}/PA", done_dir, log_dir]:
+        os.makedirs(folder, exist_ok=True)
+
+    env = tortoise_env(tortoise_dir, bin_dir, cores)
+    result = {"session": sess_id, "completed": [], "skipped": [], "failed": None, "seconds": 0.}
+    start = time.perf_counter()
+
+    for step, commands in session_steps(sess_path):
+        marker = os.path.join(done_dir, step)
+        if os.path.exists(marker):
+            result["skipped"].append(step)
+            continue
+
+        print(f"Running {step} for {sess_id}...", flush=True)
+        with open(os.path.join(log_dir, f"{step}.log"), "w") as log:
+            for command in commands:
+                returncode = run_command(command, env=env, log=log)
+                if returncode != 0:
+                    result["failed"] = {"step": step, "command": command, "returncode": returncode}
+                    break
+        if result["failed"] is not None:
+            print(f"{sess_id}: {step} exited with code {returncode}, stopping this session.", flush=True)
+            break
+
+        with open(marker, "w") as f:
+            f.write(time.strftime("%Y-%m-%d %H:%M:%S\n"))
+        result["completed"].append(step)
+
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+# Find the sessions to process
+def find_sessions(study_dir):
+    sessions = []
+    for subj_dir in sorted(os.listdir(study_dir)):
+        subj_path = os.path.join(study_dir, subj_dir)
         if not is_directory(subj_path):
             print(f"Skipping {subj_path} as it's not a directory.")
             continue
 
         subj_id = os.path.basename(subj_path)
-        print(f"Processing {subj_id}")
-
         if not starts_with_MTBI(subj_id):
             print(f"Skipping {subj_id} as it doesn't start with 'MTBI'.")
             continue
 
-        for sess_dir in os.listdir(subj_path):
+        for sess_dir in sorted(os.listdir(subj_path)):
             sess_path = os.path.join(subj_path, sess_dir)
             if not is_directory(sess_path):
                 print(f"Skipping {sess_path} as it's not a directory.")
                 continue
 
             sess_id = os.path.basename(sess_path)
-            print(f"Processing {sess_id}")
-
             if not is_valid_session(sess_id):
                 print(f"Skipping {sess_id} as it's not a valid session name (should be v1, v2 or v3).")
                 continue
+            sessions.append(sess_path)
+    return sessions
 
-            # Define paths and commands
-            dwi_bmax2500_nifti = f"{sess_path}/nii/*BMAX2500*.nii.gz"
-            dwi_bmax2500_bval = f"{sess_path}/nii/*BMAX2500*.bval"
-            dwi_bmax2500_bvec = f"{sess_path}/nii/*BMAX2500*.bvec"
-            b0_nifti = f"{sess_path}/nii/*B0*.nii.gz"
-            b0_bval = f"{sess_path}/nii/*B0*.bval"
-            b0_bvec = f"{sess_path}/nii/*B0*.bvec"
-
-            out_dir = f"{sess_path}/proc/diffusion"
-            ap_out_dir = f"{out_dir}/AP"
-            pa_out_dir = f"{out_dir}/PA"
-            os.makedirs(out_dir, exist_ok=True)
-            os.makedirs(ap_out_dir, exist_ok=True)
-            os.makedirs(pa_out_dir, exist_ok=True)
-
-            print(f"Creating symbolic links for {sess_id}...")
-            run_command(f"ln -s {dwi_bmax2500_nifti} {ap_out_dir}")
-            run_command(f"ln -s {dwi_bmax2500_bval} {ap_out_dir}")
-            run_command(f"ln -s {dwi_bmax2500_bvec} {ap_out_dir}")
-            run_command(f"ln -s {b0_nifti} {pa_out_dir}")
-            run_command(f"ln -s {b0_bval} {pa_out_dir}")
-            run_command(f"ln -s {b0_bvec} {pa_out_dir}")
-
-            #
-            # ********************* ImportNIFTI *********************
-            print(f"Importing NIFTI files for {sess_id}...")
-            run_command(f"ImportNIFTI -i {dwi_bmax2500_nifti} -b {dwi_bmax2500_bval} -v {dwi_bmax2500_bvec} -p vertical -o {ap_out_dir}")
-            run_command(f"ImportNIFTI -i {b0_nifti} -b {b0_bval} -v {b0_bvec} -p vertical -o {pa_out_dir}")
-
-            #
-            # ********************* DIFFPREP *********************
-            print(f"Running DIFFPREP for {sess_id}...")
-            t2 = f"{sess_path}/proc/*T2*.nii.gz"
-            run_command(f"DIFFPREP -i {ap_out_dir}/AP.list -s {t2} --will_be_drbuddied 1 -d for_final --is_human_brain 1 --upsampling all --res 1.0 1.0 1.0 --keep_intermediate 1 --do_QC 0")
-            run_command(f"DIFFPREP -i {pa_out_dir}/PA.list -s {t2} --will_be_drbuddied 1 -d for_final --is_human_brain 1 --upsampling all --res 1.0 1.0 1.0 --keep_intermediate 1 --do_QC 0")
-
-            #
-            # ********************* DRBUDDI *********************
-            print(f"Running DR BUDDI without GUI for {sess_id}...")
-            run_command(f"DR_BUDDI_withoutGUI --up_data $(ls {ap_out_dir}/AP_proc.list) --down_data $(ls {pa_out_dir}/PA_proc.list) --structural {t2} --res 1.0 1.0 1.0 -g 1")
-
-            #
-            # ********************* DIFFCal *********************
-            print(f"Running DIFFCal for {sess_id}...")
-            run_command(f"bet2 {out_dir}/AP_proc_DRBUDDI_proc/structural.nii {out_dir}/AP_proc_DRBUDDI_proc/structure -m -f 0.3")
-            bet2mask = f"{out_dir}/AP_proc_DRBUDDI_proc/structure_mask.nii.gz"
-            final_list = f"{out_dir}/AP_proc_DRBUDDI_proc/AP*final.list"
-            run_command(f"EstimateTensorNLLS -i {final_list} --save_CS 1 -m {bet2mask}")
-
-            print(f"Computing all tensor maps for {sess_id}...")
-            dt = f"{out_dir}/AP_proc_DRBUDDI_proc/*final_N1_DT.nii"
-            run_command(f"ComputeAllTensorMaps.bash {dt}")
-
-            #
-            # ******************** TORTOISEBmatrixToFSLBVecs ********************
-            bmtxt = f"{out_dir}/AP_proc_DRBUDDI_proc/AP*final.bmtxt"
-            print(f"Converting TORTOISE B-matrix to FSL B-vectors for {sess_id}...")
-            run_command(f"TORTOISEBmatrixToFSLBVecs {bmtxt}")
+
+# Process subjects
+def process_subjects(study_dir=src_dir, tortoise_dir=base_path, bin_dir=None, jobs=1, cores_per_job=None):
+    sessions = find_sessions(study_dir)
+    print(f"Processing {len(sessions)} sessions, {jobs} at a time.")
+
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(process_session, sess_path, tortoise_dir, bin_dir, cores_per_job)
+                   for sess_path in sessions]
+        for future in as_completed(futures):
+            result = future.result()
+            status = "failed at " + result["failed"]["step"] if result["failed"] else "done"
+            print(f"{result['session']}: {status} ({len(result['completed'])} steps run, "
+                  f"{len(result['skipped'])} skipped, {result['seconds']:.1f}s)", flush=True)
+            results.append(result)
+
+    failed = [result["session"] for result in results if result["failed"]]
+    print(f"{len(results) - len(failed)} sessions complete, {len(failed)} failed: {failed}")
+    return results
 
 
 if __name__ == "__main__":
-    process_subjects()
\ No newline at end of file
+
+    parser = argparse.ArgumentParser(description="Run TORTOISE on all sessions of a study.")
+    parser.add_argument("--src_dir", type=str, default=src_dir, help="Study folder holding the MTBI*/v* sessions.")
+    parser.add_argument("--tortoise_dir", type=str, default=base_path, help="TORTOISE installation folder.")
+    parser.add_argument("--bin_dir", type=str, default=None,
+                        help="Folder searched before the TORTOISE folders, e.g. with stub executables for a dry run.")
+    parser.add_argument("--cores_per_job", type=int, default=8, help="Cores (threads) given to each session.")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="Sessions processed concurrently (default: available cores // cores_per_job).")
+    args = parser.parse_args()
+
+    jobs = args.jobs or max(1, (os.cpu_count() or 1) // args.cores_per_job)
+    results = process_subjects(args.src_dir, args.tortoise_dir, args.bin_dir, jobs, args.cores_per_job)
+    if any(result["failed"] for result in results):
+        raise SystemExit(1)
@@ -1,12 +1,22 @@
 """
 This script calculates Knutsson 5D vectors and edge map given eigenvector calculated in step00.
+
+Sessions are processed concurrently by a pool of worker processes. A session is skipped if both of its outputs
+(*_knutsson_5D.nii and *_knutsson_edgemap.nii) are newer than its eigenvector file.
+
+Usage:
+    python step01_calc_knutsson.py --src_dir /path/to/mtbi_study --jobs 8
 """
 
 
 import os
+import glob
+import time
+import argparse
 import subprocess
 import nibabel as nib
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 # Define source directory
 SRC_DIR = "/path/to/your/data/directory"
@@ -33,85 +43,190 @@ def run_command(command):
     return process.returncode
 
 
+# Knutsson 5D vector component `index` of the eigenvectors v [X, Y, Z, 3], computed in float32 into `out`
+def knutsson_component(v, index, out, tmp):
+    x, y, z = v[..., 0], v[..., 1], v[..., 2]
+    if index == 0:  # x^2 - y^2
+        np.multiply(x, x, out=out)
+        np.multiply(y, y, out=tmp)
+        np.subtract(out, tmp, out=out)
+    elif index == 1:  # 2xy
+        np.multiply(x, 2, out=out)
+        np.multiply(out, y, out=out)
+    elif index == 2:  # 2xz
+        np.multiply(x, 2, out=out)
+        np.multiply(out, z, out=out)
+    elif index == 3:  # 2yz
+        np.multiply(y, 2, out=out)
+        np.multiply(out, z, out=out)
+    else:  # (2z^2 - x^2 - y^2) / sqrt(3)
+        np.multiply(z, z, out=out)
+        np.multiply(out, 2, out=out)
+        np.multiply(x, x, out=tmp)
+        np.subtract(out, tmp, out=out)
+        np.multiply(y, y, out=tmp)
+        np.subtract(out, tmp, out=out)
+        np.divide(out, np.float32(np.sqrt(3)), out=out)
+    return out
+
+
+# Add the squared central differences of `channel` along all three axes to `edge` (zero outside the volume)
+def add_squared_gradient(channel, edge, tmp):
+    for axis in range(3):
+        size = channel.shape[axis]
+        if size < 2:
+            continue  # both neighbours are outside the volume
+
+        def axis_slice(start, stop):
+            index = [slice(None)] * 3
+            index[axis] = slice(start, stop)
+            return tuple(index)
+
+        np.subtract(channel[axis_slice(2, None)], channel[axis_slice(None, -2)], out=tmp[axis_slice(1, -1)])
+        tmp[axis_slice(0, 1)] = channel[axis_slice(1, 2)]
+        np.negative(channel[axis_slice(size - 2, size - 1)], out=tmp[axis_slice(size - 1, size)])
+        np.multiply(tmp, tmp, out=tmp)
+        np.add(edge, tmp, out=edge)
+
+
 # Function to compute Knutsson 5D vectors and edgemap
 def compute_knutsson(eigenvector_file, output_prefix):
-    # Load eigenvector data
+    """
+    The 5D vectors and the edge map (norm of their central-difference Jacobian) are computed channel by channel in
+    float32, with two scratch volumes, instead of padded copies and a float64 Jacobian of 15 channels.
+    """
+    # Load eigenvector data, only the first eigenvector
     data = nib.load(eigenvector_file)
-    data_np = data.get_fdata()[..., 0:3].astype(np.float32)
+    data_np = np.asarray(data.dataobj[..., 0:3], dtype=np.float32)
 
-    # Compute Knutsson 5D vectors
-    k1 = data_np[:, :, :, 0]**2 - data_np[:, :, :, 1]**2
-    k2 = 2 * data_np[:, :, :, 0] * data_np[:, :, :, 1]
-    k3 = 2 * data_np[:, :, :, 0] * data_np[:, :, :, 2]
-    k4 = 2 * data_np[:, :, :, 1] * data_np[:, :, :, 2]
-    k5 = (2 * data_np[:, :, :, 2]**2 - data_np[:, :, :, 0]**2 - data_np[:, :, :, 1]**2) / np.sqrt(3)
+    # Fortran order, so that every 5D component is contiguous and the nifti is written without a copy
+    knutsson_data = np.empty(data_np.shape[0:3] + (5,), dtype=np.float32, order='F')
+    tmp = np.empty(data_np.shape[0:3], dtype=np.float32, order='F')
+    edge = np.zeros(data_np.shape[0:3], dtype=np.float32, order='F')
+
+    for i in range(5):
+        channel = knutsson_component(data_np, i, knutsson_data[..., i], tmp)
+        add_squared_gradient(channel, edge, tmp)
 
-    knutsson_data = np.stack((k1, k2, k3, k4, k5), axis=3)
     knutsson_image = nib.Nifti1Image(knutsson_data, data.affine, data.header)
     knutsson_image.set_data_dtype(np.float32)
     knutsson_image.to_filename(output_prefix + '_knutsson_5D.nii')
 
-    # Compute Jacobian for the Knutsson 5D vectors
-    jacobian = np.zeros(knutsson_data.shape[0:3] + (knutsson_data.shape[3] * 3,))
-
-    for i in range(knutsson_data.shape[3]):
-        east = np.pad(knutsson_data[1:, :, :, i], ((0, 1), (0, 0), (0, 0)), 'constant')
-        west = np.pad(knutsson_data[:-1, :, :, i], ((1, 0), (0, 0), (0, 0)), 'constant')
-        north = np.pad(knutsson_data[:, :-1, :, i], ((0, 0), (1, 0), (0, 0)), 'constant')
-        south = np.pad(knutsson_data[:, 1:, :, i], ((0, 0), (0, 1), (0, 0)), 'constant')
-        forth = np.pad(knutsson_data[:, :, 1:, i], ((0, 0), (0, 0), (0, 1)), 'constant')
-        back = np.pad(knutsson_data[:, :, :-1, i], ((0, 0), (0, 0), (1, 0)), 'constant')
-
-        jacobian[:, :, :, i * 3] = (east - west) / 2
-        jacobian[:, :, :, i * 3 + 1] = (south - north) / 2
-        jacobian[:, :, :, i * 3 + 2] = (forth - back) / 2
-
-    edge = np.sqrt(np.sum(jacobian**2, axis=3))
+    # the central differences are halved once here: sqrt(sum((d / 2)^2)) = sqrt(sum(d^2)) / 2
+    np.sqrt(edge, out=edge)
+    np.multiply(edge, 0.5, out=edge)
 
     edge_image = nib.Nifti1Image(edge, data.affine, data.header)
     edge_image.set_data_dtype(np.float32)
     edge_image.to_filename(output_prefix + '_knutsson_edgemap.nii')
 
 
-# Process subjects
-def process_subjects():
-    for subj_dir in os.listdir(SRC_DIR):
-        subj_path = os.path.join(SRC_DIR, subj_dir)
+# Find the eigenvector file written by step00 (TORTOISE) in a session, None if there is none
+def find_eigenvector_file(sess_path):
+    diffusion_dir = os.path.join(sess_path, "proc", "diffusion", "AP_proc_DRBUDDI_proc")
+    candidates = sorted(glob.glob(os.path.join(diffusion_dir, "*DT_EV.nii")))
+    if len(candidates) > 1:
+        print(f"Found {len(candidates)} eigenvector files in {diffusion_dir}, using {candidates[0]}.")
+    return candidates[0] if candidates else None
+
+
+# Whether both outputs exist and are newer than the eigenvector file
+def is_up_to_date(eigenvector_file, output_prefix):
+    outputs = [output_prefix + '_knutsson_5D.nii', output_prefix + '_knutsson_edgemap.nii']
+    if not all(os.path.exists(output) for output in outputs):
+        return False
+    input_mtime = os.path.getmtime(eigenvector_file)
+    return all(os.path.getmtime(output) > input_mtime for output in outputs)
+
+
+# Session id of a session folder, e.g. MTBI001/v1
+def session_id(sess_path):
+    return os.path.relpath(sess_path, os.path.dirname(os.path.dirname(sess_path)))
+
+
+# Process one session
+def process_session(sess_path, force=False):
+    sess_id = session_id(sess_path)
+    eigenvector_file = find_eigenvector_file(sess_path)
+    if eigenvector_file is None:
+        return {"session": sess_id, "status": "no eigenvector file", "seconds": 0.}
+
+    # e.g. AP_proc_DRBUDDI_up_final_N1_DT_EV.nii -> AP_proc_DRBUDDI_up_final_N1_DT
+    output_prefix = eigenvector_file[:-len("_EV.nii")]
+    if not force and is_up_to_date(eigenvector_file, output_prefix):
+        return {"session": sess_id, "status": "up to date", "seconds": 0.}
+
+    start = time.perf_counter()
+    compute_knutsson(eigenvector_file, output_prefix)
+    return {"session": sess_id, "status": "done", "seconds": time.perf_counter() - start}
+
+
+# Find the sessions to process
+def find_sessions(study_dir):
+    sessions = []
+    for subj_dir in sorted(os.listdir(study_dir)):
+        subj_path = os.path.join(study_dir, subj_dir)
         if not is_directory(subj_path):
             print(f"Skipping {subj_path} as it's not a directory.")
             continue
 
         subj_id = os.path.basename(subj_path)
-        print(f"Processing {subj_id}")
-
         if not starts_with_MTBI(subj_id):
             print(f"Skipping {subj_id} as it doesn't start with 'MTBI'.")
             continue
 
-        for sess_dir in os.listdir(subj_path):
+        for sess_dir in sorted(os.listdir(subj_path)):
             sess_path = os.path.join(subj_path, sess_dir)
             if not is_directory(sess_path):
                 print(f"Skipping {sess_path} as it's not a directory.")
                 continue
 
             sess_id = os.path.basename(sess_path)
-            print(f"Processing {sess_id}")
-
             if not is_valid_session(sess_id):
                 print(f"Skipping {sess_id} as it's not a valid session name (should be v1, v2 or v3).")
                 continue
+            sessions.append(sess_path)
+    return sessions
 
-            # Check if the directory to store the diffusion results from step00 (TORTOISE) exists, skip if it does not exist
-            diffusion_dir = os.path.join(sess_dir, "proc", "diffusion", "AP_proc_DRBUDDI_proc")
-            if not is_directory(diffusion_dir):
-                print(f"Skipping {subj_id} {sess_id} as {diffusion_dir} does not exist.")
-                continue
 
-            # Run Knutsson 5D vectors calculation
-            eigenvector_file = os.path.join(diffusion_dir, "*DT_EV.nii")
-            output_prefix = os.path.join(diffusion_dir, "AP_proc_DRBUDDI_up_final_N1_DT")
-            compute_knutsson(eigenvector_file, output_prefix)
+# Process subjects
+def process_subjects(study_dir=SRC_DIR, jobs=1, force=False):
+    sessions = find_sessions(study_dir)
+    print(f"Processing {len(sessions)} sessions, {jobs} at a time.")
+
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(process_session, sess_path, force): sess_path for sess_path in sessions}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as error:
+                # e.g. a corrupt eigenvector file; the other sessions go on
+                result = {"session": session_id(futures[future]), "status": "failed",
+                          "error": f"{type(error).__name__}: {error}", "seconds": 0.}
+                print(f"{result['session']}: failed, {result['error']}", flush=True)
+            else:
+                print(f"{result['session']}: {result['status']} ({result['seconds']:.1f}s)", flush=True)
+            results.append(result)
+
+    counts = {status: sum(result["status"] == status for result in results)
+              for status in ["done", "up to date", "no eigenvector file", "failed"]}
+    failed = sorted(result["session"] for result in results if result["status"] == "failed")
+    print(f"{counts['done']} computed, {counts['up to date']} up to date, "
+          f"{counts['no eigenvector file']} without eigenvector file, {counts['failed']} failed: {failed} "
+          f"in {time.perf_counter() - start:.1f}s")
+    return results
 
 
 if __name__ == "__main__":
-    process_subjects()
\ No newline at end of file
+
+    parser = argparse.ArgumentParser(description="Compute the Knutsson 5D vectors and edge maps of all sessions.")
+    parser.add_argument("--src_dir", type=str, default=SRC_DIR, help="Study folder holding the MTBI*/v* sessions.")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Sessions processed concurrently.")
+    parser.add_argument("--force", action="store_true", help="Recompute sessions whose outputs are up to date.")
+    args = parser.parse_args()
+
+    results = process_subjects(args.src_dir, args.jobs, args.force)
+    if any(result["status"] == "failed" for result in results):
+        raise SystemExit(1)
@@ -0,0 +1,169 @@
+"""
+Fold-ensemble segmentation of many subjects.
+
+Decoding of the next subjects runs in a thread pool while the current batch is on the device, and the gzip-compressed
+outputs are written by a background writer pool, so the device does not sit idle during I/O. In center-crop mode
+several subjects are stacked into one forward pass (--subjects_per_batch). A subject whose input cannot be read or
+whose output cannot be written does not stop the others; the failures are listed at the end and the exit status is 1.
+
+The manifest is a text file with one subject per line: the path of its 4D input nifti, optionally followed by the
+output prefix (default: the input filename without extension). Empty lines and lines starting with '#' are ignored.
+
+Usage (run from src):
+    python batch_predict.py --manifest subjects.txt --checkpoint_dir /path/to/model/checkpoints --out_dir /path/to/output
+"""
+
+
+import os
+import sys
+import time
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import torch
+import numpy as np
+
+sys.path.append('../src')
+from dataloaders.volume_cache import read_cropped_data, strip_nifti_ext
+from inference.ensemble import FoldEnsemble
+from inference.pipeline import make_predictor, segment_volume, segment_batch
+from inference.output_writer import OUTPUT_MODES, reference_geometry, save_label, output_ext
+from utils.device import get_device
+
+
+def read_manifest(manifest_path):
+    subjects = []
+    with open(manifest_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            prefix = fields[1] if len(fields) > 1 else strip_nifti_ext(os.path.basename(fields[0]))
+            subjects.append((fields[0], prefix))
+    return subjects
+
+
+def load_subject(data_path, prefix, crop_size):
+    shape, affine = reference_geometry(data_path)
+    data = torch.from_numpy(read_cropped_data(data_path, crop_size))
+    return {'prefix': prefix, 'shape': shape, 'affine': affine, 'data': data}
+
+
+def save_subject(prefix, shape, affine, pred_comb_arr, out_dir, mode='full', compresslevel=1):
+    out_path = os.path.join(out_dir, prefix + '_ratnus' + output_ext(compresslevel))
+    save_label(pred_comb_arr, shape, affine, out_path, mode=mode, compresslevel=compresslevel)
+    return out_path
+
+
+def collect_write(prefix, future, failures):
+    """ Wait for the write of one subject; a failure is recorded in `failures` instead of stopping the run. """
+    try:
+        print('Saved', future.result())
+    except Exception as error:
+        failures.append((prefix, 'write', '{}: {}'.format(type(error).__name__, error)))
+        print('Failed to save', prefix, '-', failures[-1][2])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Segment the thalamic nuclei of the subjects of a manifest.")
+    parser.add_argument('--manifest', type=str, required=True, help='Text file listing the subjects.')
+    parser.add_argument('--checkpoint_dir', type=str, required=True,
+                        help='Folder holding ROI_model/<fold>/ and NUCLEI_model/<fold>/best_checkpoint.pt.')
+    parser.add_argument('--out_dir', type=str, required=True, help='Folder to save the segmentations.')
+    parser.add_argument('--folds', type=int, nargs='+', default=list(range(8)), help='Folds to ensemble.')
+    parser.add_argument('--num_in', type=int, default=68, help='Number of input channels.')
+    parser.add_argument('--device', type=str, default=None,
+                        help="Device to run on, e.g. 'cuda' or 'cpu' (default: $RATNUS_DEVICE or auto).")
+    parser.add_argument('--num_threads', type=int, default=None, help='Intra-op threads for CPU inference.')
+    parser.add_argument('--inference_mode', type=str, default='center_crop', choices=['center_crop', 'sliding_window'],
+                        help='Single pass over the 96^3 center crop or sliding window over the full volume.')
+    parser.add_argument('--patch_overlap', type=float, default=0.5, help='Patch overlap in sliding-window mode.')
+    parser.add_argument('--patch_batch_size', type=int, default=2, help='Patches per forward call.')
+    parser.add_argument('--cascade', action='store_true',
+                        help='Run the NUCLEI models only on the bounding box of the ROI prediction.')
+    parser.add_argument('--subjects_per_batch', type=int, default=1,
+                        help='Subjects stacked into one forward pass (center-crop mode without cascade only).')
+    parser.add_argument('--prefetch', type=int, default=4, help='Subjects decoded ahead of the device.')
+    parser.add_argument('--num_loaders', type=int, default=2, help='Threads decoding input niftis.')
+    parser.add_argument('--num_writers', type=int, default=2, help='Threads compressing and writing outputs.')
+    parser.add_argument('--output_mode', type=str, default='full', choices=OUTPUT_MODES,
+                        help='int32 padded to the input size, or uint8 cropped with the offset in the affine.')
+    parser.add_argument('--compresslevel', type=int, default=1,
+                        help='gzip level of the outputs from 1 to 9, 0 writes uncompressed .nii files.')
+    args = parser.parse_args()
+
+    device = get_device(args.device)
+    os.makedirs(args.out_dir, exist_ok=True)
+    subjects = read_manifest(args.manifest)
+    batched = args.inference_mode == 'center_crop' and not args.cascade
+    subjects_per_batch = args.subjects_per_batch if batched else 1
+    crop_size = (96, 96, 96) if args.inference_mode == 'center_crop' else None
+
+    ensemble = FoldEnsemble(args.checkpoint_dir, folds=args.folds, num_in=args.num_in, device=device,
+                            num_threads=args.num_threads)
+    predict = make_predictor(args.inference_mode, device, patch_overlap=args.patch_overlap,
+                             patch_batch_size=args.patch_batch_size)
+
+    start = time.perf_counter()
+    loaders = ThreadPoolExecutor(max_workers=args.num_loaders)
+    writers = ThreadPoolExecutor(max_workers=args.num_writers)
+    pending_loads = deque((prefix, loaders.submit(load_subject, path, prefix, crop_size))
+                          for path, prefix in subjects[:args.prefetch + subjects_per_batch])
+    next_subject = len(pending_loads)
+    # (prefix, future) of the queued writes; only the prediction and the geometry are held until it is written
+    pending_writes = deque()
+    # (prefix, stage, error) of the subjects that could not be loaded or saved, the others are processed regardless
+    failures = []
+
+    while pending_loads:
+        batch = []
+        for _ in range(min(subjects_per_batch, len(pending_loads))):
+            prefix, future = pending_loads.popleft()
+            try:
+                batch.append(future.result())
+            except Exception as error:
+                failures.append((prefix, 'load', '{}: {}'.format(type(error).__name__, error)))
+                print('Failed to load', prefix, '-', failures[-1][2])
+
+        # keep the loader pool busy while the device works on this batch
+        while next_subject < len(subjects) and len(pending_loads) < args.prefetch + subjects_per_batch:
+            path, prefix = subjects[next_subject]
+            pending_loads.append((prefix, loaders.submit(load_subject, path, prefix, crop_size)))
+            next_subject += 1
+
+        if not batch:
+            continue
+        if batched:
+            pred_1_arrs, pred_2_arrs = segment_batch(ensemble.model_1, ensemble.model_2,
+                                                     torch.stack([subject['data'] for subject in batch]), device)
+        else:
+            pred_1_arr, pred_2_arr = segment_volume(ensemble.model_1, ensemble.model_2, batch[0]['data'], predict,
+                                                    cascade=args.cascade)
+            pred_1_arrs, pred_2_arrs = [pred_1_arr], [pred_2_arr]
+
+        for subject, pred_1_arr, pred_2_arr in zip(batch, pred_1_arrs, pred_2_arrs):
+            pred_comb_arr = pred_1_arr.astype(np.int32) * pred_2_arr.astype(np.int32)
+            pending_writes.append((subject['prefix'], writers.submit(
+                save_subject, subject['prefix'], subject['shape'], subject['affine'], pred_comb_arr, args.out_dir,
+                args.output_mode, args.compresslevel)))
+            print('Segmented', subject['prefix'])
+
+        # writers that fall behind hold back the device instead of piling up predictions in memory
+        while len(pending_writes) > args.num_writers * 2:
+            collect_write(*pending_writes.popleft(), failures)
+
+    while pending_writes:
+        collect_write(*pending_writes.popleft(), failures)
+    loaders.shutdown()
+    writers.shutdown()
+
+    elapsed = time.perf_counter() - start
+    print('{} subjects in {:.1f}s: {:.1f} subjects/hour'.format(len(subjects), elapsed,
+                                                                 3600. * len(subjects) / elapsed))
+    if failures:
+        print('{} of {} subjects failed:'.format(len(failures), len(subjects)))
+        for prefix, stage, error in failures:
+            print('  {} ({}): {}'.format(prefix, stage, error))
+        raise SystemExit(1)
@@ -0,0 +1,105 @@
+"""
+Seconds per volume of the per-channel scipy transforms of utils/augmentation.py versus the single-pass engine of
+utils/spatial_augmentation.py, with its torch (grid_sample, trilinear) and scipy (cubic spline) backends.
+
+Both sides draw their parameters from identically seeded random states. Where the parameters coincide (rotate, flip,
+shift), the mean absolute difference to the per-channel output over the central voxels is printed as well. Zoom is
+not comparable because RandomZoom changes the volume shape, and ElasticDeformation draws a full-size noise field.
+
+Run from src/benchmarks:
+    python bench_augmentation.py --channels 68 --size 96 --repeats 2
+"""
+
+
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+from scipy.ndimage import gaussian_filter
+
+sys.path.append('../../src')
+from utils import augmentation, spatial_augmentation
+from utils.spatial_augmentation import (SpatialCompose, AffineStep, coordinate_map, compose_affine, resample,
+                                        resample_scipy)
+
+TRANSFORMS = {
+    'rotate': (augmentation.RandomRotate, spatial_augmentation.Rotate),
+    'flip': (augmentation.HorizontalFlip, spatial_augmentation.Flip),
+    'zoom': (augmentation.RandomZoom, spatial_augmentation.Zoom),
+    'shift': (augmentation.RandomShift, spatial_augmentation.Shift),
+    'elastic': (augmentation.ElasticDeformation, spatial_augmentation.Elastic),
+}
+COMPARABLE = ('rotate', 'flip', 'shift')
+
+
+def run_engine(transform, data, label, backend):
+    step, _ = transform(label.shape)
+    if backend == 'scipy':
+        if isinstance(step, AffineStep):
+            return resample_scipy(data, label, compose_affine([step], label.shape))
+        return resample_scipy(data, label, coordinate_map([step], label.shape))
+    coords = coordinate_map([step], label.shape)
+    coords = coords.unsqueeze(0)
+    data_out = resample(torch.from_numpy(data)[None], coords)[0]
+    label_out = resample(torch.from_numpy(label.astype(np.float32))[None, None], coords,
+                         mode='nearest', padding_mode='border')[0, 0]
+    return data_out.numpy(), label_out.numpy().astype(label.dtype)
+
+
+def time_repeats(fn, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        out = fn()
+    return (time.perf_counter() - start) / repeats, out
+
+
+def central_diff(a, b, margin):
+    inner = (slice(None),) + (slice(margin, -margin),) * 3
+    return np.abs(a[inner] - b[inner]).mean()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark per-channel versus single-pass augmentation.")
+    parser.add_argument('--channels', type=int, default=68, help='Number of data channels.')
+    parser.add_argument('--size', type=int, default=96, help='Spatial size of the cubic volume.')
+    parser.add_argument('--repeats', type=int, default=2, help='Timed repetitions per transform.')
+    parser.add_argument('--transforms', type=str, nargs='+', default=list(TRANSFORMS), choices=list(TRANSFORMS))
+    parser.add_argument('--num_threads', type=int, default=1,
+                        help='Intra-op threads of the torch backend (dataloader workers run with 1).')
+    args = parser.parse_args()
+
+    torch.set_num_threads(args.num_threads)
+    rng = np.random.RandomState(0)
+    # smooth, image-like channels; interpolation differences on white noise would be meaningless
+    data = np.stack([gaussian_filter(rng.rand(*(args.size,) * 3), 2) for _ in range(args.channels)]).astype(np.float32)
+    label = rng.randint(0, 14, (args.size,) * 3).astype(np.int8)
+
+    print('input: {} channels, {}^3, {} torch thread(s)'.format(args.channels, args.size, torch.get_num_threads()))
+    print('{:<10}{:>14}{:>14}{:>14}{:>12}{:>12}'.format('transform', 'per-channel', 'torch', 'scipy',
+                                                        'diff torch', 'diff scipy'))
+    for name in args.transforms:
+        legacy_cls, engine_cls = TRANSFORMS[name]
+        legacy = legacy_cls(np.random.RandomState(1))
+        legacy_time, (legacy_data, _, _) = time_repeats(lambda: legacy(data, label), args.repeats)
+
+        results = {}
+        for backend in ['torch', 'scipy']:
+            engine = engine_cls(np.random.RandomState(1))
+            results[backend] = time_repeats(lambda: run_engine(engine, data, label, backend), args.repeats)
+
+        diffs = ['-', '-']
+        if name in COMPARABLE:
+            diffs = ['{:.2e}'.format(central_diff(results[backend][1][0], legacy_data, margin=8))
+                     for backend in ['torch', 'scipy']]
+        print('{:<10}{:>13.3f}s{:>13.3f}s{:>13.3f}s{:>12}{:>12}'.format(
+            name, legacy_time, results['torch'][0], results['scipy'][0], *diffs))
+
+    # full pipelines: the same expected number of transforms (0-2 per volume)
+    compose = augmentation.Compose(np.random.RandomState(2))
+    legacy_time, _ = time_repeats(lambda: compose(data, label), args.repeats * 4)
+    spatial = SpatialCompose(np.random.RandomState(2))
+    spatial_time, _ = time_repeats(lambda: spatial(data, label), args.repeats * 4)
+    print('Compose: {:.3f} s/volume  SpatialCompose (torch): {:.3f} s/volume  (speedup {:.1f}x)'.format(
+        legacy_time, spatial_time, legacy_time / spatial_time))
@@ -0,0 +1,68 @@
+"""
+Seconds per subject of UnetL5 inference on the CPU: plain eager PyTorch versus the tuned path of
+inference/optimize.py (BatchNorm folding, channels-last-3d, inference_mode, intra-op thread count).
+
+Run from src/benchmarks:
+    python bench_cpu_inference.py --num_threads 8 --subjects 5
+"""
+
+
+import sys
+import time
+import argparse
+import torch
+import torch.nn as nn
+
+sys.path.append('../../src')
+from models.unet3d import UnetL5
+from inference.optimize import optimize_for_inference, prepare_input
+
+
+def time_subjects(model, volumes, prepare):
+    # one warm-up pass so that oneDNN primitive creation is not timed
+    model(prepare(volumes[0]))
+    start = time.perf_counter()
+    for volume in volumes:
+        model(prepare(volume))
+    return (time.perf_counter() - start) / len(volumes)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark CPU inference of UnetL5.")
+    parser.add_argument('--checkpoint', type=str, default=None, help='best_checkpoint.pt to load, random weights if unset.')
+    parser.add_argument('--num_in', type=int, default=68, help='Number of input channels.')
+    parser.add_argument('--num_out', type=int, default=13, help='Number of output channels.')
+    parser.add_argument('--size', type=int, nargs=3, default=[96, 96, 96], help='Spatial size of a subject volume.')
+    parser.add_argument('--subjects', type=int, default=3, help='Number of subjects to time.')
+    parser.add_argument('--num_threads', type=int, default=None, help='Intra-op threads, torch default if unset.')
+    args = parser.parse_args()
+
+    device = torch.device('cpu')
+    torch.manual_seed(0)
+    volumes = [torch.rand(1, args.num_in, *args.size) for _ in range(args.subjects)]
+
+    def build():
+        model = UnetL5(in_dim=args.num_in, out_dim=args.num_out, num_filters=4, output_activation=nn.Softmax(dim=1))
+        if args.checkpoint:
+            model.load_state_dict(torch.load(args.checkpoint, map_location='cpu')['state_dict'])
+        return model.eval()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    eager = build()
+    with torch.no_grad():
+        eager_time = time_subjects(eager, volumes, lambda volume: volume)
+        reference = eager(volumes[0])
+
+    tuned = build()
+    tuned.load_state_dict(eager.state_dict())
+    tuned = optimize_for_inference(tuned, device, num_threads=args.num_threads)
+    with torch.inference_mode():
+        tuned_time = time_subjects(tuned, volumes, lambda volume: prepare_input(volume, tuned))
+        max_diff = (tuned(prepare_input(volumes[0], tuned)) - reference).abs().max().item()
+
+    print('threads: {}  input: {}x{}'.format(torch.get_num_threads(), args.num_in, 'x'.join(map(str, args.size))))
+    print('eager: {:.3f} s/subject'.format(eager_time))
+    print('tuned: {:.3f} s/subject  (speedup {:.2f}x, max abs diff {:.2e})'.format(
+        tuned_time, eager_time / tuned_time, max_diff))
@@ -0,0 +1,114 @@
+"""
+Time and peak memory of a DiceLoss forward/backward step: the previous implementation (explicit one-hot tensor and
+full-size temporaries) versus the current DiceLoss, which one-hot encodes the ground truth below
+loss.SPARSE_MIN_CLASSES classes and gathers the prediction at the ground truth classes from there on.
+
+Peak memory is the CUDA allocator peak on GPU and the growth of the process high-water mark (ru_maxrss) on the CPU,
+each variant running in its own process.
+
+Run from src/benchmarks:
+    python bench_dice_loss.py --num_classes 13 --batch_size 1 --size 96
+"""
+
+
+import sys
+import time
+import resource
+import argparse
+import multiprocessing
+import torch
+
+sys.path.append('../../src')
+from loss import DiceLoss
+from utils.device import get_device
+
+
+def reference_one_hot_encoding(gt, gt_values, num_classes):
+    one_hot = torch.zeros(gt.size(0), num_classes, *gt.size()[1:], device=gt.device)
+    for idx in range(num_classes):
+        one_hot[:, idx, ...] = (gt == gt_values[idx]).float()
+    return one_hot
+
+
+def reference_dice_loss(prediction, ground_truth, gt_values, num_classes, eps=1e-6):
+    ground_truth = reference_one_hot_encoding(ground_truth, gt_values, num_classes)
+    intersection = torch.sum(prediction * ground_truth, dim=(2, 3, 4))
+    union = torch.sum(prediction ** 2, dim=(2, 3, 4)) + torch.sum(ground_truth ** 2, dim=(2, 3, 4))
+    dice_score_channel = torch.mean((2 * intersection + eps) / (union + eps), dim=0)
+    return 1 - torch.mean(dice_score_channel)
+
+
+def make_inputs(args, device):
+    generator = torch.Generator().manual_seed(0)
+    shape = (args.batch_size, args.num_classes) + (args.size,) * 3
+    logits = torch.randn(shape, generator=generator).to(device)
+    # ROI labels are 0/1, NUCLEI labels 0..13 with 0 (background) not being one of the classes
+    low = 0 if args.num_classes == 2 else 1
+    gt_values = list(range(low, low + args.num_classes))
+    target = torch.randint(0, low + args.num_classes, (args.batch_size,) + (args.size,) * 3, generator=generator)
+    return logits, target.to(device).float(), gt_values
+
+
+def run_variant(variant, args, queue):
+    device = get_device(args.device)
+    logits, target, gt_values = make_inputs(args, device)
+    lossfn = DiceLoss(num_classes=args.num_classes, isOneHot=False, gt_values=gt_values)
+
+    def step():
+        prediction = torch.softmax(logits, dim=1).requires_grad_(True)
+        if variant == 'reference':
+            loss = reference_dice_loss(prediction, target, gt_values, args.num_classes)
+        else:
+            loss = lossfn(prediction, target)
+        loss.backward()
+        return loss.item(), prediction.grad
+
+    # peak memory of the first step, measured before anything else raised the high-water mark
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    loss, grad = step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak_mb = (torch.cuda.max_memory_allocated() - base) / 2 ** 20
+    else:
+        peak_mb = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss) / 2 ** 10
+
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        loss, grad = step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / args.repeats
+    # numpy, a shared-memory tensor would not outlive this process
+    queue.put((loss, grad.cpu().numpy(), elapsed, peak_mb))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the Dice loss.")
+    parser.add_argument('--num_classes', type=int, default=13, help='Number of classes (2 for ROI, 13 for NUCLEI).')
+    parser.add_argument('--batch_size', type=int, default=1, help='Batch size.')
+    parser.add_argument('--size', type=int, default=96, help='Spatial size of the cubic volume.')
+    parser.add_argument('--repeats', type=int, default=5, help='Timed repetitions.')
+    parser.add_argument('--device', type=str, default=None, help="Device, e.g. 'cuda' or 'cpu'.")
+    args = parser.parse_args()
+
+    # each variant runs in a fresh process so that its memory peak is not hidden by the other one
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for variant in ['reference', 'current']:
+        queue = context.Queue()
+        process = context.Process(target=run_variant, args=(variant, args, queue))
+        process.start()
+        results[variant] = queue.get()
+        process.join()
+
+    ref_loss, ref_grad, ref_time, ref_peak = results['reference']
+    loss, grad, elapsed, peak = results['current']
+    print('input: {} classes, batch {}, {}^3'.format(args.num_classes, args.batch_size, args.size))
+    print('reference: {:.4f} s/step  peak {:.1f} MB'.format(ref_time, ref_peak))
+    print('current:   {:.4f} s/step  peak {:.1f} MB  (speedup {:.2f}x)'.format(elapsed, peak, ref_time / elapsed))
+    print('loss diff: {:.2e}  max grad diff: {:.2e}'.format(abs(loss - ref_loss), abs(grad - ref_grad).max()))
@@ -0,0 +1,138 @@
+"""
+Startup time and CPU latency of one fold (ROI + NUCLEI model): eager PyTorch from the checkpoints (inference/ensemble.py,
+as in predict.py) versus the artifacts of export_model.py run by inference/runtime.py.
+
+Startup is the wall time of a fresh interpreter from launch until both models are ready, interpreter and imports
+included; a bare `import torch` is timed as the baseline. Latency is measured in this process on random volumes.
+Without --checkpoint_dir, randomly initialized checkpoints are written to a temporary folder first. ONNX is included if
+onnx and onnxruntime are installed.
+
+Run from src/benchmarks:
+    python bench_export.py --checkpoint_dir /path/to/model/checkpoints --fold 0 --num_threads 8
+"""
+
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+import torch
+import torch.nn as nn
+import numpy as np
+
+sys.path.append('../../src')
+from models.unet3d import UnetL5
+from inference.ensemble import load_fold_model
+from inference.optimize import prepare_input
+from inference.runtime import load_fold, onnxruntime
+from export_model import export_fold
+
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+STARTUP_EAGER = """
+import sys, torch, torch.nn as nn
+sys.path.append({src!r})
+from inference.ensemble import load_fold_model
+load_fold_model({roi!r}, {num_in}, 2, nn.Sigmoid(), torch.device('cpu'))
+load_fold_model({nuclei!r}, {num_in}, 13, nn.Softmax(dim=1), torch.device('cpu'))
+"""
+
+STARTUP_EXPORTED = """
+import sys
+sys.path.append({src!r})
+from inference.runtime import load_fold
+load_fold({export_dir!r}, {fold!r}, {export_format!r})
+"""
+
+
+def write_random_checkpoints(checkpoint_dir, fold, num_in):
+    for name, out_dim in [('ROI_model', 2), ('NUCLEI_model', 13)]:
+        os.makedirs(os.path.join(checkpoint_dir, name, str(fold)), exist_ok=True)
+        model = UnetL5(in_dim=num_in, out_dim=out_dim, num_filters=4)
+        torch.save({'state_dict': model.state_dict(), 'train_losses': [], 'val_losses': []},
+                   os.path.join(checkpoint_dir, name, str(fold), 'best_checkpoint.pt'))
+
+
+def startup_seconds(code, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True, stderr=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def latency_seconds(run, volumes):
+    # one warm-up pass so that primitive creation is not timed
+    run(volumes[0])
+    start = time.perf_counter()
+    for volume in volumes:
+        run(volume)
+    return (time.perf_counter() - start) / len(volumes)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark exported models against eager PyTorch on the CPU.")
+    parser.add_argument('--checkpoint_dir', type=str, default=None, help='Checkpoints to export, random if unset.')
+    parser.add_argument('--fold', type=int, default=0, help='Fold to export and run.')
+    parser.add_argument('--num_in', type=int, default=68, help='Number of input channels.')
+    parser.add_argument('--size', type=int, nargs=3, default=[96, 96, 96], help='Spatial size of a subject volume.')
+    parser.add_argument('--subjects', type=int, default=3, help='Number of subjects to time.')
+    parser.add_argument('--startup_repeats', type=int, default=3, help='Fresh interpreters per startup measurement.')
+    parser.add_argument('--num_threads', type=int, default=None, help='Intra-op threads, torch default if unset.')
+    args = parser.parse_args()
+
+    formats = ['torchscript']
+    try:
+        import onnx  # noqa: F401, only needed for the export
+        if onnxruntime is not None:
+            formats.append('onnx')
+    except ImportError:
+        print('onnx or onnxruntime not installed, ONNX is skipped')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint_dir = args.checkpoint_dir
+        if checkpoint_dir is None:
+            checkpoint_dir = os.path.join(tmp_dir, 'checkpoints')
+            write_random_checkpoints(checkpoint_dir, args.fold, args.num_in)
+        export_dir = os.path.join(tmp_dir, 'exported')
+        export_fold(checkpoint_dir, args.fold, export_dir, 'both' if 'onnx' in formats else 'torchscript',
+                    num_in=args.num_in, size=args.size)
+        roi_checkpoint, nuclei_checkpoint = [os.path.join(checkpoint_dir, name, str(args.fold), 'best_checkpoint.pt')
+                                             for name in ('ROI_model', 'NUCLEI_model')]
+
+        startup = {'import torch': startup_seconds('import torch', args.startup_repeats)}
+        startup['eager'] = startup_seconds(STARTUP_EAGER.format(src=SRC_DIR, roi=roi_checkpoint, nuclei=nuclei_checkpoint,
+                                                                num_in=args.num_in), args.startup_repeats)
+        for export_format in formats:
+            startup[export_format] = startup_seconds(STARTUP_EXPORTED.format(
+                src=SRC_DIR, export_dir=export_dir, fold=args.fold, export_format=export_format), args.startup_repeats)
+
+        device = torch.device('cpu')
+        torch.manual_seed(0)
+        volumes = [torch.rand(1, args.num_in, *args.size) for _ in range(args.subjects)]
+        eager = [load_fold_model(roi_checkpoint, args.num_in, 2, nn.Sigmoid(), device, args.num_threads),
+                 load_fold_model(nuclei_checkpoint, args.num_in, 13, nn.Softmax(dim=1), device, args.num_threads)]
+
+        def run_eager(volume):
+            with torch.inference_mode():
+                return [model(prepare_input(volume, model)).numpy() for model in eager]
+
+        latency = {'eager': latency_seconds(run_eager, volumes)}
+        reference = run_eager(volumes[0])
+        max_diff = {}
+        for export_format in formats:
+            exported = load_fold(export_dir, args.fold, export_format, num_threads=args.num_threads)
+            latency[export_format] = latency_seconds(lambda volume: [model(volume) for model in exported], volumes)
+            max_diff[export_format] = max(float(np.abs(model(volumes[0]) - ref).max())
+                                          for model, ref in zip(exported, reference))
+
+    print('threads: {}  input: {}x{}'.format(torch.get_num_threads(), args.num_in, 'x'.join(map(str, args.size))))
+    print('import torch: startup {:.2f} s'.format(startup['import torch']))
+    print('eager:       startup {:.2f} s  latency {:.3f} s/subject'.format(startup['eager'], latency['eager']))
+    for export_format in formats:
+        print('{:12s} startup {:.2f} s  latency {:.3f} s/subject  (max abs diff {:.2e})'.format(
+            export_format + ':', startup[export_format], latency[export_format], max_diff[export_format]))
@@ -0,0 +1,104 @@
+"""
+Latency and peak memory of one subject through the two-model pipeline (ROI and NUCLEI UnetL5) versus the multi-task
+model (MultiTaskUnetL5, one shared encoder and two heads), both prepared by inference/optimize.py.
+
+Each variant runs in its own process. On the CPU, peak memory is the growth of the process high-water mark (VmHWM) over
+the resident size before the timed passes. The mark is reset after the warm-up pass via /proc/self/clear_refs. On CUDA,
+it is torch.cuda.max_memory_allocated.
+
+Run from src/benchmarks:
+    python bench_multitask.py --num_threads 8 --subjects 3 [--device cuda]
+"""
+
+
+import sys
+import time
+import argparse
+import multiprocessing
+import torch
+import torch.nn as nn
+
+sys.path.append('../../src')
+from models.unet3d import UnetL5, MultiTaskUnetL5
+from inference.optimize import optimize_for_inference
+from inference.pipeline import ConcatenatedHeads
+from inference.cascade import forward
+
+
+def status_mb(field):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) / 2 ** 10
+    return 0.
+
+
+def reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM to the current resident size (Linux)
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+
+
+def build(variant, num_in, device, num_threads):
+    torch.manual_seed(0)
+    if variant == 'multitask':
+        model = MultiTaskUnetL5(in_dim=num_in, roi_dim=2, nuclei_dim=13, num_filters=4)
+        return [ConcatenatedHeads(optimize_for_inference(model.eval(), device, num_threads=num_threads))]
+    model_1 = UnetL5(in_dim=num_in, out_dim=2, num_filters=4, output_activation=nn.Sigmoid())
+    model_2 = UnetL5(in_dim=num_in, out_dim=13, num_filters=4, output_activation=nn.Softmax(dim=1))
+    return [optimize_for_inference(model.eval(), device, num_threads=num_threads) for model in (model_1, model_2)]
+
+
+def run_variant(variant, args, queue):
+    device = torch.device(args.device)
+    models = build(variant, args.num_in, device, args.num_threads)
+    num_params = sum(param.numel() for model in models for param in model.parameters())
+    volumes = [torch.rand(args.num_in, *args.size) for _ in range(args.subjects)]
+
+    with torch.inference_mode():
+        # one warm-up pass so that primitive creation is not timed
+        for model in models:
+            forward(model, volumes[0], device)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            reset_peak_rss()
+        base_rss = status_mb('VmRSS')
+
+        start = time.perf_counter()
+        for volume in volumes:
+            for model in models:
+                forward(model, volume, device).cpu()
+        elapsed = (time.perf_counter() - start) / len(volumes)
+
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if device.type == 'cuda' else status_mb('VmHWM') - base_rss
+    queue.put((elapsed, peak, num_params))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark the multi-task model against the two-model pipeline.")
+    parser.add_argument('--num_in', type=int, default=68, help='Number of input channels.')
+    parser.add_argument('--size', type=int, nargs=3, default=[96, 96, 96], help='Spatial size of a subject volume.')
+    parser.add_argument('--subjects', type=int, default=3, help='Number of subjects to time.')
+    parser.add_argument('--num_threads', type=int, default=None, help='Intra-op threads, torch default if unset.')
+    parser.add_argument('--device', type=str, default='cpu', help="Device to run on, e.g. 'cpu' or 'cuda'.")
+    args = parser.parse_args()
+
+    # each variant runs in a fresh process so that its memory peak is not hidden by the other one
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for variant in ['two_models', 'multitask']:
+        queue = context.Queue()
+        process = context.Process(target=run_variant, args=(variant, args, queue))
+        process.start()
+        results[variant] = queue.get()
+        process.join()
+
+    print('device: {}  input: {}x{}'.format(args.device, args.num_in, 'x'.join(map(str, args.size))))
+    ref_time, ref_peak, ref_params = results['two_models']
+    elapsed, peak, num_params = results['multitask']
+    print('two models: {:.3f} s/subject  peak {:.1f} MB  {:.2f}M parameters'.format(ref_time, ref_peak, ref_params / 1e6))
+    print('multitask:  {:.3f} s/subject  peak {:.1f} MB  {:.2f}M parameters  (speedup {:.2f}x)'.format(
+        elapsed, peak, num_params / 1e6, ref_time / elapsed))
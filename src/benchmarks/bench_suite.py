@@ -0,0 +1,377 @@
+"""
+Reproducible benchmark suite: synthetic NIfTI fixtures, timings of the main stages and a comparison between runs.
+
+    python bench_suite.py fixtures --out /tmp/ratnus_fixtures
+    python bench_suite.py run --fixtures /tmp/ratnus_fixtures --out before.json
+    python bench_suite.py run --fixtures /tmp/ratnus_fixtures --out after.json
+    python bench_suite.py compare before.json after.json --threshold 0.1
+
+fixtures writes, from a fixed seed, subjects in the layout of the training and test data:
+    out/data/subject_XX.nii.gz       [H, W, L, 68] float32, smooth random contrasts plus noise
+    out/label_1/subject_XX.nii.gz    binary ROI label, one ellipsoid per thalamus
+    out/label_2/subject_XX.nii.gz    nuclei labels 1..13, sectors of the ROI
+    out/eigvec/subject_XX.nii        [H, W, L, 3] unit principal eigenvectors, the input of compute_knutsson
+    out/fixtures.json                the generation parameters
+run times every benchmark (one untimed warm-up call, then --repeats timed calls, each with freshly seeded inputs)
+and writes the times and their statistics together with the environment: versions, CPU, threads, device and the git
+commit. run generates the fixtures first if --fixtures does not hold them yet.
+compare prints the ratio of every benchmark between two result files and flags it as a regression (or improvement)
+when the chosen statistic changed by more than --threshold; the exit status is 1 if there is any regression. It also
+warns when the environments of the two runs differ.
+
+Run from src/benchmarks.
+"""
+
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import itertools
+import platform
+import statistics
+import subprocess
+import datetime
+import numpy as np
+import nibabel as nib
+import scipy
+import torch
+import torch.nn as nn
+from scipy.ndimage import gaussian_filter
+
+sys.path.append('../../src')
+sys.path.append('../../dmri_processing_pipeline')
+from dataloaders.dataloader_train import load_data, load_label
+from utils import augmentation
+from utils.augmentation import center_crop
+from utils.utils import one_hot_encoding, generate_foreground_mask
+from loss import DiceLoss
+from models.unet3d import UnetL5
+from step01_calc_knutsson import compute_knutsson
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+CROP_SIZE = (96, 96, 96)
+NUCLEI_GT_VALUES = list(range(1, 14))
+AUGMENTATIONS = ['RandomRotate', 'HorizontalFlip', 'RandomZoom', 'RandomShift', 'ElasticDeformation']
+
+
+# Fixtures
+
+def smooth_field(rng, shape, sigma):
+    field = gaussian_filter(rng.standard_normal(shape).astype(np.float32), sigma)
+    return field / (field.std() + 1e-6)
+
+
+def thalamus_labels(shape):
+    """ ROI (one ellipsoid per hemisphere) and nuclei labels (13 angular sectors of each ellipsoid). """
+    grid = np.stack(np.meshgrid(*[np.arange(n, dtype=np.float32) - n / 2 for n in shape], indexing='ij'), axis=0)
+    roi = np.zeros(shape, dtype=np.int32)
+    nuclei = np.zeros(shape, dtype=np.int32)
+    for side in (-1, 1):
+        x, y, z = grid[0] - side * 12, grid[1], grid[2]
+        inside = (x / 9) ** 2 + (y / 15) ** 2 + (z / 10) ** 2 <= 1
+        sector = np.floor((np.arctan2(z, y) + np.pi) / (2 * np.pi) * 13).astype(np.int32) % 13
+        roi[inside] = 1
+        nuclei[inside] = sector[inside] + 1
+    return roi, nuclei
+
+
+def write_fixtures(out_dir, subjects=2, size=(112, 112, 112), channels=68, seed=0):
+    """ Write the synthetic subjects (see the module docstring); returns the generation parameters. """
+    for sub_dir in ('data', 'label_1', 'label_2', 'eigvec'):
+        os.makedirs(os.path.join(out_dir, sub_dir), exist_ok=True)
+    rng = np.random.RandomState(seed)
+    affine = np.diag([1., 1., 1., 1.])
+    roi, nuclei = thalamus_labels(size)
+
+    for subject in range(subjects):
+        name = 'subject_{:02d}'.format(subject)
+        # every contrast is a mix of a few smooth fields, brighter inside the thalamus, plus noise
+        fields = np.stack([smooth_field(rng, size, 4) for _ in range(4)], axis=-1)
+        weights = rng.uniform(-1, 1, (4, channels)).astype(np.float32)
+        data = fields @ weights + rng.uniform(0, 1, channels).astype(np.float32) * roi[..., None]
+        data += 0.1 * rng.standard_normal(data.shape).astype(np.float32)
+        nib.Nifti1Image(data.astype(np.float32), affine).to_filename(os.path.join(out_dir, 'data', name + '.nii.gz'))
+        nib.Nifti1Image(roi, affine).to_filename(os.path.join(out_dir, 'label_1', name + '.nii.gz'))
+        nib.Nifti1Image(nuclei, affine).to_filename(os.path.join(out_dir, 'label_2', name + '.nii.gz'))
+
+        vectors = np.stack([smooth_field(rng, size, 3) for _ in range(3)], axis=-1)
+        vectors /= np.linalg.norm(vectors, axis=-1, keepdims=True) + 1e-6
+        nib.Nifti1Image(vectors.astype(np.float32), affine).to_filename(os.path.join(out_dir, 'eigvec', name + '.nii'))
+
+    params = {'subjects': subjects, 'size': list(size), 'channels': channels, 'seed': seed}
+    with open(os.path.join(out_dir, 'fixtures.json'), 'w') as f:
+        json.dump(params, f, indent=2)
+    return params
+
+
+def fixture_paths(fixtures_dir, sub_dir):
+    return [os.path.join(fixtures_dir, sub_dir, fn) for fn in sorted(os.listdir(os.path.join(fixtures_dir, sub_dir)))]
+
+
+# Benchmarks: each returns a list of (name, setup, run); setup() builds the inputs of one call of run(inputs) and is
+# not timed
+
+def bench_loading(fixtures_dir, args):
+    data_paths = fixture_paths(fixtures_dir, 'data')
+    label_paths = fixture_paths(fixtures_dir, 'label_2')
+
+    def run(index):
+        data = center_crop(load_data(data_paths[index]), CROP_SIZE)
+        label = center_crop(load_label(label_paths[index]), CROP_SIZE)
+        return data, label
+
+    # the subjects in turn, so that a repeated call does not just read the page cache of the previous one
+    indices = itertools.cycle(range(len(data_paths)))
+    return [('load_data+center_crop', lambda: next(indices), run)]
+
+
+def bench_augmentations(fixtures_dir, args):
+    data = center_crop(load_data(fixture_paths(fixtures_dir, 'data')[0]), CROP_SIZE)
+    label = center_crop(load_label(fixture_paths(fixtures_dir, 'label_2')[0]), CROP_SIZE)
+    benchmarks = []
+    for name in AUGMENTATIONS:
+        # the same random parameters in every call and every run
+        def setup(name=name):
+            return getattr(augmentation, name)(np.random.RandomState(args.seed)), data.copy(), label.copy()
+        benchmarks.append(('augmentation.' + name, setup, lambda inputs: inputs[0](inputs[1], inputs[2])))
+    return benchmarks
+
+
+def bench_dice(fixtures_dir, args):
+    device = torch.device(args.device)
+    label = center_crop(load_label(fixture_paths(fixtures_dir, 'label_2')[0]), CROP_SIZE)
+    gt = torch.from_numpy(np.stack([label, label[::-1].copy()])).to(device)
+    one_hot_loss = DiceLoss(num_classes=13, isOneHot=True)
+    sparse_loss = DiceLoss(num_classes=13, isOneHot=False, gt_values=NUCLEI_GT_VALUES)
+
+    def setup():
+        torch.manual_seed(args.seed)
+        return torch.softmax(torch.randn(2, 13, *CROP_SIZE, device=device), dim=1).requires_grad_(True)
+
+    def run_one_hot(prediction):
+        loss = one_hot_loss(prediction, one_hot_encoding(gt, NUCLEI_GT_VALUES, 13))
+        loss.backward()
+        return loss
+
+    def run_sparse(prediction):
+        loss = sparse_loss(prediction, gt)
+        loss.backward()
+        return loss
+
+    return [('one_hot_encoding+DiceLoss', setup, run_one_hot), ('DiceLoss.sparse', setup, run_sparse)]
+
+
+def bench_unet(fixtures_dir, args):
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    model = UnetL5(in_dim=args.channels, out_dim=13, num_filters=4, output_activation=nn.Softmax(dim=1)).to(device)
+    data = torch.from_numpy(center_crop(load_data(fixture_paths(fixtures_dir, 'data')[0]), CROP_SIZE)[None])
+    data = data[:, :args.channels].to(device)
+
+    def run_forward(_):
+        model.eval()
+        with torch.inference_mode():
+            return model(data)
+
+    def run_train_step(_):
+        model.train()
+        output = model(data)
+        output.mean().backward()
+        model.zero_grad(set_to_none=True)
+        return output
+
+    return [('UnetL5.forward', lambda: None, run_forward), ('UnetL5.forward_backward', lambda: None, run_train_step)]
+
+
+def bench_foreground_mask(fixtures_dir, args):
+    roi = center_crop(load_label(fixture_paths(fixtures_dir, 'label_1')[0]), CROP_SIZE)
+
+    def setup():
+        # a noisy ROI prediction: the label plus salt noise, thousands of small components
+        rng = np.random.RandomState(args.seed)
+        return np.maximum(roi, rng.random_sample(roi.shape) < 0.02).astype(np.int32)
+
+    return [('generate_foreground_mask', setup, generate_foreground_mask)]
+
+
+def bench_knutsson(fixtures_dir, args):
+    eigvec_file = fixture_paths(fixtures_dir, 'eigvec')[0]
+    out_dir = os.path.join(fixtures_dir, 'knutsson')
+    os.makedirs(out_dir, exist_ok=True)
+    return [('compute_knutsson', lambda: os.path.join(out_dir, 'subject_00'),
+             lambda prefix: compute_knutsson(eigvec_file, prefix))]
+
+
+# names of the benchmarks of every factory, so that factories of unselected benchmarks are not even set up
+BENCHMARKS = [(['load_data+center_crop'], bench_loading),
+              (['augmentation.' + name for name in AUGMENTATIONS], bench_augmentations),
+              (['one_hot_encoding+DiceLoss', 'DiceLoss.sparse'], bench_dice),
+              (['UnetL5.forward', 'UnetL5.forward_backward'], bench_unet),
+              (['generate_foreground_mask'], bench_foreground_mask),
+              (['compute_knutsson'], bench_knutsson)]
+
+
+# Running and comparing
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_DIR,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return {'commit': commit, 'dirty': dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+
+
+def environment(device):
+    env = {'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+           'host': socket.gethostname(),
+           'platform': platform.platform(),
+           'processor': platform.processor() or platform.machine(),
+           'cpu_count': os.cpu_count(),
+           'python': platform.python_version(),
+           'numpy': np.__version__,
+           'scipy': scipy.__version__,
+           'nibabel': nib.__version__,
+           'torch': torch.__version__,
+           'torch_threads': torch.get_num_threads(),
+           'device': str(device),
+           'git': git_revision()}
+    if device.type == 'cuda':
+        env['cuda_device'] = torch.cuda.get_device_name(device)
+    return env
+
+
+def time_benchmark(setup, run, repeats, device):
+    times = []
+    for i in range(repeats + 1):
+        inputs = setup()
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        run(inputs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        if i > 0:
+            # the first call is a warm-up
+            times.append(time.perf_counter() - start)
+    return {'times': times,
+            'min': min(times),
+            'median': statistics.median(times),
+            'mean': statistics.mean(times),
+            'stdev': statistics.stdev(times) if len(times) > 1 else 0.}
+
+
+def selected(name, only):
+    return only is None or any(name == pattern or name.startswith(pattern) for pattern in only)
+
+
+def run_suite(args):
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    if not os.path.exists(os.path.join(args.fixtures, 'fixtures.json')):
+        print('writing fixtures to', args.fixtures)
+        write_fixtures(args.fixtures, args.subjects, args.size, args.channels, args.seed)
+    with open(os.path.join(args.fixtures, 'fixtures.json')) as f:
+        fixtures = json.load(f)
+    args.channels = min(args.channels, fixtures['channels'])
+
+    device = torch.device(args.device)
+    results = {}
+    for names, factory in BENCHMARKS:
+        if not any(selected(name, args.only) for name in names):
+            continue
+        for name, setup, run in factory(args.fixtures, args):
+            if not selected(name, args.only):
+                continue
+            results[name] = time_benchmark(setup, run, args.repeats, device)
+            print('{:32s} median {:9.4f} s  min {:9.4f} s  ({} repeats)'.format(
+                name, results[name]['median'], results[name]['min'], args.repeats), flush=True)
+
+    report = {'environment': environment(device),
+              'fixtures': fixtures,
+              'config': {'repeats': args.repeats, 'channels': args.channels, 'seed': args.seed},
+              'results': results}
+    with open(args.out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Saved', args.out)
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+
+    for key in ('cpu_count', 'torch_threads', 'device', 'torch', 'numpy', 'scipy', 'host'):
+        if base['environment'].get(key) != new['environment'].get(key):
+            print('warning: {} differs ({} vs {})'.format(key, base['environment'].get(key),
+                                                           new['environment'].get(key)))
+    if base['fixtures'] != new['fixtures'] or base['config'] != new['config']:
+        print('warning: the runs used different fixtures or settings')
+
+    regressions = []
+    print('{:32s} {:>11s} {:>11s} {:>8s}'.format('benchmark', 'base (s)', 'new (s)', 'ratio'))
+    for name in sorted(set(base['results']) | set(new['results'])):
+        if name not in base['results'] or name not in new['results']:
+            print('{:32s} only in {}'.format(name, 'base' if name in base['results'] else 'new'))
+            continue
+        before, after = base['results'][name][args.stat], new['results'][name][args.stat]
+        ratio = after / before
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - args.threshold:
+            flag = 'improved'
+        print('{:32s} {:11.4f} {:11.4f} {:7.2f}x  {}'.format(name, before, after, ratio, flag))
+
+    if regressions:
+        print('{} regression(s) over {:.0%}: {}'.format(len(regressions), args.threshold, ', '.join(regressions)))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark suite on synthetic NIfTI fixtures.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fixtures_parser = subparsers.add_parser('fixtures', help='Write the synthetic fixtures.')
+    run_parser = subparsers.add_parser('run', help='Run the benchmarks and save the results as JSON.')
+    for sub_parser in (fixtures_parser, run_parser):
+        sub_parser.add_argument('--subjects', type=int, default=2, help='Number of synthetic subjects.')
+        sub_parser.add_argument('--size', type=int, nargs=3, default=[112, 112, 112],
+                                help='Spatial size of the synthetic volumes, at least 96 (the crop size).')
+        sub_parser.add_argument('--channels', type=int, default=68, help='Number of input channels.')
+        sub_parser.add_argument('--seed', type=int, default=0, help='Seed of the fixtures and the random inputs.')
+    fixtures_parser.add_argument('--out', type=str, required=True, help='Folder to write the fixtures to.')
+
+    run_parser.add_argument('--fixtures', type=str, required=True, help='Fixture folder, written first if empty.')
+    run_parser.add_argument('--out', type=str, required=True, help='JSON file to save the results to.')
+    run_parser.add_argument('--repeats', type=int, default=5, help='Timed calls per benchmark after one warm-up.')
+    run_parser.add_argument('--only', type=str, nargs='+', default=None,
+                            help="Benchmarks to run, by name or prefix, e.g. 'augmentation.' UnetL5 (default: all).")
+    run_parser.add_argument('--num_threads', type=int, default=None, help='Intra-op threads, torch default if unset.')
+    run_parser.add_argument('--device', type=str, default='cpu', help="Device of the torch benchmarks.")
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two result files.')
+    compare_parser.add_argument('base', type=str, help='Results of the reference run.')
+    compare_parser.add_argument('new', type=str, help='Results of the run to check.')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='Relative change flagged, 0.1 is 10%%.')
+    compare_parser.add_argument('--stat', type=str, default='median', choices=['median', 'min', 'mean'],
+                                help='Statistic of the timings that is compared.')
+    args = parser.parse_args()
+    if args.command != 'compare' and min(args.size) < max(CROP_SIZE):
+        parser.error('--size must be at least the crop size {}.'.format(CROP_SIZE))
+
+    if args.command == 'fixtures':
+        params = write_fixtures(args.out, args.subjects, args.size, args.channels, args.seed)
+        print('Saved {subjects} subjects of {channels} channels to'.format(**params), args.out)
+    elif args.command == 'run':
+        run_suite(args)
+    else:
+        sys.exit(compare(args))
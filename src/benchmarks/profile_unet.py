@@ -0,0 +1,107 @@
+"""
+Side-by-side per-block profile of UnetL3, UnetL4 and UnetL5 (utils/profiling.py) for one input shape and the given
+num_filters: wall time per block (forward, and backward with --backward), activation size, parameters, analytical
+FLOPs and peak memory, followed by a summary of the totals per architecture.
+
+Each configuration runs in its own process, so that the memory and allocator caches of one do not carry over to the
+next.
+
+Run from src/benchmarks:
+    python profile_unet.py --models L3 L4 L5 --num_filters 4 8 --num_in 68 --size 96 96 96 --backward --json unet.json
+"""
+
+
+import sys
+import json
+import argparse
+import multiprocessing
+from queue import Empty
+import torch
+import torch.nn as nn
+
+sys.path.append('../../src')
+from models.unet3d import UnetL3, UnetL4, UnetL5
+from utils.profiling import profile_model, format_table
+
+MODELS = {'L3': UnetL3, 'L4': UnetL4, 'L5': UnetL5}
+
+
+def run_config(name, num_filters, args, queue):
+    # errors are sent back as a message, e.g. BatchNorm in training mode on a 1-voxel bridge for too small inputs
+    try:
+        if args.num_threads is not None:
+            torch.set_num_threads(args.num_threads)
+        torch.manual_seed(0)
+        model = MODELS[name](in_dim=args.num_in, out_dim=args.out_dim, num_filters=num_filters,
+                             output_activation=nn.Softmax(dim=1))
+        report = profile_model(model, [args.batch_size, args.num_in, *args.size], torch.device(args.device),
+                               backward=args.backward, repeats=args.repeats)
+        report['num_filters'] = num_filters
+        queue.put(report)
+    except Exception as error:
+        queue.put('{}: {}'.format(type(error).__name__, error))
+
+
+def wait_result(process, queue, poll_seconds=5):
+    """ The report of a configuration, or an error message if it failed or its process died without a result. """
+    while True:
+        try:
+            return queue.get(timeout=poll_seconds)
+        except Empty:
+            if not process.is_alive():
+                try:
+                    # a result put right before the exit may still be in flight
+                    return queue.get(timeout=1)
+                except Empty:
+                    return 'process exited with code {} without a result'.format(process.exitcode)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Per-block profile of the UNet architectures.")
+    parser.add_argument('--models', type=str, nargs='+', default=['L3', 'L4', 'L5'], choices=list(MODELS),
+                        help='Architectures to compare.')
+    parser.add_argument('--num_filters', type=int, nargs='+', default=[4], help='Filters of the first level.')
+    parser.add_argument('--num_in', type=int, default=68, help='Number of input channels.')
+    parser.add_argument('--out_dim', type=int, default=13, help='Number of output channels.')
+    parser.add_argument('--size', type=int, nargs=3, default=[96, 96, 96], help='Spatial size of the input.')
+    parser.add_argument('--batch_size', type=int, default=1, help='Batch size of the input.')
+    parser.add_argument('--backward', action='store_true', help='Profile training steps (forward and backward).')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed passes after one warm-up pass.')
+    parser.add_argument('--num_threads', type=int, default=None, help='Intra-op threads, torch default if unset.')
+    parser.add_argument('--device', type=str, default='cpu', help="Device to run on, e.g. 'cpu' or 'cuda'.")
+    parser.add_argument('--json', type=str, default=None, help='File to save all reports to.')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    reports, failures = [], []
+    for num_filters in args.num_filters:
+        for name in args.models:
+            queue = context.Queue()
+            process = context.Process(target=run_config, args=(name, num_filters, args, queue))
+            process.start()
+            result = wait_result(process, queue)
+            process.join()
+            if isinstance(result, str):
+                failures.append('{} with num_filters {}: {}'.format(MODELS[name].__name__, num_filters, result))
+                print('failed:', failures[-1])
+            else:
+                reports.append(result)
+                print(format_table(result))
+            print()
+
+    print('{:8s} {:>7s} {:>10s} {:>9s} {:>11s} {:>11s} {:>9s} {:>12s}'.format(
+        'model', 'filters', 'params', 'GFLOPs', 'fwd ms', 'bwd ms', 'peak MB', 'act. MB'))
+    for report in reports:
+        total = report['total']
+        print('{:8s} {:>7d} {:>10d} {:>9.2f} {:>11.1f} {:>11s} {:>9s} {:>12.1f}'.format(
+            report['model'], report['num_filters'], total['params'], total['gflops'], total['forward_ms'],
+            '-' if total['backward_ms'] is None else '{:.1f}'.format(total['backward_ms']),
+            '-' if total['peak_mb'] is None else '{:.1f}'.format(total['peak_mb']), total['output_mb']))
+
+    for failure in failures:
+        print('failed:', failure)
+
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(reports, f, indent=2)
@@ -0,0 +1,161 @@
+"""
+Per-channel chunked store of the 4D input volumes.
+
+Even with lazy slicing, a .nii.gz has to be decompressed up to the last channel that is read, so training on a channel
+subset (e.g. MPRAGE and FGATIR only) costs as much I/O as training on all 68 channels. The chunk store keeps every
+channel of a subject as its own uncompressed, full field-of-view .npy file. Datasets memory-map only the requested
+channels and slice the crop out of them, so the bytes read scale with the channels and the region actually used.
+
+Layout:
+    chunk_dir/
+        <name>/meta.json     sidecar: shape, number of channels, dtype, affine and source (path, mtime, size)
+        <name>/c000.npy      channel 0, [H, W, L]
+        <name>/c001.npy      ...
+where <name> is the nifti filename without extension. An entry is rebuilt as soon as its source file changes.
+
+Usage (one-time conversion, run from src/dataloaders):
+    python chunk_store.py --data_dir /path/to/data --chunk_dir /path/to/chunks
+"""
+
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+import nibabel as nib
+from nibabel.openers import ImageOpener
+
+sys.path.append('../../src')
+from dataloaders.volume_cache import DATA_DTYPES, crop_slices, strip_nifti_ext, source_stat
+
+STORE_VERSION = 1
+
+
+def iter_channels(data_path):
+    """
+    Yield the channels of a 4D nifti one by one as float32 [H, W, L] arrays. The file is decompressed in a single
+    sequential pass and only one channel is held in memory.
+    """
+    img = nib.load(data_path)
+    proxy = img.dataobj
+    shape = img.shape[:3]
+    num_channels = int(np.prod(img.shape[3:]))
+    channel_bytes = int(np.prod(shape)) * proxy.dtype.itemsize
+
+    with ImageOpener(data_path) as f:
+        f.seek(proxy.offset)
+        for _ in range(num_channels):
+            raw = np.frombuffer(f.read(channel_bytes), dtype=proxy.dtype).reshape(shape, order='F')
+            channel = raw.astype(np.float32)
+            if proxy.slope != 1.0 or proxy.inter != 0.0:
+                channel = channel * np.float32(proxy.slope) + np.float32(proxy.inter)
+            yield channel
+
+
+class ChunkStore:
+    """
+    Full field-of-view volumes stored as one uncompressed .npy file per channel.
+
+    chunk_dir (str): Root folder of the store.
+    dtype (str): Storage dtype of the channels, 'float32' or 'float16'.
+    """
+
+    def __init__(self, chunk_dir, dtype='float32'):
+        if dtype not in DATA_DTYPES:
+            raise ValueError(f"dtype must be one of {DATA_DTYPES}, got {dtype}.")
+        self.chunk_dir = chunk_dir
+        self.dtype = dtype
+
+    def entry_dir(self, name):
+        return os.path.join(self.chunk_dir, strip_nifti_ext(name))
+
+    def channel_path(self, name, channel):
+        return os.path.join(self.entry_dir(name), 'c{:03d}.npy'.format(channel))
+
+    def read_meta(self, name):
+        meta_path = os.path.join(self.entry_dir(name), 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        try:
+            with open(meta_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_fresh(self, source_path):
+        """ Check whether the entry of `source_path` exists, matches the store dtype and its source is unchanged. """
+        meta = self.read_meta(os.path.basename(source_path))
+        if meta is None or meta.get('version') != STORE_VERSION or meta['dtype'] != self.dtype:
+            return False
+        return os.path.exists(source_path) and source_stat(source_path) == meta['source']
+
+    def convert(self, source_path):
+        """
+        Split a 4D nifti into per-channel files. Every file is written to a temporary name and moved into place, and the
+        sidecar is written last, so that readers never observe a partially written entry.
+        """
+        name = os.path.basename(source_path)
+        entry_dir = self.entry_dir(name)
+        os.makedirs(entry_dir, exist_ok=True)
+        suffix = '.tmp{}'.format(os.getpid())
+
+        num_channels = 0
+        for channel, array in enumerate(iter_channels(source_path)):
+            channel_path = self.channel_path(name, channel)
+            np.save(channel_path + suffix, np.ascontiguousarray(array, dtype=self.dtype))
+            os.replace(channel_path + suffix + '.npy', channel_path)
+            num_channels += 1
+
+        img = nib.load(source_path)
+        meta = {'version': STORE_VERSION,
+                'name': name,
+                'shape': list(img.shape[:3]),
+                'num_channels': num_channels,
+                'dtype': self.dtype,
+                'affine': img.affine.tolist(),
+                'source': source_stat(source_path)}
+        meta_path = os.path.join(entry_dir, 'meta.json')
+        with open(meta_path + suffix, 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(meta_path + suffix, meta_path)
+
+    def read(self, source_path, channels=None, crop_size=(96, 96, 96)):
+        """
+        Read the center crop of the requested channels of `source_path` as a float32 [C, H, W, L] array, converting the
+        source first if its entry is missing or stale.
+
+        channels (list): Channel indices to read, all channels if None.
+        crop_size (tuple): Size of the center crop, None for the full volume.
+        """
+        if not self.is_fresh(source_path):
+            self.convert(source_path)
+        name = os.path.basename(source_path)
+        meta = self.read_meta(name)
+        if channels is None:
+            channels = range(meta['num_channels'])
+        crop = crop_slices(meta['shape'], crop_size)
+        return np.stack([np.load(self.channel_path(name, channel), mmap_mode='r')[crop] for channel in channels],
+                        axis=0).astype(np.float32)
+
+
+def build_store(store, data_dir):
+    """ Convert every nifti in `data_dir`, skipping those whose entry is up to date. """
+    for fn in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, fn)
+        if store.is_fresh(path):
+            print(f"Up to date: {fn}")
+            continue
+        print(f"Converting: {fn}")
+        store.convert(path)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Convert 4D nifti volumes into the per-channel chunk store.")
+    parser.add_argument('--data_dir', type=str, required=True, help='Root folder for the data.')
+    parser.add_argument('--chunk_dir', type=str, required=True, help='Folder to store the channels.')
+    parser.add_argument('--dtype', type=str, default='float32', choices=DATA_DTYPES, help='Storage dtype.')
+    args = parser.parse_args()
+
+    build_store(ChunkStore(args.chunk_dir, dtype=args.dtype), args.data_dir)
@@ -7,8 +7,12 @@ from torch.utils.data import Dataset, DataLoader
 
 sys.path.append('../../src')
 from utils.augmentation import center_crop
+from dataloaders.volume_cache import VolumeCache
+from dataloaders.chunk_store import ChunkStore
+from dataloaders.feature_assembly import FEATURE_GROUP
+from utils.device import get_device
 
-device = torch.device("cuda")
+device = get_device()
 
 # Generate from ../utils/split_dataset_to_8_folds.ipynb
 config_split = {
@@ -38,14 +42,24 @@ def load_label(label_path):
 
 class ThalamusDataset(Dataset):
 
-    def __init__(self, data_dir, label_1_dir, label_2_dir, split, division):
+    def __init__(self, data_dir, label_1_dir, label_2_dir, split, division, cache_dir=None, cache_dtype='float32',
+                 crop_size=(96, 96, 96), chunk_dir=None, channels=None):
         super(ThalamusDataset, self).__init__()
         self.data_dir = data_dir
         self.label_1_dir = label_1_dir
         self.label_2_dir = label_2_dir
         self.split = split
         self.division = division
-        self.data_file_list = sorted(list(os.listdir(self.data_dir)))
+        self.crop_size = crop_size  # None returns the full volumes, e.g. for sliding-window inference
+        self.cache = VolumeCache(cache_dir, crop_size=crop_size, dtype=cache_dtype) if cache_dir else None
+        # the data is read from the per-channel chunk store instead, if given
+        self.chunks = ChunkStore(chunk_dir, dtype=cache_dtype) if chunk_dir else None
+        self.channels = list(channels) if channels is not None else None  # None keeps all channels
+        if data_dir is None:
+            # inputs assembled into the cache (see dataloaders/feature_assembly.py)
+            self.data_file_list = self.cache.names(FEATURE_GROUP)
+        else:
+            self.data_file_list = sorted(list(os.listdir(self.data_dir)))
         self.label_1_file_list = sorted(list(os.listdir(self.label_1_dir)))
         self.label_2_file_list = sorted(list(os.listdir(self.label_2_dir)))
 
@@ -59,17 +73,35 @@ class ThalamusDataset(Dataset):
         label_2_fn = [self.label_2_file_list[index] for index in config_split[self.split][self.division + "_idxs"]][idx]
 
         assert data_fn.split('_')[0] == label_1_fn.split('_')[0]
-        data_path = os.path.join(self.data_dir, data_fn)
+        data_path = os.path.join(self.data_dir, data_fn) if self.data_dir is not None else None
         label_1_path = os.path.join(self.label_1_dir, label_1_fn)
         label_2_path = os.path.join(self.label_2_dir, label_2_fn)
 
-        data_np = load_data(data_path)
-        label_1_np = load_label(label_1_path)
-        label_2_np = load_label(label_2_path)
-
-        data_np = center_crop(data_np, output_size=(96, 96, 96))
-        label_1_np = center_crop(label_1_np, output_size=(96, 96, 96))
-        label_2_np = center_crop(label_2_np, output_size=(96, 96, 96))
+        if data_path is None:
+            data_np = self.cache.load_entry(FEATURE_GROUP, data_fn)
+        elif self.chunks is not None:
+            # only the requested channels and the crop region are read from disk
+            data_np = self.chunks.read(data_path, self.channels, crop_size=self.crop_size)
+        elif self.cache is not None:
+            # cropped volumes, memory-mapped from the cache
+            data_np = self.cache.load(data_path)
+        else:
+            data_np = load_data(data_path)
+            if self.crop_size is not None:
+                data_np = center_crop(data_np, output_size=self.crop_size)
+        if self.channels is not None and self.chunks is None:
+            data_np = data_np[self.channels]
+
+        if self.cache is not None:
+            label_1_np = self.cache.load(label_1_path, is_label=True)
+            label_2_np = self.cache.load(label_2_path, is_label=True)
+        else:
+            label_1_np = load_label(label_1_path)
+            label_2_np = load_label(label_2_path)
+
+            if self.crop_size is not None:
+                label_1_np = center_crop(label_1_np, output_size=self.crop_size)
+                label_2_np = center_crop(label_2_np, output_size=self.crop_size)
 
         data_tensor = torch.tensor(data_np, dtype=torch.float32)
         label_1_tensor = torch.tensor(label_1_np, dtype=torch.int32)
@@ -78,7 +110,14 @@ class ThalamusDataset(Dataset):
         return data_tensor, label_1_tensor, label_2_tensor, data_fn, label_1_fn, label_2_fn
 
 
-def ThalamusDataloader(data_dir, label_1_dir, label_2_dir, batch_size, split, division, shuffle=False, num_workers=8):
-    dataset = ThalamusDataset(data_dir=data_dir, label_1_dir=label_1_dir, label_2_dir=label_2_dir, split=split, division=division)
-    dataloader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers)
+def ThalamusDataloader(data_dir, label_1_dir, label_2_dir, batch_size, split, division, shuffle=False, num_workers=8,
+                       cache_dir=None, cache_dtype='float32', pin_memory=False, prefetch_factor=2,
+                       persistent_workers=False, crop_size=(96, 96, 96), chunk_dir=None, channels=None):
+    dataset = ThalamusDataset(data_dir=data_dir, label_1_dir=label_1_dir, label_2_dir=label_2_dir, split=split,
+                              division=division, cache_dir=cache_dir, cache_dtype=cache_dtype, crop_size=crop_size,
+                              chunk_dir=chunk_dir, channels=channels)
+    # prefetch_factor and persistent_workers are only valid with worker processes
+    worker_kwargs = dict(prefetch_factor=prefetch_factor, persistent_workers=persistent_workers) if num_workers > 0 else {}
+    dataloader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers,
+                            pin_memory=pin_memory, **worker_kwargs)
     return dataloader
@@ -3,12 +3,17 @@ import sys
 import torch
 import numpy as np
 import nibabel as nib
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
 
 sys.path.append('../../src')
 from utils.augmentation import center_crop
+from utils.spatial_augmentation import SpatialCompose
+from dataloaders.volume_cache import VolumeCache
+from dataloaders.chunk_store import ChunkStore
+from dataloaders.feature_assembly import FEATURE_GROUP
+from utils.device import get_device
 
-device = torch.device("cuda")
+device = get_device()
 
 # Generate from ../utils/split_dataset_to_8_folds.ipynb
 config_split = {
@@ -38,14 +43,26 @@ def load_label(label_path):
 
 class ThalamusDataset(Dataset):
 
-    def __init__(self, data_dir, label_dir, split, division):
+    def __init__(self, data_dir, label_dir, split, division, cache_dir=None, cache_dtype='float32', augment=False,
+                 augment_backend='torch', chunk_dir=None, channels=None):
         super(ThalamusDataset, self).__init__()
         self.label_dir = label_dir
         self.data_dir = data_dir
         self.split = split
         self.division = division
-        self.data_file_list = sorted(list(os.listdir(self.data_dir)))
+        self.cache = VolumeCache(cache_dir, crop_size=(96, 96, 96), dtype=cache_dtype) if cache_dir else None
+        # the data is read from the per-channel chunk store instead, if given
+        self.chunks = ChunkStore(chunk_dir, dtype=cache_dtype) if chunk_dir else None
+        self.channels = list(channels) if channels is not None else None  # None keeps all channels
+        if data_dir is None:
+            # inputs assembled into the cache (see dataloaders/feature_assembly.py)
+            self.data_file_list = self.cache.names(FEATURE_GROUP)
+        else:
+            self.data_file_list = sorted(list(os.listdir(self.data_dir)))
         self.label_file_list = sorted(list(os.listdir(self.label_dir)))
+        # reseeded per worker by seed_worker, so that the workers do not repeat each other's augmentations
+        self.random_state = np.random.RandomState(np.random.randint(2 ** 31))
+        self.augmentation = SpatialCompose(self.random_state, backend=augment_backend) if augment else None
 
     def __len__(self):
         return len(config_split[self.split][self.division + "_idxs"])
@@ -56,14 +73,29 @@ class ThalamusDataset(Dataset):
         label_fn = [self.label_file_list[index] for index in config_split[self.split][self.division + "_idxs"]][idx]
 
         assert data_fn.split('_')[0] == label_fn.split('_')[0]
-        data_path = os.path.join(self.data_dir, data_fn)
+        data_path = os.path.join(self.data_dir, data_fn) if self.data_dir is not None else None
         label_path = os.path.join(self.label_dir, label_fn)
 
-        data_np = load_data(data_path)
-        label_np = load_label(label_path)
-
-        data_np = center_crop(data_np, output_size=(96, 96, 96))
-        label_np = center_crop(label_np, output_size=(96, 96, 96))
+        if data_path is None:
+            data_np = self.cache.load_entry(FEATURE_GROUP, data_fn)
+        elif self.chunks is not None:
+            # only the requested channels and the crop region are read from disk
+            data_np = self.chunks.read(data_path, self.channels, crop_size=(96, 96, 96))
+        elif self.cache is not None:
+            # cropped volumes, memory-mapped from the cache
+            data_np = self.cache.load(data_path)
+        else:
+            data_np = center_crop(load_data(data_path), output_size=(96, 96, 96))
+        if self.channels is not None and self.chunks is None:
+            data_np = data_np[self.channels]
+
+        if self.cache is not None:
+            label_np = self.cache.load(label_path, is_label=True)
+        else:
+            label_np = center_crop(load_label(label_path), output_size=(96, 96, 96))
+
+        if self.augmentation is not None:
+            data_np, label_np, _ = self.augmentation(np.asarray(data_np, dtype=np.float32), np.asarray(label_np))
 
         data_tensor = torch.tensor(data_np, dtype=torch.float32)
         label_tensor = torch.tensor(label_np, dtype=torch.int32)
@@ -71,7 +103,23 @@ class ThalamusDataset(Dataset):
         return data_tensor, label_tensor
 
 
-def ThalamusDataloader(data_dir, label_dir, batch_size, split, division, shuffle=False, num_workers=8):
-    dataset = ThalamusDataset(data_dir=data_dir, label_dir=label_dir, split=split, division=division)
-    dataloader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers)
+def seed_worker(worker_id):
+    worker_info = torch.utils.data.get_worker_info()
+    worker_info.dataset.random_state.seed(worker_info.seed % 2 ** 32)
+
+
+def ThalamusDataloader(data_dir, label_dir, batch_size, split, division, shuffle=False, num_workers=8,
+                       cache_dir=None, cache_dtype='float32', pin_memory=False, prefetch_factor=2,
+                       persistent_workers=False, augment=False, augment_backend='torch', chunk_dir=None,
+                       channels=None, distributed=False):
+    dataset = ThalamusDataset(data_dir=data_dir, label_dir=label_dir, split=split, division=division,
+                              cache_dir=cache_dir, cache_dtype=cache_dtype, augment=augment,
+                              augment_backend=augment_backend, chunk_dir=chunk_dir, channels=channels)
+    # prefetch_factor and persistent_workers are only valid with worker processes
+    worker_kwargs = dict(prefetch_factor=prefetch_factor, persistent_workers=persistent_workers,
+                         worker_init_fn=seed_worker) if num_workers > 0 else {}
+    # in distributed training every rank reads its own shard, reshuffled by sampler.set_epoch at every epoch
+    sampler = DistributedSampler(dataset, shuffle=shuffle) if distributed else None
+    dataloader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle and sampler is None,
+                            sampler=sampler, num_workers=num_workers, pin_memory=pin_memory, **worker_kwargs)
     return dataloader
@@ -0,0 +1,113 @@
+"""
+Assembly of the 68-channel model input from the per-modality images.
+
+The channels are stacked in the order the models were trained with:
+    0       MPRAGE
+    1       FGATIR
+    2       T1 map
+    3       PD map
+    4-54    multi-TI images (51, TI from 400 to 1400 ms in steps of 20 ms)
+    55-67   diffusion features (13): AD, FA, RD, Trace, WL, WP, WS, Knutsson 5D vector (5), Knutsson edge map
+            (see dmri_processing_pipeline/)
+
+Instead of writing a combined 4D .nii.gz, every source image is decompressed once, channel by channel, and its center
+crop is written straight into a VolumeCache entry (group FEATURE_GROUP). The sidecar lists all source images, so the
+entry goes stale as soon as any of them changes. Datasets read the entries by name when no data_dir is given.
+
+The manifest is a JSON list with one object per subject. Each modality is a path or a list of paths whose channels are
+concatenated, e.g. the diffusion features as separate maps:
+    [{"name": "MTBI-0001_v1",
+      "mprage": ".../MPRAGE.nii.gz", "fgatir": ".../FGATIR.nii.gz", "t1map": ".../t1map.nii.gz",
+      "pdmap": ".../pdmap.nii.gz", "multiTI": ".../multiTIs.nii.gz",
+      "diffusion": [".../AD.nii", ".../FA.nii", ".../RD.nii", ".../TR.nii", ".../WL.nii", ".../WP.nii", ".../WS.nii",
+                    ".../..._knutsson_5D.nii", ".../..._knutsson_edgemap.nii"]}]
+
+Usage (run from src/dataloaders):
+    python feature_assembly.py --manifest subjects.json --cache_dir /path/to/cache
+"""
+
+
+import sys
+import json
+import argparse
+import numpy as np
+import nibabel as nib
+
+sys.path.append('../../src')
+from dataloaders.volume_cache import VolumeCache, DATA_DTYPES, crop_slices
+from dataloaders.chunk_store import iter_channels
+
+# Cache group of the assembled inputs
+FEATURE_GROUP = 'features'
+
+# Modalities in channel order, with their number of channels
+MODALITIES = [('mprage', 1), ('fgatir', 1), ('t1map', 1), ('pdmap', 1), ('multiTI', 51), ('diffusion', 13)]
+NUM_CHANNELS = sum(num_channels for _, num_channels in MODALITIES)
+
+
+def source_paths(subject):
+    """ The source images of a manifest entry in channel order, checking the channel count of every modality. """
+    paths = []
+    for modality, num_channels in MODALITIES:
+        if modality not in subject:
+            raise ValueError(f"{subject.get('name')}: missing modality '{modality}'.")
+        modality_paths = subject[modality] if isinstance(subject[modality], list) else [subject[modality]]
+        found = sum(int(np.prod(nib.load(path).shape[3:])) for path in modality_paths)
+        if found != num_channels:
+            raise ValueError(f"{subject.get('name')}: '{modality}' has {found} channels, expected {num_channels}.")
+        paths.extend(modality_paths)
+    return paths
+
+
+def check_geometry(paths):
+    """ All sources must be on the same voxel grid. """
+    reference = nib.load(paths[0])
+    for path in paths[1:]:
+        img = nib.load(path)
+        if img.shape[:3] != reference.shape[:3] or not np.allclose(img.affine, reference.affine, atol=1e-4):
+            raise ValueError(f"{path} is not on the voxel grid of {paths[0]}.")
+    return reference.shape[:3]
+
+
+def assemble_subject(cache, subject):
+    """
+    Write the [68, H, W, L] center crop of one subject into the cache. Only one full-size channel of one source is in
+    memory at a time.
+    """
+    paths = source_paths(subject)
+    shape = check_geometry(paths)
+    crop = crop_slices(shape, cache.crop_size)
+    crop_shape = [len(range(*s.indices(size))) for s, size in zip(crop, shape)]
+
+    with cache.writer(FEATURE_GROUP, subject['name'], [NUM_CHANNELS] + crop_shape, cache.dtype, paths) as array:
+        channel = 0
+        for path in paths:
+            for volume in iter_channels(path):
+                array[channel] = volume[crop]
+                channel += 1
+
+
+def assemble_features(cache, subjects):
+    """ Assemble every subject of the manifest, skipping entries whose sources are unchanged. """
+    for subject in subjects:
+        if cache.is_fresh(FEATURE_GROUP, subject['name'], is_label=False):
+            print(f"Up to date: {subject['name']}")
+            continue
+        print(f"Assembling: {subject['name']}")
+        assemble_subject(cache, subject)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Assemble the 68-channel model inputs into the volume cache.")
+    parser.add_argument('--manifest', type=str, required=True, help='JSON list of subjects and their source images.')
+    parser.add_argument('--cache_dir', type=str, required=True, help='Folder of the volume cache.')
+    parser.add_argument('--crop_size', type=int, nargs=3, default=[96, 96, 96], help='Size of the center crop.')
+    parser.add_argument('--full_volume', action='store_true', help='Store the full volumes instead of the crop.')
+    parser.add_argument('--dtype', type=str, default='float32', choices=DATA_DTYPES, help='Storage dtype of the data.')
+    args = parser.parse_args()
+
+    with open(args.manifest) as f:
+        subjects = json.load(f)
+    crop_size = None if args.full_volume else args.crop_size
+    assemble_features(VolumeCache(args.cache_dir, crop_size=crop_size, dtype=args.dtype), subjects)
@@ -0,0 +1,246 @@
+"""
+On-disk cache of center-cropped volumes for ThalamusDataset.
+
+Decoding a 68-channel .nii.gz and cropping it to 96^3 on every __getitem__ is far more expensive than the training step
+itself. The cache stores each cropped volume once as an uncompressed, channel-first .npy file next to a small .json
+sidecar describing its source files (path, mtime and size). Datasets read the .npy files memory-mapped, and an entry is
+rebuilt automatically as soon as one of its source files changes.
+
+Layout:
+    cache_dir/
+        <group>/<crop>/<name>.npy     cropped array, [C, H, W, L] (data) or [H, W, L] (labels)
+        <group>/<crop>/<name>.json    sidecar: sources, crop size, dtype
+where <group> is derived from the source folder (see group_name), <crop> is the crop size (e.g. 96x96x96, or 'full')
+and <name> is the nifti filename without extension.
+
+Usage (one-time build, run from src/dataloaders):
+    python volume_cache.py --data_dir /path/to/data --label_dir /path/to/labels [/path/to/more/labels] \
+                           --cache_dir /path/to/cache
+"""
+
+
+import os
+import json
+import hashlib
+import argparse
+from contextlib import contextmanager
+import numpy as np
+import nibabel as nib
+
+CACHE_VERSION = 1
+DATA_DTYPES = ('float32', 'float16')
+
+
+def crop_slices(shape, output_size):
+    """ Slices of the center crop, computed exactly as in utils.augmentation.center_crop. None keeps the full volume. """
+    if output_size is None:
+        return (slice(None),) * 3
+    center = [i // 2 for i in shape[:3]]
+    start = [center[i] - output_size[i] // 2 for i in range(3)]
+    return tuple(slice(start[i], start[i] + output_size[i]) for i in range(3))
+
+
+def strip_nifti_ext(fn):
+    for ext in ('.nii.gz', '.nii'):
+        if fn.endswith(ext):
+            return fn[:-len(ext)]
+    return fn
+
+
+def source_stat(path):
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'mtime': stat.st_mtime, 'size': stat.st_size}
+
+
+# Read the center crop of a 4D nifti without materializing the full volume in float64
+def read_cropped_data(data_path, output_size, dtype=np.float32):
+    img = nib.load(data_path)
+    crop = crop_slices(img.shape, output_size)
+    data = np.asarray(img.dataobj[crop + (slice(None),)], dtype=np.float32)
+    data = data.transpose((3, 0, 1, 2))  # transpose h*w*l*c to c*h*w*l
+    return np.ascontiguousarray(data, dtype=dtype)
+
+
+# Read the center crop of a 3D nifti label map
+def read_cropped_label(label_path, output_size):
+    img = nib.load(label_path)
+    crop = crop_slices(img.shape, output_size)
+    label = np.asarray(img.dataobj[crop], dtype=np.float64).astype(np.int32)
+    return label.astype(np.int8)
+
+
+def group_name(src_dir):
+    """ Cache sub-folder of a source folder, e.g. 'labels-3f2a9c1e'. The hash keeps folders with equal names apart. """
+    src_dir = os.path.abspath(src_dir)
+    digest = hashlib.sha1(src_dir.encode()).hexdigest()[:8]
+    return '{}-{}'.format(os.path.basename(src_dir.rstrip(os.sep)), digest)
+
+
+class VolumeCache:
+    """
+    Cropped, channel-first volumes stored as uncompressed .npy files.
+
+    cache_dir (str): Root folder of the cache.
+    crop_size (tuple): Size of the center crop stored in the cache, None to store the full volumes.
+    dtype (str): Storage dtype of the data volumes, 'float32' or 'float16'. Labels are always stored as int8.
+    """
+
+    def __init__(self, cache_dir, crop_size=(96, 96, 96), dtype='float32'):
+        if dtype not in DATA_DTYPES:
+            raise ValueError(f"dtype must be one of {DATA_DTYPES}, got {dtype}.")
+        self.cache_dir = cache_dir
+        self.crop_size = tuple(int(i) for i in crop_size) if crop_size is not None else None
+        self.dtype = dtype
+
+    def group_dir(self, group):
+        crop_tag = 'x'.join(str(i) for i in self.crop_size) if self.crop_size is not None else 'full'
+        return os.path.join(self.cache_dir, group, crop_tag)
+
+    def entry_paths(self, group, name):
+        stem = os.path.join(self.group_dir(group), strip_nifti_ext(name))
+        return stem + '.npy', stem + '.json'
+
+    def names(self, group):
+        """ Sorted names of the entries stored in a group, as they were registered (usually the nifti filenames). """
+        group_dir = self.group_dir(group)
+        if not os.path.isdir(group_dir):
+            return []
+        names = []
+        for fn in os.listdir(group_dir):
+            if fn.endswith('.json'):
+                with open(os.path.join(group_dir, fn)) as f:
+                    names.append(json.load(f)['name'])
+        return sorted(names)
+
+    def read_meta(self, group, name):
+        array_path, meta_path = self.entry_paths(group, name)
+        if not (os.path.exists(array_path) and os.path.exists(meta_path)):
+            return None
+        try:
+            with open(meta_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def is_fresh(self, group, name, is_label):
+        """ Check whether an entry exists, matches the cache settings and all its sources are unchanged. """
+        meta = self.read_meta(group, name)
+        if meta is None or meta.get('version') != CACHE_VERSION:
+            return False
+        if (tuple(meta['crop_size']) if meta['crop_size'] is not None else None) != self.crop_size:
+            return False
+        if meta['dtype'] != ('int8' if is_label else self.dtype):
+            return False
+        for source in meta['sources']:
+            if not os.path.exists(source['path']):
+                return False
+            if source_stat(source['path']) != source:
+                return False
+        return True
+
+    def write(self, group, name, array, sources):
+        """
+        Store an array and its sidecar. Both files are written to a temporary name first and moved into place, so that
+        concurrent DataLoader workers never observe a partially written entry.
+        """
+        array_path, meta_path = self.entry_paths(group, name)
+        os.makedirs(os.path.dirname(array_path), exist_ok=True)
+        suffix = '.tmp{}'.format(os.getpid())
+
+        np.save(array_path + suffix, array)
+        os.replace(array_path + suffix + '.npy', array_path)
+        self.write_meta(group, name, array.shape, array.dtype, sources)
+
+    @contextmanager
+    def writer(self, group, name, shape, dtype, sources):
+        """
+        Yield a writable memmap of a new entry, to be filled piece by piece instead of being held in memory. The entry is
+        moved into place, and its sidecar written, only once the block exits without error.
+        """
+        array_path, _ = self.entry_paths(group, name)
+        os.makedirs(os.path.dirname(array_path), exist_ok=True)
+        tmp_path = array_path + '.tmp{}.npy'.format(os.getpid())
+
+        array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=tuple(shape))
+        try:
+            yield array
+            array.flush()
+        except BaseException:
+            del array
+            os.remove(tmp_path)
+            raise
+        del array
+        os.replace(tmp_path, array_path)
+        self.write_meta(group, name, shape, dtype, sources)
+
+    def write_meta(self, group, name, shape, dtype, sources):
+        _, meta_path = self.entry_paths(group, name)
+        suffix = '.tmp{}'.format(os.getpid())
+        meta = {'version': CACHE_VERSION,
+                'name': name,
+                'crop_size': list(self.crop_size) if self.crop_size is not None else None,
+                'dtype': str(np.dtype(dtype)),
+                'shape': list(shape),
+                'sources': [source_stat(path) for path in sources]}
+        with open(meta_path + suffix, 'w') as f:
+            json.dump(meta, f, indent=2)
+        os.replace(meta_path + suffix, meta_path)
+
+    def build(self, source_path, is_label):
+        group, name = group_name(os.path.dirname(source_path)), os.path.basename(source_path)
+        if is_label:
+            array = read_cropped_label(source_path, self.crop_size)
+        else:
+            array = read_cropped_data(source_path, self.crop_size, dtype=self.dtype)
+        self.write(group, name, array, [source_path])
+        return array
+
+    def load(self, source_path, is_label=False):
+        """ Return the cached crop of `source_path` as a read-only memmap, (re)building the entry if it is stale. """
+        group, name = group_name(os.path.dirname(source_path)), os.path.basename(source_path)
+        if not self.is_fresh(group, name, is_label):
+            self.build(source_path, is_label)
+        array_path, _ = self.entry_paths(group, name)
+        return np.load(array_path, mmap_mode='r')
+
+    def load_entry(self, group, name, is_label=False):
+        """
+        Return a stored entry as a read-only memmap. Unlike load, the entry is not tied to a single source nifti and
+        cannot be rebuilt here (e.g. the assembled features of dataloaders/feature_assembly.py).
+        """
+        if not self.is_fresh(group, name, is_label):
+            raise FileNotFoundError(f"Cache entry {group}/{name} in {self.cache_dir} is missing or stale, "
+                                    f"rebuild it first (see dataloaders/feature_assembly.py).")
+        array_path, _ = self.entry_paths(group, name)
+        return np.load(array_path, mmap_mode='r')
+
+
+def build_cache(cache, data_dir, label_dirs):
+    """
+    Build (or refresh) the cache for every nifti in `data_dir` and `label_dirs`.
+    Entries whose sources are unchanged are skipped.
+    """
+    jobs = [(data_dir, False)] + [(label_dir, True) for label_dir in label_dirs]
+    for src_dir, is_label in jobs:
+        group = group_name(src_dir)
+        for fn in sorted(os.listdir(src_dir)):
+            path = os.path.join(src_dir, fn)
+            if cache.is_fresh(group, fn, is_label):
+                print(f"Up to date: {group}/{fn}")
+                continue
+            print(f"Caching: {group}/{fn}")
+            cache.build(path, is_label)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Build the cropped volume cache used by ThalamusDataset.")
+    parser.add_argument('--data_dir', type=str, required=True, help='Root folder for the data.')
+    parser.add_argument('--label_dir', type=str, nargs='+', required=True,
+                        help='Root folder(s) for the labels.')
+    parser.add_argument('--cache_dir', type=str, required=True, help='Folder to store the cache.')
+    parser.add_argument('--crop_size', type=int, nargs=3, default=[96, 96, 96], help='Size of the center crop.')
+    parser.add_argument('--dtype', type=str, default='float32', choices=DATA_DTYPES, help='Storage dtype of the data.')
+    args = parser.parse_args()
+
+    build_cache(VolumeCache(args.cache_dir, crop_size=args.crop_size, dtype=args.dtype), args.data_dir, args.label_dir)
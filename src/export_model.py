@@ -0,0 +1,103 @@
+"""
+Export the ROI and NUCLEI models of cross-validation folds as frozen inference artifacts.
+
+The checkpoints are loaded into UnetL5, prepared by inference/optimize.py (eval mode, BatchNorm folded into the
+convolutions) and written as
+    out_dir/<fold>/ROI_model.pt          frozen TorchScript (--format torchscript or both)
+    out_dir/<fold>/ROI_model.onnx        ONNX, dynamic batch and spatial dimensions (--format onnx or both)
+    out_dir/<fold>/ROI_model.json        metadata: input channels, output channels, label offset, source checkpoint
+and the same for NUCLEI_model. The artifacts hold the weights only, not the loss histories of the checkpoints, and are
+run by inference/runtime.py without the model definitions or the training modules.
+ONNX export needs the onnx package.
+
+Usage (run from src):
+    python export_model.py --checkpoint_dir /path/to/model/checkpoints --out_dir /path/to/exported --folds 0 1
+"""
+
+
+import os
+import sys
+import json
+import argparse
+import torch
+import torch.nn as nn
+
+sys.path.append('../src')
+from models.unet3d import UnetL5
+from inference.optimize import optimize_for_inference
+
+# name, output channels, output activation, offset added to the argmax to get the label values
+MODELS = [('ROI_model', 2, nn.Sigmoid, 0), ('NUCLEI_model', 13, lambda: nn.Softmax(dim=1), 1)]
+EXPORT_FORMATS = ('torchscript', 'onnx', 'both')
+
+
+def load_checkpoint_model(checkpoint, in_dim, out_dim, output_activation, channels_last=False):
+    """ UnetL5 with the weights of `checkpoint`, BatchNorm folded, on the CPU. """
+    model = UnetL5(in_dim=in_dim, out_dim=out_dim, num_filters=4, output_activation=output_activation)
+    model.load_state_dict(torch.load(checkpoint, map_location='cpu')['state_dict'])
+    return optimize_for_inference(model, torch.device('cpu'), channels_last=channels_last)
+
+
+def export_torchscript(model, example, path):
+    # traced in the channels-last-3d format, in which the CPU convolutions are fastest (see inference/optimize.py)
+    with torch.inference_mode():
+        traced = torch.jit.trace(model, example.contiguous(memory_format=torch.channels_last_3d))
+    torch.jit.save(torch.jit.freeze(traced), path)
+
+
+def export_onnx(model, example, path, opset_version=17):
+    dynamic_axes = {'data': {0: 'batch', 2: 'height', 3: 'width', 4: 'length'},
+                    'prob': {0: 'batch', 2: 'height', 3: 'width', 4: 'length'}}
+    torch.onnx.export(model, (example,), path, input_names=['data'], output_names=['prob'],
+                      opset_version=opset_version, dynamic_axes=dynamic_axes, dynamo=False)
+
+
+def export_fold(checkpoint_dir, fold, out_dir, export_format='torchscript', num_in=68, size=(96, 96, 96)):
+    """ Export the ROI and NUCLEI models of `fold`; returns the paths written. """
+    fold_dir = os.path.join(out_dir, str(fold))
+    os.makedirs(fold_dir, exist_ok=True)
+    example = torch.rand(1, num_in, *size)
+    paths = []
+
+    for name, out_dim, output_activation, label_offset in MODELS:
+        checkpoint = os.path.join(checkpoint_dir, name, str(fold), 'best_checkpoint.pt')
+        prefix = os.path.join(fold_dir, name)
+
+        if export_format in ('torchscript', 'both'):
+            model = load_checkpoint_model(checkpoint, num_in, out_dim, output_activation(), channels_last=True)
+            export_torchscript(model, example, prefix + '.pt')
+            paths.append(prefix + '.pt')
+        if export_format in ('onnx', 'both'):
+            model = load_checkpoint_model(checkpoint, num_in, out_dim, output_activation())
+            export_onnx(model, example, prefix + '.onnx')
+            paths.append(prefix + '.onnx')
+
+        meta = {'name': name,
+                'fold': str(fold),
+                'in_dim': num_in,
+                'out_dim': out_dim,
+                'label_offset': label_offset,
+                'bn_folded': True,
+                'torchscript_channels_last': True,
+                'checkpoint': os.path.abspath(checkpoint)}
+        with open(prefix + '.json', 'w') as f:
+            json.dump(meta, f, indent=2)
+        paths.append(prefix + '.json')
+    return paths
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Export fold checkpoints to TorchScript and/or ONNX.")
+    parser.add_argument('--checkpoint_dir', type=str, required=True,
+                        help='Folder holding ROI_model/<fold>/ and NUCLEI_model/<fold>/best_checkpoint.pt.')
+    parser.add_argument('--out_dir', type=str, required=True, help='Folder to save the exported models.')
+    parser.add_argument('--folds', type=int, nargs='+', default=list(range(8)), help='Folds to export.')
+    parser.add_argument('--format', type=str, default='torchscript', choices=EXPORT_FORMATS, help='Artifact format.')
+    parser.add_argument('--num_in', type=int, default=68, help='Number of input channels.')
+    parser.add_argument('--size', type=int, nargs=3, default=[96, 96, 96], help='Spatial size of the example input.')
+    args = parser.parse_args()
+
+    for fold in args.folds:
+        for path in export_fold(args.checkpoint_dir, fold, args.out_dir, args.format, args.num_in, args.size):
+            print('Saved', path)
@@ -0,0 +1,67 @@
+import sys
+import math
+import torch
+import numpy as np
+
+sys.path.append('../../src')
+from utils.utils import generate_foreground_mask
+from inference.optimize import prepare_input
+
+
+def padded_bounding_box(mask, margin=8, multiple=32):
+    """
+    Bounding box of the foreground of `mask`, enlarged by `margin` voxels on every side and grown to a multiple of
+    `multiple` so that the sub-volume passes through all pooling levels of the network (32 for UnetL5).
+    The box is shifted, never cropped, to stay inside the volume. Returns None if the mask is empty.
+    """
+    if not mask.any():
+        return None
+
+    bbox = []
+    for axis, size in enumerate(mask.shape):
+        other_axes = tuple(i for i in range(mask.ndim) if i != axis)
+        nonzero = np.flatnonzero(mask.any(axis=other_axes))
+        lo, hi = int(nonzero[0]) - margin, int(nonzero[-1]) + 1 + margin
+        length = min(math.ceil((hi - lo) / multiple) * multiple, size)
+        lo -= (length - (hi - lo)) // 2
+        lo = min(max(lo, 0), size - length)
+        bbox.append(slice(lo, lo + length))
+    return tuple(bbox)
+
+
+def forward(model, data, device=None):
+    """ Default predictor: a single forward pass over the whole [C, H, W, L] volume, moved to `device` if given. """
+    data = data.unsqueeze(0) if device is None else data.unsqueeze(0).to(device)
+    return model(prepare_input(data, model))[0]
+
+
+def cascaded_inference(model_1, model_2, data, margin=8, multiple=32, threshold=50, predict=forward):
+    """
+    ROI-guided two-stage inference.
+
+    The ROI model (model_1) runs on the whole volume. Its label map is cleaned with generate_foreground_mask and the
+    padded bounding box of the remaining thalamus is the only region the NUCLEI model (model_2) runs on. The NUCLEI
+    labels are pasted back into a full-size map that is 0 outside the box, where the combined prediction is 0 anyway.
+
+    model_1 (nn.Module): ROI model, 2 output channels.
+    model_2 (nn.Module): NUCLEI model, 13 output channels.
+    data (torch.Tensor): Input volume with shape [C, H, W, L].
+    margin (int): Voxels added around the ROI bounding box.
+    multiple (int): The box size is rounded up to a multiple of this value.
+    threshold (int): Minimum connected component size kept by generate_foreground_mask.
+    predict (callable): predict(model, volume) -> output [out_dim, ...], e.g. a sliding_window_inference wrapper.
+
+    Returns the cleaned ROI labels [0, 1], the NUCLEI labels [0, 1, ..., 13] and the bounding box (None if no ROI).
+    """
+    with torch.inference_mode():
+        pred_1 = predict(model_1, data)
+        pred_1_arr = torch.argmax(pred_1, dim=0).type(torch.int32).cpu().numpy()   # Index [0, 1]
+        pred_1_arr = pred_1_arr * generate_foreground_mask(pred_1_arr, threshold=threshold)
+
+        pred_2_arr = np.zeros_like(pred_1_arr)
+        bbox = padded_bounding_box(pred_1_arr > 0, margin=margin, multiple=multiple)
+        if bbox is not None:
+            pred_2 = predict(model_2, data[(slice(None),) + bbox])
+            pred_2_arr[bbox] = torch.argmax(pred_2, dim=0).type(torch.int32).cpu().numpy() + 1   # Index [1, ..., 13]
+
+    return pred_1_arr, pred_2_arr, bbox
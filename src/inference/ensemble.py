@@ -0,0 +1,74 @@
+import os
+import sys
+import copy
+import torch
+import torch.nn as nn
+from torch.func import stack_module_state, functional_call, vmap
+
+sys.path.append('../../src')
+from models.unet3d import UnetL5
+from inference.optimize import optimize_for_inference
+
+
+class AveragedModels(nn.Module):
+    """
+    Averages the outputs (probabilities) of models sharing one architecture.
+
+    With vectorize=True the weights of all models are stacked and the models run as a single batched call through
+    torch.func.vmap, instead of one forward pass per model.
+    """
+
+    def __init__(self, models, vectorize=True):
+        super(AveragedModels, self).__init__()
+        self.vectorize = vectorize
+        self.num_models = len(models)
+        self.channels_last = getattr(models[0], 'channels_last', False)
+        if vectorize:
+            self.stacked_params, self.stacked_buffers = stack_module_state(list(models))
+            self.base = [copy.deepcopy(models[0]).to('meta')]  # in a list so that it is not registered as a submodule
+            self.models = nn.ModuleList()
+        else:
+            self.models = nn.ModuleList(models)
+
+    def _call_one(self, params, buffers, x):
+        return functional_call(self.base[0], (params, buffers), (x,))
+
+    def forward(self, x):
+        if self.vectorize:
+            return vmap(self._call_one, in_dims=(0, 0, None))(self.stacked_params, self.stacked_buffers, x).mean(dim=0)
+        out = self.models[0](x)
+        for model in self.models[1:]:
+            out = out + model(x)
+        return out / self.num_models
+
+
+def load_fold_model(checkpoint, in_dim, out_dim, output_activation, device, num_threads=None, channels_last=None):
+    model = UnetL5(in_dim=in_dim, out_dim=out_dim, num_filters=4, output_activation=output_activation)
+    model.load_state_dict(torch.load(checkpoint, map_location='cpu')['state_dict'])
+    return optimize_for_inference(model, device, num_threads=num_threads, channels_last=channels_last)
+
+
+class FoldEnsemble:
+    """
+    The ROI and NUCLEI models of several cross-validation folds, loaded once and kept resident.
+
+    checkpoint_dir (str): Folder holding ROI_model/<fold>/best_checkpoint.pt and NUCLEI_model/<fold>/best_checkpoint.pt.
+    folds (list): Folds to use, all 8 by default. Fewer folds trade accuracy for latency.
+    num_in (int): Number of input channels.
+    device (torch.device): Device the models run on.
+    num_threads (int): Intra-op threads for CPU inference.
+    vectorize (bool): Run the models of each stage as one batched call (see AveragedModels).
+    """
+
+    def __init__(self, checkpoint_dir, folds=range(8), num_in=68, device=torch.device('cpu'), num_threads=None,
+                 vectorize=True):
+        self.folds = [str(fold) for fold in folds]
+        # channels-last does not combine with the batched (vmap) execution
+        channels_last = False if vectorize else None
+        roi_models = [load_fold_model(os.path.join(checkpoint_dir, 'ROI_model', fold, 'best_checkpoint.pt'), num_in, 2,
+                                      nn.Sigmoid(), device, num_threads, channels_last) for fold in self.folds]
+        nuclei_models = [load_fold_model(os.path.join(checkpoint_dir, 'NUCLEI_model', fold, 'best_checkpoint.pt'),
+                                         num_in, 13, nn.Softmax(dim=1), device, num_threads, channels_last)
+                         for fold in self.folds]
+        self.model_1 = AveragedModels(roi_models, vectorize=vectorize)
+        self.model_2 = AveragedModels(nuclei_models, vectorize=vectorize)
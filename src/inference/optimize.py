@@ -0,0 +1,70 @@
+import torch
+import torch.nn as nn
+
+
+def fold_conv_bn(conv, bn):
+    """ Fold an eval-mode BatchNorm3d into the weights and bias of the preceding Conv3d / ConvTranspose3d. """
+    scale = bn.weight.detach() / torch.sqrt(bn.running_var + bn.eps)
+    bias = conv.bias.detach() if conv.bias is not None else torch.zeros_like(bn.running_mean)
+
+    # output channels are dim 0 of a Conv3d weight and dim 1 of a ConvTranspose3d weight
+    shape = [1] * conv.weight.dim()
+    shape[1 if isinstance(conv, nn.ConvTranspose3d) else 0] = -1
+
+    conv.weight = nn.Parameter(conv.weight.detach() * scale.view(shape))
+    conv.bias = nn.Parameter((bias - bn.running_mean) * scale + bn.bias.detach())
+    return conv
+
+
+def fold_batchnorm(model):
+    """
+    Fold every BatchNorm3d that directly follows a convolution inside an nn.Sequential (as built by the blocks in
+    models/unet3d.py) into that convolution, and replace the BatchNorm3d by nn.Identity.
+    Only valid for inference: the model must be in eval mode and is modified in place.
+    """
+    if model.training:
+        raise RuntimeError("BatchNorm folding requires the model to be in eval mode.")
+
+    for module in model.modules():
+        if not isinstance(module, nn.Sequential):
+            continue
+        for i in range(len(module) - 1):
+            conv, bn = module[i], module[i + 1]
+            if isinstance(conv, (nn.Conv3d, nn.ConvTranspose3d)) and isinstance(bn, nn.BatchNorm3d):
+                fold_conv_bn(conv, bn)
+                module[i + 1] = nn.Identity()
+    return model
+
+
+def optimize_for_inference(model, device, num_threads=None, channels_last=None, fold_bn=True):
+    """
+    Prepare a trained model for inference on `device`.
+
+    model (nn.Module): Model with its trained weights loaded.
+    device (torch.device): Device to run on.
+    num_threads (int): Intra-op thread count for CPU inference, torch's default if None.
+    channels_last (bool): Use the channels-last-3d memory format. Defaults to True on the CPU, where the oneDNN
+                          convolutions are considerably faster in this layout.
+    fold_bn (bool): Fold the BatchNorm3d layers into the preceding convolutions.
+    """
+    if num_threads is not None and device.type == 'cpu':
+        torch.set_num_threads(num_threads)
+    if channels_last is None:
+        channels_last = device.type == 'cpu'
+
+    model = model.to(device).eval()
+    for param in model.parameters():
+        param.requires_grad_(False)
+    if fold_bn:
+        fold_batchnorm(model)
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last_3d)
+    model.channels_last = channels_last
+    return model
+
+
+def prepare_input(data, model):
+    """ Convert a [B, C, H, W, L] batch to the memory format expected by a model from optimize_for_inference. """
+    if getattr(model, 'channels_last', False):
+        return data.contiguous(memory_format=torch.channels_last_3d)
+    return data
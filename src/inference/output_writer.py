@@ -0,0 +1,132 @@
+"""
+Writing and reading of the predicted label maps.
+
+The predictions only cover the 96^3 center crop of the input. Padding them back to the full field of view and storing
+them as int32 makes every output file large and slow to compress, while almost all of its voxels are 0. In 'cropped'
+mode the labels are written as uint8 at the size of the prediction, and the position of the crop is encoded in the
+affine: voxel (0, 0, 0) of the file is voxel `offset` of the reference image. The file is therefore correctly placed in
+world space by any viewer. The shape of the reference image is kept in the header description, so expand_label can
+rebuild the full-size volume on demand without the reference image.
+
+'full' mode writes the padded int32 volumes as before.
+
+Usage (expand a cropped output, run from src/inference):
+    python output_writer.py --cropped pred_cropped.nii.gz --out pred_full.nii.gz [--reference t1.nii.gz]
+"""
+
+
+import re
+import sys
+import gzip
+import argparse
+import numpy as np
+import nibabel as nib
+
+sys.path.append('../../src')
+from utils.utils import pad_to_original_size
+
+OUTPUT_MODES = ('full', 'cropped')
+DESCRIP_PREFIX = 'ratnus crop of '
+
+
+def reference_geometry(path):
+    """ Shape [H, W, L] and affine of a nifti, read from its header only. """
+    header = nib.load(path).header
+    return tuple(int(size) for size in header.get_data_shape()[:3]), header.get_best_affine()
+
+
+def crop_offset(crop_shape, original_shape):
+    """ Voxel offset of a prediction in the original volume, consistent with pad_to_original_size. """
+    return tuple((orig_dim - crop_dim) // 2 for crop_dim, orig_dim in zip(crop_shape, original_shape))
+
+
+def offset_affine(affine, offset):
+    """ Affine of a sub-volume starting at voxel `offset` of an image with `affine`. """
+    translation = np.eye(4)
+    translation[:3, 3] = offset
+    return affine @ translation
+
+
+def output_ext(compresslevel):
+    return '.nii' if compresslevel == 0 else '.nii.gz'
+
+
+def save_nifti(img, out_path, compresslevel=1):
+    """ Save an image, gzip-compressed at `compresslevel` if out_path ends with .gz. """
+    if not out_path.endswith('.gz'):
+        nib.save(img, out_path)
+        return
+    with gzip.open(out_path, 'wb', compresslevel=compresslevel) as f:
+        f.write(img.to_bytes())
+
+
+def save_label(pred, original_shape, affine, out_path, mode='cropped', compresslevel=1):
+    """
+    Save a predicted label map [H, W, L] of the center crop of an image with shape `original_shape` and `affine`.
+
+    mode (str): 'cropped' writes uint8 at the size of the prediction with the crop offset in the affine,
+                'full' pads the prediction to the original shape and writes int32.
+    compresslevel (int): gzip level from 1 (fastest) to 9, ignored for uncompressed .nii outputs.
+    """
+    if mode == 'full':
+        img = nib.Nifti1Image(pad_to_original_size(pred, original_shape).astype(np.int32), affine=affine)
+    elif mode == 'cropped':
+        if pred.min() < 0 or pred.max() > np.iinfo(np.uint8).max:
+            raise ValueError(f"Labels must be in [0, 255] for mode 'cropped', got [{pred.min()}, {pred.max()}].")
+        img = nib.Nifti1Image(pred.astype(np.uint8), affine=offset_affine(affine, crop_offset(pred.shape,
+                                                                                               original_shape)))
+        img.header['descrip'] = DESCRIP_PREFIX + 'x'.join(str(size) for size in original_shape[:3])
+    else:
+        raise ValueError(f"mode must be one of {OUTPUT_MODES}, got {mode}.")
+    save_nifti(img, out_path, compresslevel)
+
+
+def stored_shape(header):
+    """ Original shape stored by save_label in the header description, None if there is none. """
+    match = re.fullmatch(re.escape(DESCRIP_PREFIX) + r'(\d+)x(\d+)x(\d+)', header['descrip'].item().decode())
+    return tuple(int(size) for size in match.groups()) if match else None
+
+
+def expand_label(path, reference=None):
+    """
+    Full field-of-view label map of a file written by save_label, as (labels, affine).
+
+    reference (str): Image whose grid the labels are placed on. By default the grid stored in the file is used.
+    Files of mode 'full' are returned unchanged.
+    """
+    img = nib.load(path)
+    labels = np.asarray(img.dataobj)
+    if reference is not None:
+        original_shape, affine = reference_geometry(reference)
+    else:
+        original_shape = stored_shape(img.header)
+        if original_shape is None:
+            return labels, img.affine
+        affine = None
+
+    # the offset is where voxel (0, 0, 0) of the crop lands on the reference grid
+    if affine is None:
+        offset = crop_offset(labels.shape, original_shape)
+        affine = offset_affine(img.affine, [-o for o in offset])
+    else:
+        offset = np.linalg.solve(affine, img.affine[:, 3])[:3]
+        if not np.allclose(offset, np.round(offset), atol=1e-3):
+            raise ValueError(f"{path} is not on the voxel grid of {reference}.")
+        offset = np.round(offset).astype(int)
+
+    full = np.zeros(original_shape, dtype=labels.dtype)
+    full[tuple(slice(o, o + size) for o, size in zip(offset, labels.shape))] = labels
+    return full, affine
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Expand a cropped label map to the full field of view.")
+    parser.add_argument('--cropped', type=str, required=True, help='Label map written in cropped mode.')
+    parser.add_argument('--out', type=str, required=True, help='Output path of the full-size label map.')
+    parser.add_argument('--reference', type=str, default=None, help='Image defining the output grid.')
+    parser.add_argument('--compresslevel', type=int, default=1, help='gzip level of .nii.gz outputs.')
+    args = parser.parse_args()
+
+    labels, affine = expand_label(args.cropped, args.reference)
+    save_nifti(nib.Nifti1Image(labels, affine=affine), args.out, args.compresslevel)
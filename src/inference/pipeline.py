@@ -0,0 +1,94 @@
+import sys
+import torch
+import torch.nn as nn
+from functools import partial
+
+sys.path.append('../../src')
+from utils.utils import generate_foreground_mask
+from inference.cascade import cascaded_inference, forward
+from inference.sliding_window import sliding_window_inference
+from inference.optimize import prepare_input
+
+
+def make_predictor(inference_mode, device, patch_size=(96, 96, 96), patch_overlap=0.5, patch_batch_size=2):
+    """
+    predict(model, volume) -> output [out_dim, ...] for a [C, H, W, L] host volume.
+
+    inference_mode (str): 'center_crop' runs a single forward pass over the (already cropped) volume,
+                          'sliding_window' runs Gaussian-blended patches over a volume of any size.
+    """
+    if inference_mode == 'sliding_window':
+        return partial(sliding_window_inference, patch_size=patch_size, overlap=patch_overlap,
+                       batch_size=patch_batch_size, device=device)
+    if inference_mode == 'center_crop':
+        return partial(forward, device=device)
+    raise ValueError(f"Unknown inference mode {inference_mode}.")
+
+
+def segment_volume(model_1, model_2, data, predict, cascade=False, cascade_margin=8, threshold=50):
+    """
+    Run the ROI (model_1) and NUCLEI (model_2) stages on one [C, H, W, L] volume.
+
+    Returns the ROI labels [0, 1] cleaned by generate_foreground_mask and the NUCLEI labels [1, ..., 13]
+    (0 outside of the ROI bounding box in cascade mode), both as int32 numpy arrays.
+    """
+    if cascade:
+        pred_1_arr, pred_2_arr, _ = cascaded_inference(model_1, model_2, data, margin=cascade_margin,
+                                                       threshold=threshold, predict=predict)
+        return pred_1_arr, pred_2_arr
+
+    with torch.inference_mode():
+        pred_1 = predict(model_1, data)
+        pred_2 = predict(model_2, data)
+
+        # convert probability to index
+        pred_1_arr = torch.argmax(pred_1, dim=0).type(torch.int32).cpu().numpy()       # Index [0, 1]
+        pred_2_arr = torch.argmax(pred_2, dim=0).type(torch.int32).cpu().numpy() + 1   # Index [1, 2, ..., 13]
+
+    # remove small connected components for prediction 1
+    pred_1_arr = pred_1_arr * generate_foreground_mask(pred_1_arr, threshold=threshold)
+    return pred_1_arr, pred_2_arr
+
+
+def segment_batch(model_1, model_2, data, device, threshold=50):
+    """
+    Center-crop inference for a batch of subjects [N, C, H, W, L], one forward pass per stage for the whole batch.
+    Returns lists of the cleaned ROI labels and the NUCLEI labels of every subject.
+    """
+    with torch.inference_mode():
+        data = data.to(device)
+        pred_1 = torch.argmax(model_1(prepare_input(data, model_1)), dim=1).type(torch.int32).cpu().numpy()
+        pred_2 = torch.argmax(model_2(prepare_input(data, model_2)), dim=1).type(torch.int32).cpu().numpy() + 1
+
+    pred_1_arrs = [arr * generate_foreground_mask(arr, threshold=threshold) for arr in pred_1]
+    return pred_1_arrs, list(pred_2)
+
+
+class ConcatenatedHeads(nn.Module):
+    """
+    Wraps a MultiTaskUnetL5 so that it returns a single tensor, its ROI and NUCLEI outputs concatenated along the channel
+    dimension, as expected by the predictors (e.g. sliding_window_inference).
+    """
+
+    def __init__(self, model):
+        super(ConcatenatedHeads, self).__init__()
+        self.model = model
+        self.roi_dim = model.roi_dim
+        self.channels_last = getattr(model, 'channels_last', False)
+
+    def forward(self, x):
+        return torch.cat(self.model(x), dim=1)
+
+
+def segment_volume_multitask(model, data, predict, threshold=50):
+    """
+    Run a MultiTaskUnetL5 wrapped in ConcatenatedHeads on one [C, H, W, L] volume. One pass gives both outputs, which
+    are returned as in segment_volume.
+    """
+    with torch.inference_mode():
+        pred = predict(model, data)
+        pred_1_arr = torch.argmax(pred[:model.roi_dim], dim=0).type(torch.int32).cpu().numpy()       # Index [0, 1]
+        pred_2_arr = torch.argmax(pred[model.roi_dim:], dim=0).type(torch.int32).cpu().numpy() + 1   # Index [1, ..., 13]
+
+    pred_1_arr = pred_1_arr * generate_foreground_mask(pred_1_arr, threshold=threshold)
+    return pred_1_arr, pred_2_arr
@@ -0,0 +1,77 @@
+"""
+Minimal runtime for the models written by export_model.py.
+
+Only torch (TorchScript artifacts) or onnxruntime (ONNX artifacts) and numpy are imported: no model definitions, no
+checkpoints with loss histories and no training modules. onnxruntime is optional and only needed for .onnx files.
+
+Usage:
+    roi_model, nuclei_model = load_fold('/path/to/exported', fold=0)
+    roi_labels = roi_model.labels(data)         # data: [N, C, H, W, L] float32 array or tensor
+    nuclei_labels = nuclei_model.labels(data)
+"""
+
+
+import os
+import json
+import warnings
+import numpy as np
+import torch
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+class ExportedModel:
+    """
+    A TorchScript (.pt) or ONNX (.onnx) artifact with its metadata (.json next to it).
+
+    path (str): Path of the artifact.
+    num_threads (int): Intra-op threads, the runtime's default if None.
+    """
+
+    def __init__(self, path, num_threads=None):
+        self.path = path
+        with open(os.path.splitext(path)[0] + '.json') as f:
+            self.meta = json.load(f)
+
+        if path.endswith('.onnx'):
+            if onnxruntime is None:
+                raise ImportError("Running ONNX models requires the onnxruntime package.")
+            options = onnxruntime.SessionOptions()
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+            self.module = None
+        else:
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+            with warnings.catch_warnings():
+                # TorchScript is deprecated upstream, but still the fastest artifact to load
+                warnings.simplefilter('ignore', FutureWarning)
+                self.module = torch.jit.load(path, map_location='cpu')
+            self.session = None
+
+    def __call__(self, data):
+        """ Output probabilities [N, out_dim, H, W, L] as a float32 numpy array. """
+        if self.session is not None:
+            data = data.numpy() if isinstance(data, torch.Tensor) else data
+            return self.session.run(None, {'data': np.ascontiguousarray(data, dtype=np.float32)})[0]
+
+        data = torch.as_tensor(data, dtype=torch.float32)
+        if self.meta.get('torchscript_channels_last', False):
+            data = data.contiguous(memory_format=torch.channels_last_3d)
+        with torch.inference_mode():
+            return self.module(data).numpy()
+
+    def labels(self, data):
+        """ Label map [N, H, W, L]: the argmax of the output plus the label offset of the model. """
+        return np.argmax(self(data), axis=1).astype(np.int32) + self.meta['label_offset']
+
+
+def load_fold(export_dir, fold, export_format='torchscript', num_threads=None):
+    """ The exported ROI and NUCLEI models of `fold`. """
+    ext = '.onnx' if export_format == 'onnx' else '.pt'
+    return tuple(ExportedModel(os.path.join(export_dir, str(fold), name + ext), num_threads=num_threads)
+                 for name in ('ROI_model', 'NUCLEI_model'))
@@ -0,0 +1,98 @@
+import sys
+import math
+import torch
+import torch.nn.functional as F
+
+sys.path.append('../../src')
+from inference.optimize import prepare_input
+
+
+def gaussian_importance_map(patch_size, sigma_scale=0.125, device=None):
+    """
+    Gaussian weights used to blend overlapping patches, highest at the patch center.
+
+    patch_size (tuple): Spatial size of a patch, e.g. (96, 96, 96).
+    sigma_scale (float): Standard deviation of the Gaussian relative to the patch size.
+    """
+    axes = []
+    for size in patch_size:
+        coords = torch.arange(size, dtype=torch.float32, device=device) - (size - 1) / 2
+        sigma = size * sigma_scale
+        axes.append(torch.exp(-coords ** 2 / (2 * sigma ** 2)))
+    importance = axes[0][:, None, None] * axes[1][None, :, None] * axes[2][None, None, :]
+    importance = importance / importance.max()
+    # avoid zero weights at the border, which would leave uncovered voxels undefined
+    return importance.clamp(min=1e-4)
+
+
+def patch_starts(size, patch, step):
+    """ Start positions along one axis so that patches of length `patch` cover [0, size) with at most `step` apart. """
+    if size <= patch:
+        return [0]
+    num = math.ceil((size - patch) / step) + 1
+    return [round(i * (size - patch) / (num - 1)) for i in range(num)]
+
+
+def sliding_window_inference(model, data, patch_size=(96, 96, 96), overlap=0.5, blend='gaussian', sigma_scale=0.125,
+                             batch_size=2, device=None, out_device='cpu'):
+    """
+    Patch-based inference over a volume of arbitrary size.
+
+    The volume is tiled with overlapping patches, patches are batched into a single forward call and the blended
+    outputs are accumulated on `out_device`. Peak memory on `device` is bounded by `batch_size` patches, independent of
+    the volume size, so full-FOV predictions can also run on CPU-only nodes.
+
+    model (nn.Module): Network in eval mode. Every patch dimension must be compatible with its pooling depth
+                       (a multiple of 32 for UnetL5).
+    data (torch.Tensor): Input volume with shape [C, H, W, L].
+    patch_size (tuple): Spatial size of the patches.
+    overlap (float): Fraction of overlap between neighbouring patches, in [0, 1).
+    blend (str): 'gaussian' weights voxels close to a patch center higher, 'constant' averages uniformly.
+    sigma_scale (float): Standard deviation of the Gaussian blending relative to the patch size.
+    batch_size (int): Number of patches per forward call.
+    device (torch.device): Device the model runs on. Defaults to the device of the model parameters.
+    out_device (torch.device): Device the output probabilities are accumulated on.
+
+    Returns the blended model output with shape [out_dim, H, W, L] on `out_device`.
+    """
+    if not 0 <= overlap < 1:
+        raise ValueError("overlap must be in [0, 1).")
+    if blend not in ('gaussian', 'constant'):
+        raise ValueError("blend must be 'gaussian' or 'constant'.")
+    if device is None:
+        device = next(model.parameters()).device
+
+    # pad volumes smaller than a patch, the padding is cropped from the output again
+    spatial_shape = tuple(data.shape[1:])
+    pad = [max(p - s, 0) for s, p in zip(spatial_shape, patch_size)]
+    if any(pad):
+        data = F.pad(data, (0, pad[2], 0, pad[1], 0, pad[0]))
+    padded_shape = tuple(data.shape[1:])
+
+    steps = [max(int(p * (1 - overlap)), 1) for p in patch_size]
+    starts = [patch_starts(s, p, st) for s, p, st in zip(padded_shape, patch_size, steps)]
+    positions = [(x, y, z) for x in starts[0] for y in starts[1] for z in starts[2]]
+
+    if blend == 'gaussian':
+        importance = gaussian_importance_map(patch_size, sigma_scale, device=device)
+    else:
+        importance = torch.ones(patch_size, device=device)
+    importance_out = importance.to(out_device)
+
+    output, weights = None, torch.zeros(padded_shape, dtype=torch.float32, device=out_device)
+    with torch.inference_mode():
+        for i in range(0, len(positions), batch_size):
+            batch_positions = positions[i:i + batch_size]
+            patches = torch.stack([data[:, x:x + patch_size[0], y:y + patch_size[1], z:z + patch_size[2]]
+                                   for x, y, z in batch_positions])
+            pred = model(prepare_input(patches.to(device, dtype=torch.float32), model)) * importance
+            pred = pred.to(out_device, dtype=torch.float32)
+
+            if output is None:
+                output = torch.zeros((pred.shape[1],) + padded_shape, dtype=torch.float32, device=out_device)
+            for (x, y, z), patch_pred in zip(batch_positions, pred):
+                output[:, x:x + patch_size[0], y:y + patch_size[1], z:z + patch_size[2]] += patch_pred
+                weights[x:x + patch_size[0], y:y + patch_size[1], z:z + patch_size[2]] += importance_out
+
+        output /= weights
+    return output[:, :spatial_shape[0], :spatial_shape[1], :spatial_shape[2]]
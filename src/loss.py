@@ -1,12 +1,32 @@
 import torch
 import torch.nn as nn
-from utils.utils import one_hot_encoding
+from utils.utils import class_indices, one_hot_encoding
+
+# from this number of classes on, the sparse path of DiceLoss is faster than the one-hot encoding (1.3-1.7x for the 13
+# NUCLEI classes on the CPU at 96^3, see benchmarks/bench_dice_loss.py); below it the gather and the float64 scatter
+# cost more than the one-hot tensor saves, e.g. about 0.5x for the 2 ROI classes
+SPARSE_MIN_CLASSES = 9
+
+
+class SumOfSquares(torch.autograd.Function):
+    """ sum(x ** 2) over the trailing dimension without a temporary of the size of x (the gradient is 2 * x). """
+
+    @staticmethod
+    def forward(ctx, x):
+        ctx.save_for_backward(x)
+        return torch.linalg.vector_norm(x, dim=-1, dtype=torch.float64).square().to(x.dtype)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        x, = ctx.saved_tensors
+        return 2 * x * grad_output.unsqueeze(-1)
 
 
 class DiceLoss(nn.Module):
     """
     Construct based on Vnet paper 'https://arxiv.org/abs/1606.04797'
-    Handle both one-hot encoded and non-one-hot encoded ground truth.
+    Handle both one-hot encoded and non-one-hot encoded ground truth. The latter is one-hot encoded for fewer than
+    SPARSE_MIN_CLASSES classes, and compared to the prediction without a one-hot tensor otherwise.
 
     Attributes:
         num_classes (int): The number of classes in the segmentation task.
@@ -25,15 +45,16 @@ class DiceLoss(nn.Module):
         self.isPlotPerChannelLoss = isPlotPerChannelLoss
 
     def forward(self, prediction, ground_truth):
-        # Perform one-hot encoding conversion if needed
-        if not self.isOneHot:
-            if self.gt_values is None:
-                raise ValueError("gt_values must be provided if ground truth is not one-hot encoded.")
-            ground_truth = one_hot_encoding(ground_truth, self.gt_values, self.num_classes)
-
         # Calculate the intersection and union
-        intersection = torch.sum(prediction * ground_truth, dim=(2, 3, 4))
-        union = torch.sum(prediction ** 2, dim=(2, 3, 4)) + torch.sum(ground_truth ** 2, dim=(2, 3, 4))
+        if not self.isOneHot and self.gt_values is None:
+            raise ValueError("gt_values must be provided if ground truth is not one-hot encoded.")
+        if not self.isOneHot and self.num_classes >= SPARSE_MIN_CLASSES:
+            intersection, union = self.sparse_intersection_union(prediction, ground_truth)
+        else:
+            if not self.isOneHot:
+                ground_truth = one_hot_encoding(ground_truth, self.gt_values, self.num_classes)
+            intersection = torch.sum(prediction * ground_truth, dim=(2, 3, 4))
+            union = torch.sum(prediction ** 2, dim=(2, 3, 4)) + torch.sum(ground_truth ** 2, dim=(2, 3, 4))
 
         # Calculate Dice Score per channel
         dice_score_channel = (2 * intersection + self.eps) / (union + self.eps)
@@ -48,3 +69,29 @@ class DiceLoss(nn.Module):
 
         return (dice_loss_overall, dice_loss_channel) if self.isPlotPerChannelLoss else dice_loss_overall
 
+    def sparse_intersection_union(self, prediction, ground_truth):
+        """
+        Intersection and union of the prediction with the one-hot encoded ground truth, without building the one-hot
+        tensor or any other prediction-sized temporary:
+            sum(prediction * one_hot)  = per class sum of the prediction gathered at the ground truth class
+            sum(one_hot ** 2)          = per class voxel count
+            sum(prediction ** 2)       = per channel dot product of the prediction with itself
+        """
+        batch_size = prediction.size(0)
+        indices = class_indices(ground_truth, self.gt_values[:self.num_classes]).flatten(1)   # [B, N]
+        valid = indices >= 0
+        indices = indices.clamp(min=0)
+
+        prediction_flat = prediction.flatten(2)                                                # [B, C, N]
+        picked = prediction_flat.gather(1, indices.unsqueeze(1)).squeeze(1) * valid            # [B, N]
+
+        # per class sums are accumulated in float64, a sequential float32 scatter would lose precision
+        # compared to the pairwise summation of torch.sum
+        sums = torch.zeros(batch_size, self.num_classes, dtype=torch.float64, device=prediction.device)
+        intersection = sums.scatter_add(1, indices, picked.double()).to(prediction.dtype)
+        gt_count = sums.scatter_add(1, indices, valid.double()).to(prediction.dtype)
+
+        prediction_sq = SumOfSquares.apply(prediction_flat)
+
+        return intersection, prediction_sq + gt_count
+
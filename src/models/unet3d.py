@@ -1,5 +1,7 @@
 import torch
 import torch.nn as nn
+from contextlib import contextmanager
+from torch.utils.checkpoint import checkpoint
 
 
 def conv_block_3d(in_dim: int, out_dim: int, activation: nn.Module) -> nn.Sequential:
@@ -43,6 +45,38 @@ def max_pooling_3d() -> nn.MaxPool3d:
     return nn.MaxPool3d(kernel_size=2, stride=2, padding=0)
 
 
+@contextmanager
+def frozen_batchnorm_stats(block: nn.Module):
+    """ Keep the BatchNorm running statistics of `block` unchanged, e.g. while a checkpointed block is recomputed. """
+    bns = [m for m in block.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    saved = [(bn.momentum, bn.num_batches_tracked.clone()) for bn in bns]
+    for bn in bns:
+        bn.momentum = 0.
+    try:
+        yield
+    finally:
+        for bn, (momentum, num_batches_tracked) in zip(bns, saved):
+            bn.momentum = momentum
+            bn.num_batches_tracked.copy_(num_batches_tracked)
+
+
+def checkpoint_block(block: nn.Module, x: torch.Tensor) -> torch.Tensor:
+    """
+    Run `block` with activation checkpointing: its intermediate activations are dropped after the forward pass and
+    recomputed during the backward pass. The recomputation does not update the BatchNorm running statistics again.
+    """
+    state = {'recompute': False}
+
+    def run(inp):
+        if state['recompute']:
+            with frozen_batchnorm_stats(block):
+                return block(inp)
+        state['recompute'] = True
+        return block(inp)
+
+    return checkpoint(run, x, use_reentrant=False)
+
+
 class UnetL3(nn.Module):
     def __init__(self, in_dim: int, out_dim: int, num_filters: int,
                  activation: nn.Module = nn.LeakyReLU(0.2, inplace=True), output_activation: nn.Module = None):
@@ -188,15 +222,20 @@ class UnetL4(nn.Module):
         return out
 
 
-class UnetL5(nn.Module):
-    def __init__(self, in_dim: int, out_dim: int, num_filters: int,
-                 activation: nn.Module = nn.LeakyReLU(0.2, inplace=True), output_activation: nn.Module = None):
-        super(UnetL5, self).__init__()
+class UnetL5Encoder(nn.Module):
+    """
+    The down-sampling path and bridge of UnetL5. Base class of UnetL5 and MultiTaskUnetL5, so that their encoder
+    layers keep the names down_*, pool_* and bridge of the original UnetL5 state dicts.
+    """
+
+    def __init__(self, in_dim: int, num_filters: int, activation: nn.Module = nn.LeakyReLU(0.2, inplace=True),
+                 use_checkpoint: bool = False):
+        super(UnetL5Encoder, self).__init__()
         self.in_dim = in_dim
-        self.out_dim = out_dim
         self.num_filters = num_filters
         self.activation = activation
-        self.output_activation = output_activation
+        # activation checkpointing of the conv_block_2_3d stages while training
+        self.use_checkpoint = use_checkpoint
 
         # Down sampling
         self.down_1 = conv_block_2_3d(self.in_dim, self.num_filters, self.activation)
@@ -213,65 +252,135 @@ class UnetL5(nn.Module):
         # Bridge
         self.bridge = conv_block_2_3d(self.num_filters * 16, self.num_filters * 32, self.activation)
 
-        # Up sampling
-        self.trans_1 = conv_trans_block_3d(self.num_filters * 32, self.num_filters * 32, self.activation)
-        self.up_1 = conv_block_2_3d(self.num_filters * 48, self.num_filters * 16, self.activation)
-        self.trans_2 = conv_trans_block_3d(self.num_filters * 16, self.num_filters * 16, self.activation)
-        self.up_2 = conv_block_2_3d(self.num_filters * 24, self.num_filters * 8, self.activation)
-        self.trans_3 = conv_trans_block_3d(self.num_filters * 8, self.num_filters * 8, self.activation)
-        self.up_3 = conv_block_2_3d(self.num_filters * 12, self.num_filters * 4, self.activation)
-        self.trans_4 = conv_trans_block_3d(self.num_filters * 4, self.num_filters * 4, self.activation)
-        self.up_4 = conv_block_2_3d(self.num_filters * 6, self.num_filters * 2, self.activation)
-        self.trans_5 = conv_trans_block_3d(self.num_filters * 2, self.num_filters * 2, self.activation)
-        self.up_5 = conv_block_2_3d(self.num_filters * 3, self.num_filters * 1, self.activation)
+    def run_block(self, block: nn.Module, x: torch.Tensor) -> torch.Tensor:
+        if self.use_checkpoint and self.training and torch.is_grad_enabled():
+            return checkpoint_block(block, x)
+        return block(x)
 
-        # Output
-        if self.output_activation:
-            self.out = conv_block_out_activate_3d(num_filters, out_dim, self.output_activation)
-        else:
-            self.out = conv_block_out_3d(num_filters, out_dim)
-
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def encode(self, x: torch.Tensor) -> tuple:
+        """ The bridge and the skip connections [down_1, ..., down_5] of `x`. """
         # Down sampling
-        down_1 = self.down_1(x)
+        down_1 = self.run_block(self.down_1, x)
         pool_1 = self.pool_1(down_1)
 
-        down_2 = self.down_2(pool_1)
+        down_2 = self.run_block(self.down_2, pool_1)
         pool_2 = self.pool_2(down_2)
 
-        down_3 = self.down_3(pool_2)
+        down_3 = self.run_block(self.down_3, pool_2)
         pool_3 = self.pool_3(down_3)
 
-        down_4 = self.down_4(pool_3)
+        down_4 = self.run_block(self.down_4, pool_3)
         pool_4 = self.pool_4(down_4)
 
-        down_5 = self.down_5(pool_4)
+        down_5 = self.run_block(self.down_5, pool_4)
         pool_5 = self.pool_5(down_5)
 
         # Bridge
-        bridge = self.bridge(pool_5)
+        bridge = self.run_block(self.bridge, pool_5)
+        return bridge, [down_1, down_2, down_3, down_4, down_5]
+
+
+def add_l5_decoder(module: nn.Module, out_dim: int, num_filters: int, activation: nn.Module,
+                   output_activation: nn.Module = None):
+    """ Add the up-sampling path (trans_*, up_*) and the output layer (out) of UnetL5 to `module`. """
+    # Up sampling
+    module.trans_1 = conv_trans_block_3d(num_filters * 32, num_filters * 32, activation)
+    module.up_1 = conv_block_2_3d(num_filters * 48, num_filters * 16, activation)
+    module.trans_2 = conv_trans_block_3d(num_filters * 16, num_filters * 16, activation)
+    module.up_2 = conv_block_2_3d(num_filters * 24, num_filters * 8, activation)
+    module.trans_3 = conv_trans_block_3d(num_filters * 8, num_filters * 8, activation)
+    module.up_3 = conv_block_2_3d(num_filters * 12, num_filters * 4, activation)
+    module.trans_4 = conv_trans_block_3d(num_filters * 4, num_filters * 4, activation)
+    module.up_4 = conv_block_2_3d(num_filters * 6, num_filters * 2, activation)
+    module.trans_5 = conv_trans_block_3d(num_filters * 2, num_filters * 2, activation)
+    module.up_5 = conv_block_2_3d(num_filters * 3, num_filters * 1, activation)
+
+    # Output
+    if output_activation:
+        module.out = conv_block_out_activate_3d(num_filters, out_dim, output_activation)
+    else:
+        module.out = conv_block_out_3d(num_filters, out_dim)
+
+
+def run_l5_decoder(module: nn.Module, bridge: torch.Tensor, skips: list, run_block=None) -> torch.Tensor:
+    """ The output of the decoder layers of `module` (see add_l5_decoder) for the bridge and skips of the encoder. """
+    # run_block optionally checkpoints the conv blocks
+    run_block = run_block or (lambda block, x: block(x))
+    down_1, down_2, down_3, down_4, down_5 = skips
+
+    # Up sampling
+    trans_1 = module.trans_1(bridge)
+    concat_1 = torch.cat([trans_1, down_5], dim=1)
+    up_1 = run_block(module.up_1, concat_1)
+
+    trans_2 = module.trans_2(up_1)
+    concat_2 = torch.cat([trans_2, down_4], dim=1)
+    up_2 = run_block(module.up_2, concat_2)
+
+    trans_3 = module.trans_3(up_2)
+    concat_3 = torch.cat([trans_3, down_3], dim=1)
+    up_3 = run_block(module.up_3, concat_3)
+
+    trans_4 = module.trans_4(up_3)
+    concat_4 = torch.cat([trans_4, down_2], dim=1)
+    up_4 = run_block(module.up_4, concat_4)
+
+    trans_5 = module.trans_5(up_4)
+    concat_5 = torch.cat([trans_5, down_1], dim=1)
+    up_5 = run_block(module.up_5, concat_5)
+
+    # Output
+    return module.out(up_5)
+
+
+class UnetL5(UnetL5Encoder):
+    def __init__(self, in_dim: int, out_dim: int, num_filters: int,
+                 activation: nn.Module = nn.LeakyReLU(0.2, inplace=True), output_activation: nn.Module = None,
+                 use_checkpoint: bool = False):
+        super(UnetL5, self).__init__(in_dim, num_filters, activation, use_checkpoint)
+        self.out_dim = out_dim
+        self.output_activation = output_activation
+        add_l5_decoder(self, out_dim, num_filters, self.activation, self.output_activation)
 
-        # Up sampling
-        trans_1 = self.trans_1(bridge)
-        concat_1 = torch.cat([trans_1, down_5], dim=1)
-        up_1 = self.up_1(concat_1)
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        bridge, skips = self.encode(x)
+        return run_l5_decoder(self, bridge, skips, self.run_block)
 
-        trans_2 = self.trans_2(up_1)
-        concat_2 = torch.cat([trans_2, down_4], dim=1)
-        up_2 = self.up_2(concat_2)
 
-        trans_3 = self.trans_3(up_2)
-        concat_3 = torch.cat([trans_3, down_3], dim=1)
-        up_3 = self.up_3(concat_3)
+class UnetL5Decoder(nn.Module):
+    """ The up-sampling path and output layer of UnetL5, fed with the bridge and the skip connections of an encoder. """
 
-        trans_4 = self.trans_4(up_3)
-        concat_4 = torch.cat([trans_4, down_2], dim=1)
-        up_4 = self.up_4(concat_4)
+    def __init__(self, out_dim: int, num_filters: int, activation: nn.Module = nn.LeakyReLU(0.2, inplace=True),
+                 output_activation: nn.Module = None):
+        super(UnetL5Decoder, self).__init__()
+        self.out_dim = out_dim
+        self.num_filters = num_filters
+        self.activation = activation
+        self.output_activation = output_activation
+        add_l5_decoder(self, out_dim, num_filters, self.activation, self.output_activation)
 
-        trans_5 = self.trans_5(up_4)
-        concat_5 = torch.cat([trans_5, down_1], dim=1)
-        up_5 = self.up_5(concat_5)
+    def forward(self, bridge: torch.Tensor, skips: list, run_block=None) -> torch.Tensor:
+        return run_l5_decoder(self, bridge, skips, run_block)
 
-        # Output
-        out = self.out(up_5)
-        return out
+
+class MultiTaskUnetL5(UnetL5Encoder):
+    """
+    UnetL5 with one encoder shared by two decoders: the ROI head (roi_dim channels, sigmoid) and the NUCLEI head
+    (nuclei_dim channels, softmax). A single pass replaces the separate ROI and NUCLEI UnetL5 models, so the encoder
+    runs once per volume. forward returns (roi_out, nuclei_out).
+    """
+
+    def __init__(self, in_dim: int, roi_dim: int = 2, nuclei_dim: int = 13, num_filters: int = 4,
+                 activation: nn.Module = nn.LeakyReLU(0.2, inplace=True), use_checkpoint: bool = False):
+        super(MultiTaskUnetL5, self).__init__(in_dim, num_filters, activation, use_checkpoint)
+        self.roi_dim = roi_dim
+        self.nuclei_dim = nuclei_dim
+
+        # Heads
+        self.roi_decoder = UnetL5Decoder(roi_dim, num_filters, self.activation, nn.Sigmoid())
+        self.nuclei_decoder = UnetL5Decoder(nuclei_dim, num_filters, self.activation, nn.Softmax(dim=1))
+
+    def forward(self, x: torch.Tensor) -> tuple:
+        bridge, skips = self.encode(x)
+        return (self.roi_decoder(bridge, skips, self.run_block),
+                self.nuclei_decoder(bridge, skips, self.run_block))
@@ -0,0 +1,78 @@
+"""
+Fold-ensemble segmentation of a single subject.
+
+All requested folds (8 ROI + 8 NUCLEI models by default) are loaded once, run on the same loaded volume and their
+sigmoid/softmax probabilities are averaged into one consensus segmentation.
+
+Usage (run from src):
+    python predict.py --data /path/to/subject_data.nii.gz --checkpoint_dir /path/to/model/checkpoints \
+                      --out_dir /path/to/output [--folds 0 1 2]
+"""
+
+
+import os
+import sys
+import time
+import argparse
+import torch
+import numpy as np
+
+sys.path.append('../src')
+from dataloaders.volume_cache import read_cropped_data, strip_nifti_ext
+from inference.ensemble import FoldEnsemble
+from inference.pipeline import make_predictor, segment_volume
+from inference.output_writer import OUTPUT_MODES, reference_geometry, save_label, output_ext
+from utils.device import get_device
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Segment the thalamic nuclei of one subject with a fold ensemble.")
+    parser.add_argument('--data', type=str, required=True, help='4D nifti with the input channels of the subject.')
+    parser.add_argument('--checkpoint_dir', type=str, required=True,
+                        help='Folder holding ROI_model/<fold>/ and NUCLEI_model/<fold>/best_checkpoint.pt.')
+    parser.add_argument('--out_dir', type=str, required=True, help='Folder to save the segmentation.')
+    parser.add_argument('--folds', type=int, nargs='+', default=list(range(8)),
+                        help='Folds to ensemble (default: all 8). Fewer folds lower the latency.')
+    parser.add_argument('--num_in', type=int, default=68, help='Number of input channels.')
+    parser.add_argument('--device', type=str, default=None,
+                        help="Device to run on, e.g. 'cuda' or 'cpu' (default: $RATNUS_DEVICE or auto).")
+    parser.add_argument('--num_threads', type=int, default=None, help='Intra-op threads for CPU inference.')
+    parser.add_argument('--inference_mode', type=str, default='center_crop', choices=['center_crop', 'sliding_window'],
+                        help='Single pass over the 96^3 center crop or sliding window over the full volume.')
+    parser.add_argument('--patch_overlap', type=float, default=0.5, help='Patch overlap in sliding-window mode.')
+    parser.add_argument('--patch_batch_size', type=int, default=2, help='Patches per forward call.')
+    parser.add_argument('--cascade', action='store_true',
+                        help='Run the NUCLEI models only on the bounding box of the ROI prediction.')
+    parser.add_argument('--no_vectorize', action='store_true',
+                        help='Run the fold models one after another instead of as one batched call.')
+    parser.add_argument('--output_mode', type=str, default='full', choices=OUTPUT_MODES,
+                        help='int32 padded to the input size, or uint8 cropped with the offset in the affine.')
+    parser.add_argument('--compresslevel', type=int, default=1,
+                        help='gzip level of the output from 1 to 9, 0 writes an uncompressed .nii.')
+    args = parser.parse_args()
+
+    device = get_device(args.device)
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    ensemble = FoldEnsemble(args.checkpoint_dir, folds=args.folds, num_in=args.num_in, device=device,
+                            num_threads=args.num_threads, vectorize=not args.no_vectorize)
+    print('Loaded {} folds in {:.2f}s'.format(len(ensemble.folds), time.perf_counter() - start))
+
+    # input volume, only the header is needed for the reference geometry
+    start = time.perf_counter()
+    original_shape, affine = reference_geometry(args.data)
+    crop_size = (96, 96, 96) if args.inference_mode == 'center_crop' else None
+    data = torch.from_numpy(read_cropped_data(args.data, crop_size))
+
+    predict = make_predictor(args.inference_mode, device, patch_overlap=args.patch_overlap,
+                             patch_batch_size=args.patch_batch_size)
+    pred_1_arr, pred_2_arr = segment_volume(ensemble.model_1, ensemble.model_2, data, predict, cascade=args.cascade)
+    pred_comb_arr = pred_1_arr.astype(np.int32) * pred_2_arr.astype(np.int32)
+    print('Segmented {} in {:.2f}s'.format(args.data, time.perf_counter() - start))
+
+    prefix = strip_nifti_ext(os.path.basename(args.data))
+    out_path = os.path.join(args.out_dir, prefix + '_ratnus' + output_ext(args.compresslevel))
+    save_label(pred_comb_arr, original_shape, affine, out_path, mode=args.output_mode, compresslevel=args.compresslevel)
+    print('Saved', out_path)
@@ -3,94 +3,90 @@ import sys
 import torch
 import numpy as np
 import torch.nn as nn
-import nibabel as nib
-from scipy.ndimage import label, find_objects
 
 sys.path.append('../src')
 from dataloaders.dataloader_test import ThalamusDataloader
-from models.unet3d import UnetL5
+from models.unet3d import UnetL5, MultiTaskUnetL5
+from inference.optimize import optimize_for_inference
+from inference.pipeline import make_predictor, segment_volume, segment_volume_multitask, ConcatenatedHeads
+from inference.output_writer import reference_geometry, save_label, output_ext
+from utils.device import get_device
 
 
 # Hard coding
 test_batch_size = 1
 num_input_channels = 68
-device = torch.device("cuda")
+device = get_device()  # RATNUS_DEVICE=cpu forces the CPU, see utils/device.py
+cpu_num_threads = None  # intra-op threads for CPU inference, torch's default if None
 
 data_dir = '/path/to/nifti/data'
 label_1_dir = '/path/to/binary/labels'
 label_2_dir = '/path/to/labels'
 checkpoint_dir = '/path/to/model/checkpoints'
 original_data_dir = '/path/to/where/data/is/stored/before/combining/into/68/channels'
+cache_dir = None  # set to a folder to read cropped volumes from the cache (see dataloaders/volume_cache.py)
 
-out_dir = '/path/to/output/directory'
-if not os.path.exists(out_dir):
-    os.makedirs(out_dir)
-
-
-# Remove small connected component
-def generate_foreground_mask(data, threshold=50):
-
-    # find connected components
-    labeled_data, num_features = label(data)
-    regions = find_objects(labeled_data)
-
-    # calculate the volume for each connected component
-    areas = [np.sum(data[regions[i]] == 1) for i in range(num_features)]
-
-    mask = np.ones_like(data, dtype=bool)
-    mask[data == 0] = 0
-    for i, area in enumerate(areas):
-        if area < threshold:
-            mask[regions[i]] = 0
-
-    return mask
+# 'two_models': separate ROI and NUCLEI UnetL5 models (ROI_model/ and NUCLEI_model/ checkpoints)
+# 'multitask': one MultiTaskUnetL5 with a shared encoder (MULTITASK_model/ checkpoints, see train_MULTITASK_model.py)
+model_type = 'two_models'
 
+# 'center_crop': a single forward pass over the 96^3 center crop, padded back to the original size
+# 'sliding_window': Gaussian-blended patches over the full volume (see inference/sliding_window.py)
+inference_mode = 'center_crop'
+patch_size = (96, 96, 96)
+patch_overlap = 0.5
+patch_batch_size = 2
 
-# Recover the predictions to original shape
-def pad_to_original_size(pred, original_shape):
+# run the NUCLEI model only on the bounding box of the ROI prediction (see inference/cascade.py)
+# the step2 output is then 0 outside of the box; two_models only
+cascade = False
+cascade_margin = 8
 
-    padding = []
-    for pred_dim, orig_dim in zip(pred.shape, original_shape):
-        total_pad = orig_dim - pred_dim
-        pad_before = total_pad // 2
-        pad_after = total_pad - pad_before
-        padding.append((pad_before, pad_after))
+# 'full': int32 predictions padded back to the original size
+# 'cropped': uint8 predictions at their own size, the crop offset is encoded in the affine (see inference/output_writer.py)
+output_mode = 'full'
+output_compresslevel = 1  # gzip level from 1 to 9, 0 writes uncompressed .nii files
 
-    padded_pred = np.pad(pred, padding, mode='constant', constant_values=0)
-
-    return padded_pred
+out_dir = '/path/to/output/directory'
+if not os.path.exists(out_dir):
+    os.makedirs(out_dir)
 
 
 if __name__ == '__main__':
 
-    model_1 = UnetL5(in_dim=num_input_channels, out_dim=2, num_filters=4, output_activation=nn.Sigmoid()).to(device)
-    model_1.eval()
-    model_1.require_grad = False
-
-    model_2 = UnetL5(in_dim=num_input_channels, out_dim=13, num_filters=4, output_activation=nn.Softmax(dim=1)).to(
-        device)
-    model_2.eval()
-    model_2.require_grad = False
+    predict = make_predictor(inference_mode, device, patch_size=patch_size, patch_overlap=patch_overlap,
+                             patch_batch_size=patch_batch_size)
 
     for split_idx in range(8):
 
         split_idx = str(split_idx)
         print('Processing fold ', split_idx)
 
-        checkpoint_1 = os.path.join(checkpoint_dir, 'ROI_model', str(split_idx), 'best_checkpoint.pt')
-        model_1.load_state_dict(torch.load(checkpoint_1)['state_dict'])
-        model_1 = model_1.to(device)
-
-        checkpoint_2 = os.path.join(checkpoint_dir, 'NUCLEI_model', str(split_idx), 'best_checkpoint.pt')
-        model_2.load_state_dict(torch.load(checkpoint_2)['state_dict'])
-        model_2 = model_2.to(device)
+        # models are rebuilt for every fold, BatchNorm folding changes their structure
+        if model_type == 'multitask':
+            checkpoint = os.path.join(checkpoint_dir, 'MULTITASK_model', str(split_idx), 'best_checkpoint.pt')
+            model = MultiTaskUnetL5(in_dim=num_input_channels, roi_dim=2, nuclei_dim=13, num_filters=4)
+            model.load_state_dict(torch.load(checkpoint, map_location='cpu')['state_dict'])
+            model = ConcatenatedHeads(optimize_for_inference(model, device, num_threads=cpu_num_threads))
+        else:
+            checkpoint_1 = os.path.join(checkpoint_dir, 'ROI_model', str(split_idx), 'best_checkpoint.pt')
+            model_1 = UnetL5(in_dim=num_input_channels, out_dim=2, num_filters=4, output_activation=nn.Sigmoid())
+            model_1.load_state_dict(torch.load(checkpoint_1, map_location='cpu')['state_dict'])
+            model_1 = optimize_for_inference(model_1, device, num_threads=cpu_num_threads)
+
+            checkpoint_2 = os.path.join(checkpoint_dir, 'NUCLEI_model', str(split_idx), 'best_checkpoint.pt')
+            model_2 = UnetL5(in_dim=num_input_channels, out_dim=13, num_filters=4, output_activation=nn.Softmax(dim=1))
+            model_2.load_state_dict(torch.load(checkpoint_2, map_location='cpu')['state_dict'])
+            model_2 = optimize_for_inference(model_2, device, num_threads=cpu_num_threads)
 
         test_loaders = ThalamusDataloader(data_dir=data_dir,
                                           label_1_dir=label_1_dir,
                                           label_2_dir=label_2_dir,
                                           batch_size=test_batch_size,
                                           split=split_idx,
-                                          division="test")
+                                          division="test",
+                                          cache_dir=cache_dir,
+                                          crop_size=(96, 96, 96) if inference_mode == 'center_crop' else None)
 
         for batch_idx, (data, target_1, target_2, data_fn, label_1_fn, label_2_fn) in enumerate(test_loaders):
 
@@ -101,50 +97,35 @@ if __name__ == '__main__':
             print('The testing data is ', data_fn_prefix)
 
             # get the prediction from model
-            data = data.type(torch.float32).to(device)
-            target_1 = target_1.type(torch.int32).to(device)
-            target_2 = target_2.type(torch.int32).to(device)
-            pred_1 = model_1(data).to(device)
-            pred_2 = model_2(data).to(device)
-
-            # convert probability to index
-            pred_1_labels = torch.argmax(pred_1, dim=1).type(torch.int32)       # Index [0, 1]
-            pred_2_labels = torch.argmax(pred_2, dim=1).type(torch.int32) + 1   # Index [1, 2, ..., 13]
-
-            # convert tensor to numpy array
-            target_1_arr = target_1.squeeze().detach().cpu().numpy()
-            target_2_arr = target_2.squeeze().detach().cpu().numpy()
-            pred_1_arr = pred_1_labels.squeeze().detach().cpu().numpy()
-            pred_2_arr = pred_2_labels.squeeze().detach().cpu().numpy()
-
-            # remove small connected components for prediction 1
-            foreground_mask = generate_foreground_mask(pred_1_arr)
-            pred_1_arr = pred_1_arr * foreground_mask
+            # in sliding-window mode the full volume stays on the host, only batches of patches are moved to the device
+            data = data.type(torch.float32)
+            target_1_arr = target_1.type(torch.int32).squeeze().numpy()
+            target_2_arr = target_2.type(torch.int32).squeeze().numpy()
+
+            if model_type == 'multitask':
+                # both outputs from a single pass
+                pred_1_arr, pred_2_arr = segment_volume_multitask(model, data[0], predict)
+            else:
+                # NUCLEI model only runs on the padded bounding box of the cleaned ROI prediction in cascade mode
+                pred_1_arr, pred_2_arr = segment_volume(model_1, model_2, data[0], predict, cascade=cascade,
+                                                        cascade_margin=cascade_margin)
 
             # generate final prediction
             pred_comb_arr = pred_1_arr.astype(np.int32) * pred_2_arr.astype(np.int32)
 
-            # get affine matrix and original shape
+            # get affine matrix and original shape from the header of the T1 image
             subject_id, session_id = data_fn_prefix.split('_', 1)
             original_data_folder = os.path.join(original_data_dir, subject_id, session_id)
             t1_files = [f for f in os.listdir(original_data_folder) if 'T1' in f and f.endswith('_wmnorm.nii.gz')]
             if t1_files:
-                t1_file_path = os.path.join(original_data_folder, t1_files[0])
-                affine_matrix = nib.load(t1_file_path).affine
-                original_shape = nib.load(t1_file_path).shape
+                original_shape, affine_matrix = reference_geometry(os.path.join(original_data_folder, t1_files[0]))
             else:
                 raise FileNotFoundError(f"No T1 file found for {subject_id} {session_id}.")
 
-            # pad to predictions to original size
-            pred_1_arr_padded = pad_to_original_size(pred_1_arr, original_shape)
-            pred_2_arr_padded = pad_to_original_size(pred_2_arr, original_shape)
-            pred_comb_arr_padded = pad_to_original_size(pred_comb_arr, original_shape)
-
             # save results
-            nib.save(nib.Nifti1Image(pred_1_arr_padded.astype(np.int32), affine=affine_matrix),
-                     out_dir + '/' + data_fn_prefix + '_model_' + str(split_idx) + '_pred_step1.nii.gz')
-            nib.save(nib.Nifti1Image(pred_2_arr_padded.astype(np.int32), affine=affine_matrix),
-                     out_dir + '/' + data_fn_prefix + '_model_' + str(split_idx) + '_pred_step2.nii.gz')
-            nib.save(nib.Nifti1Image(pred_comb_arr_padded.astype(np.int32), affine=affine_matrix),
-                     out_dir + '/' + data_fn_prefix + '_model_' + str(split_idx) + '_pred_comb.nii.gz')
-
+            out_prefix = out_dir + '/' + data_fn_prefix + '_model_' + str(split_idx)
+            ext = output_ext(output_compresslevel)
+            for pred_arr, suffix in [(pred_1_arr, '_pred_step1'), (pred_2_arr, '_pred_step2'),
+                                     (pred_comb_arr, '_pred_comb')]:
+                save_label(pred_arr, original_shape, affine_matrix, out_prefix + suffix + ext, mode=output_mode,
+                           compresslevel=output_compresslevel)
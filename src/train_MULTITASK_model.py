@@ -0,0 +1,265 @@
+import os
+import sys
+import torch
+import argparse
+import numpy as np
+from tqdm import tqdm
+import torch.optim as optim
+
+sys.path.append('../src')
+from loss import DiceLoss
+from utils.checkpoint_manager import CheckpointManager
+from utils.timing import DataWaitTimer
+from utils.spatial_augmentation import BatchAugmentation
+from utils.device import get_device, autocast_dtype
+from dataloaders.dataloader_test import ThalamusDataloader
+from models.unet3d import MultiTaskUnetL5
+
+roi_gt_values = list(range(2))
+nuclei_gt_values = list(range(1, 14))
+# both labels are packed into one map for the device-side augmentation, NUCLEI labels are below LABEL_BASE
+LABEL_BASE = 16
+device = get_device()
+
+# Fix random seeds
+global_seed = 1234
+torch.manual_seed(global_seed)
+torch.cuda.manual_seed(global_seed)
+torch.cuda.manual_seed_all(global_seed)
+torch.backends.cudnn.benchmark = False
+torch.backends.cudnn.deterministic = True
+np.random.seed(global_seed)
+
+
+def joint_loss(model, data, target_1, target_2, roi_lossfn, nuclei_lossfn, nuclei_weight, amp_dtype=None):
+    """ Dice loss of the ROI head plus `nuclei_weight` times the Dice loss of the NUCLEI head, both in float32. """
+    mask = torch.where(target_2 > 0, torch.tensor([1.0], device=device), torch.tensor([0.0], device=device))
+    mask = mask.unsqueeze(1).expand(-1, 13, -1, -1, -1)
+
+    with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+        pred_1, pred_2 = model(data)
+    roi_loss = roi_lossfn(pred_1.float(), target_1)
+    nuclei_loss = nuclei_lossfn(pred_2.float() * mask, target_2)
+    return roi_loss + nuclei_weight * nuclei_loss, roi_loss, nuclei_loss
+
+
+def train(train_loaders, model, roi_lossfn, nuclei_lossfn, nuclei_weight, optimizer, epoch, scaler, amp_dtype=None,
+          augmentation=None):
+    model.train()
+    progress_bar = tqdm(train_loaders, desc="Training")
+    total_loss, total_roi_loss, total_nuclei_loss = 0.0, 0.0, 0.0
+    timer = DataWaitTimer(device)
+    timer.start()
+
+    for batch_idx, (data, target_1, target_2, _, _, _) in enumerate(progress_bar):
+        timer.data_ready()
+
+        data = data.type(torch.float32).to(device, non_blocking=True)
+        target_1 = target_1.to(device, non_blocking=True).type(torch.float32)
+        target_2 = target_2.to(device, non_blocking=True).type(torch.float32)
+        if augmentation is not None:
+            # both label maps go through the same transformations
+            data, target, _ = augmentation(data, target_1 * LABEL_BASE + target_2, epoch, batch_idx)
+            target_1, target_2 = torch.div(target, LABEL_BASE, rounding_mode='floor'), torch.remainder(target, LABEL_BASE)
+
+        optimizer.zero_grad()
+        loss, roi_loss, nuclei_loss = joint_loss(model, data, target_1, target_2, roi_lossfn, nuclei_lossfn,
+                                                 nuclei_weight, amp_dtype)
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
+
+        total_loss += loss.data.item()
+        total_roi_loss += roi_loss.data.item()
+        total_nuclei_loss += nuclei_loss.data.item()
+        avg_loss = total_loss / (batch_idx + 1)
+        progress_bar.set_description('epoch index {} loss:{:.6f} (ROI {:.6f}, NUCLEI {:.6f})'.format(
+            epoch, avg_loss, total_roi_loss / (batch_idx + 1), total_nuclei_loss / (batch_idx + 1)))
+        timer.step_done()
+
+    print(timer.report('Epoch {} training'.format(epoch)))
+    return avg_loss
+
+
+def val(val_loaders, model, roi_lossfn, nuclei_lossfn, nuclei_weight, epoch, amp_dtype=None):
+
+    model.eval()
+    progress_bar = tqdm(val_loaders, desc='Validation')
+    total_loss = 0.
+    timer = DataWaitTimer(device)
+
+    with torch.no_grad():
+        timer.start()
+        for batch_idx, (data, target_1, target_2, _, _, _) in enumerate(progress_bar):
+            timer.data_ready()
+
+            data = data.type(torch.float32).to(device, non_blocking=True)
+            target_1 = target_1.to(device, non_blocking=True).type(torch.float32)
+            target_2 = target_2.to(device, non_blocking=True).type(torch.float32)
+            loss, _, _ = joint_loss(model, data, target_1, target_2, roi_lossfn, nuclei_lossfn, nuclei_weight,
+                                    amp_dtype)
+
+            total_loss += loss.data.item()
+            avg_loss = total_loss / (batch_idx + 1)
+            progress_bar.set_description('Epoch: {} test loss: {:.6f}'.format(epoch, avg_loss))
+            timer.step_done()
+
+    print(timer.report('Epoch {} validation'.format(epoch)))
+    return avg_loss
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Train the multi-task model (shared encoder, ROI and NUCLEI heads).")
+    parser.add_argument('--data_dir', type=str, default=None,
+                        help='Root folder for the data. If unset, the inputs assembled into --cache_dir are used.')
+    parser.add_argument('--label_1_dir', type=str, required=True, help='Root folder for the binary ROI labels.')
+    parser.add_argument('--label_2_dir', type=str, required=True, help='Root folder for the NUCLEI labels.')
+    parser.add_argument('--nuclei_weight', type=float, default=1.0, help='Weight of the NUCLEI loss in the joint loss.')
+    parser.add_argument('--out_dir', type=str, required=True, help='Folder to save the training results.')
+    parser.add_argument('--split', type=str, required=True, help='Data split for 8 folds.')
+    parser.add_argument('--train_batch_size', type=int, default=1, help='Batch size for training.')
+    parser.add_argument('--val_batch_size', type=int, default=1, help='Batch size for validation.')
+    parser.add_argument('--resume_epoch', type=int, default=-1, help='Epoch to resume training from (default: -1 for none).')
+    parser.add_argument('--keep_last', type=int, default=3, help='Most recent epoch checkpoints to keep (-1: all).')
+    parser.add_argument('--keep_best', type=int, default=1, help='Epoch checkpoints with the lowest val loss to keep.')
+    parser.add_argument('--plot_every', type=int, default=1, help='Plot the losses every n epochs (0: never).')
+    parser.add_argument('--epochs', type=int, default=100, help='Number of training epochs.')
+    parser.add_argument('--lr', type=float, default=1e-3, help='Learning rate.')
+    parser.add_argument('--wd', type=float, default=1e-4, help='Weight decay.')
+    parser.add_argument('--num_in', type=int, default=68, help='Number of input channels.')
+    parser.add_argument('--device', type=str, default=None,
+                        help="Device to train on, e.g. 'cuda', 'cuda:1' or 'cpu' (default: $RATNUS_DEVICE or auto).")
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Folder of the cropped volume cache (see dataloaders/volume_cache.py). Disabled if unset.')
+    parser.add_argument('--cache_dtype', type=str, default='float32', choices=['float32', 'float16'],
+                        help='Storage dtype of the cached data volumes.')
+    parser.add_argument('--chunk_dir', type=str, default=None,
+                        help='Per-channel chunk store of the data (see dataloaders/chunk_store.py), built on first use.')
+    parser.add_argument('--channels', type=int, nargs='+', default=None,
+                        help='Indices of the input channels to train on (default: all); sets --num_in.')
+    parser.add_argument('--num_workers', type=int, default=8, help='Number of dataloader worker processes.')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='Batches prefetched by each worker.')
+    parser.add_argument('--pin_memory', action=argparse.BooleanOptionalAction, default=True,
+                        help='Use page-locked host memory for faster host-to-device copies.')
+    parser.add_argument('--persistent_workers', action=argparse.BooleanOptionalAction, default=True,
+                        help='Keep the dataloader workers alive across epochs.')
+    parser.add_argument('--augment', type=str, default='none', choices=['none', 'device'],
+                        help="Spatial augmentation of the training volumes, 'device' runs it batch-wise on the training "
+                             "device.")
+    parser.add_argument('--amp', action='store_true',
+                        help='Mixed-precision training: float16 autocast with loss scaling on CUDA, bfloat16 on the CPU.')
+    parser.add_argument('--grad_checkpoint', action='store_true',
+                        help='Recompute the UnetL5 conv blocks in the backward pass instead of storing their activations.')
+    args = parser.parse_args()
+    if args.data_dir is None and args.cache_dir is None:
+        parser.error('--cache_dir with assembled inputs (dataloaders/feature_assembly.py) is required without --data_dir.')
+    device = get_device(args.device)
+    if args.channels is not None:
+        args.num_in = len(args.channels)
+
+    print("=="*50)
+    print("Eight Fold Experiment Split ", args.split)
+    print("=="*50)
+
+    # creating folders to save results
+    if not os.path.exists(args.out_dir):
+        print('creating:', args.out_dir)
+        os.makedirs(args.out_dir)
+
+    split_dir = os.path.join(args.out_dir, args.split)
+    if not os.path.exists(split_dir):
+        print('creating:', split_dir)
+        os.mkdir(split_dir)
+
+    checkpoint_dir = os.path.join(split_dir, 'checkpoint')
+    if not os.path.exists(checkpoint_dir):
+        print('creating:', checkpoint_dir)
+        os.mkdir(checkpoint_dir)
+
+    # model, loss, optimizer, scheduler and early stop
+    model = MultiTaskUnetL5(in_dim=args.num_in, roi_dim=2, nuclei_dim=13, num_filters=4,
+                            use_checkpoint=args.grad_checkpoint).to(device)
+    roi_lossfn = DiceLoss(num_classes=2, isOneHot=False, gt_values=roi_gt_values, isPlotPerChannelLoss=False)
+    nuclei_lossfn = DiceLoss(num_classes=13, isOneHot=False, gt_values=nuclei_gt_values, isPlotPerChannelLoss=False)
+    optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.wd)
+    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=5, factor=0.9)
+
+    # mixed precision, loss scaling is only needed (and enabled) for float16
+    amp_dtype = autocast_dtype(device) if args.amp else None
+    scaler = torch.amp.GradScaler(device.type, enabled=amp_dtype == torch.float16)
+
+    # device-side augmentation, the details of every sample go to augmentations.log
+    augmentation = None
+    if args.augment == 'device':
+        augmentation = BatchAugmentation(np.random.RandomState(global_seed),
+                                         log_path=os.path.join(split_dir, 'augmentations.log'))
+
+    # full-state checkpoints (model, optimizer, scheduler, scaler, random generators, losses), written in the background
+    random_states = {'augmentation': augmentation.compose.random_state} if augmentation is not None else None
+    checkpoints = CheckpointManager(checkpoint_dir, split_dir, keep_last=args.keep_last if args.keep_last >= 0 else None,
+                                    keep_best=args.keep_best, plot_every=args.plot_every, random_states=random_states)
+
+    # whether resume training
+    startEpoch = -1
+    if args.resume_epoch > 0:
+        print("Resume Training from %d" % args.resume_epoch)
+        startEpoch = args.resume_epoch
+        train_losses, val_losses = checkpoints.load(args.resume_epoch, model, optimizer, scheduler, scaler,
+                                                    map_location=device)
+    else:
+        train_losses, val_losses = [], []
+
+    # dataloaders are built once and reused by every epoch
+    train_loaders = ThalamusDataloader(data_dir=args.data_dir,
+                                       label_1_dir=args.label_1_dir,
+                                       label_2_dir=args.label_2_dir,
+                                       batch_size=args.train_batch_size,
+                                       split=args.split,
+                                       division="train",
+                                       shuffle=True,
+                                       num_workers=args.num_workers,
+                                       cache_dir=args.cache_dir,
+                                       cache_dtype=args.cache_dtype,
+                                       pin_memory=args.pin_memory and device.type == 'cuda',
+                                       prefetch_factor=args.prefetch_factor,
+                                       persistent_workers=args.persistent_workers,
+                                       chunk_dir=args.chunk_dir,
+                                       channels=args.channels)
+
+    val_loaders = ThalamusDataloader(data_dir=args.data_dir,
+                                     label_1_dir=args.label_1_dir,
+                                     label_2_dir=args.label_2_dir,
+                                     batch_size=args.val_batch_size,
+                                     split=args.split,
+                                     division="val",
+                                     num_workers=args.num_workers,
+                                     cache_dir=args.cache_dir,
+                                     cache_dtype=args.cache_dtype,
+                                     pin_memory=args.pin_memory and device.type == 'cuda',
+                                     prefetch_factor=args.prefetch_factor,
+                                     persistent_workers=args.persistent_workers,
+                                     chunk_dir=args.chunk_dir,
+                                     channels=args.channels)
+
+    # start training
+    for epoch in range(startEpoch+1, args.epochs):
+
+        # train model
+        train_avg_loss = train(train_loaders, model, roi_lossfn, nuclei_lossfn, args.nuclei_weight, optimizer, epoch,
+                               scaler, amp_dtype, augmentation)
+        train_losses.append(train_avg_loss)
+
+        # test model
+        val_avg_loss = val(val_loaders, model, roi_lossfn, nuclei_lossfn, args.nuclei_weight, epoch, amp_dtype)
+        val_losses.append(val_avg_loss)
+
+        # adjust lr
+        scheduler.step(val_avg_loss)
+
+        # full state, best model, losses and plot, written in the background
+        checkpoints.save(epoch, model, optimizer, scheduler, scaler, train_losses, val_losses)
+
+    checkpoints.close()
+    if augmentation is not None:
+        augmentation.close()
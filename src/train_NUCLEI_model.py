@@ -4,18 +4,22 @@ import torch
 import argparse
 import numpy as np
 from tqdm import tqdm
-import matplotlib.pyplot as plt
 import torch.optim as optim
 import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel as DDP
 
 sys.path.append('../src')
 from loss import DiceLoss
-from utils.save_best_model import SaveBestModel
+from utils.checkpoint_manager import CheckpointManager
+from utils.timing import DataWaitTimer
+from utils.spatial_augmentation import BatchAugmentation
+from utils.device import get_device, autocast_dtype
+from utils.distributed import init_distributed, is_main_process, get_rank, average, cleanup_distributed
 from dataloaders.dataloader_train import ThalamusDataloader
 from models.unet3d import UnetL5
 
 gt_values = list(range(1, 14))
-device = torch.device("cuda")
+device = get_device()
 
 # Fix random seeds
 global_seed = 1234
@@ -27,176 +31,256 @@ torch.backends.cudnn.deterministic = True
 np.random.seed(global_seed)
 
 
-def train(train_loaders, model, lossfn, optimizer, epoch):
+def train(train_loaders, model, lossfn, optimizer, epoch, scaler, amp_dtype=None, augmentation=None):
     model.train()
-    progress_bar = tqdm(train_loaders, desc="Training")
+    progress_bar = tqdm(train_loaders, desc="Training", disable=not is_main_process())
     total_loss = 0.0
+    timer = DataWaitTimer(device)
+    timer.start()
 
     for batch_idx, (data, target) in enumerate(progress_bar):
+        timer.data_ready()
 
-        data = data.type(torch.float32).to(device)
-        target = target.type(torch.float32).to(device)
+        data = data.type(torch.float32).to(device, non_blocking=True)
+        target = target.to(device, non_blocking=True).type(torch.float32)
+        if augmentation is not None:
+            data, target, _ = augmentation(data, target, epoch, batch_idx)
         mask = torch.where(target > 0, torch.tensor([1.0], device=device), torch.tensor([0.0], device=device))
         mask = mask.unsqueeze(1).expand(-1, 13, -1, -1, -1)
 
         optimizer.zero_grad()
-        pred = model(data)
-        pred = pred * mask
+        with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+            pred = model(data)
+        # the loss is computed in float32 also under autocast
+        pred = pred.float() * mask
 
         loss = lossfn(pred, target)
-        loss.backward()
-        optimizer.step()
+        scaler.scale(loss).backward()
+        scaler.step(optimizer)
+        scaler.update()
 
         total_loss += loss.data.item()
         avg_loss = total_loss / (batch_idx + 1)
         progress_bar.set_description('epoch index {} loss:{:.6f}'.format(epoch,  avg_loss))
+        timer.step_done()
 
+    # mean over the batches of all ranks in distributed training
+    avg_loss = average(total_loss, batch_idx + 1, device)
+    if is_main_process():
+        print(timer.report('Epoch {} training'.format(epoch)))
     return avg_loss
 
 
-def val(val_loaders, model, lossfn, epoch):
+def val(val_loaders, model, lossfn, epoch, amp_dtype=None):
 
     model.eval()
-    progress_bar = tqdm(val_loaders, desc='Validation')
+    progress_bar = tqdm(val_loaders, desc='Validation', disable=not is_main_process())
     total_loss = 0.
+    timer = DataWaitTimer(device)
 
     with torch.no_grad():
+        timer.start()
         for batch_idx, (data, target) in enumerate(progress_bar):
+            timer.data_ready()
 
-            data = data.type(torch.float32).to(device)
-            target = target.type(torch.float32).to(device)
+            data = data.type(torch.float32).to(device, non_blocking=True)
+            target = target.to(device, non_blocking=True).type(torch.float32)
             mask = torch.where(target > 0, torch.tensor([1.0], device=device), torch.tensor([0.0], device=device))
             mask = mask.unsqueeze(1).expand(-1, 13, -1, -1, -1)
 
-            pred = model(data)
-            pred = pred * mask
+            with torch.autocast(device.type, dtype=amp_dtype, enabled=amp_dtype is not None):
+                pred = model(data)
+            pred = pred.float() * mask
             loss = lossfn(pred, target)
 
             total_loss += loss.data.item()
             avg_loss = total_loss / (batch_idx + 1)
             progress_bar.set_description('Epoch: {} test loss: {:.6f}'.format(epoch, avg_loss))
+            timer.step_done()
 
+    # the val set is not sharded, every rank has the loss over all subjects
+    if is_main_process():
+        print(timer.report('Epoch {} validation'.format(epoch)))
     return avg_loss
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description="Train NUCLEI model.")
-    parser.add_argument('--data_dir', type=str, required=True, help='Root folder for the data.')
+    parser.add_argument('--data_dir', type=str, default=None,
+                        help='Root folder for the data. If unset, the inputs assembled into --cache_dir are used.')
     parser.add_argument('--label_dir', type=str, required=True, help='Root folder for the ground truth labels.')
     parser.add_argument('--out_dir', type=str, required=True, help='Folder to save the training results.')
     parser.add_argument('--split', type=str, required=True, help='Data split for 8 folds.')
     parser.add_argument('--train_batch_size', type=int, default=1, help='Batch size for training.')
     parser.add_argument('--val_batch_size', type=int, default=1, help='Batch size for validation.')
     parser.add_argument('--resume_epoch', type=int, default=-1, help='Epoch to resume training from (default: -1 for none).')
+    parser.add_argument('--keep_last', type=int, default=3, help='Most recent epoch checkpoints to keep (-1: all).')
+    parser.add_argument('--keep_best', type=int, default=1, help='Epoch checkpoints with the lowest val loss to keep.')
+    parser.add_argument('--plot_every', type=int, default=1, help='Plot the losses every n epochs (0: never).')
     parser.add_argument('--epochs', type=int, default=100, help='Number of training epochs.')
     parser.add_argument('--lr', type=float, default=1e-3, help='Learning rate.')
     parser.add_argument('--wd', type=float, default=1e-4, help='Weight decay.')
     parser.add_argument('--num_in', type=int, default=68, help='Number of input channels.')
+    parser.add_argument('--device', type=str, default=None,
+                        help="Device to train on, e.g. 'cuda', 'cuda:1' or 'cpu' (default: $RATNUS_DEVICE or auto).")
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='Folder of the cropped volume cache (see dataloaders/volume_cache.py). Disabled if unset.')
+    parser.add_argument('--cache_dtype', type=str, default='float32', choices=['float32', 'float16'],
+                        help='Storage dtype of the cached data volumes.')
+    parser.add_argument('--chunk_dir', type=str, default=None,
+                        help='Per-channel chunk store of the data (see dataloaders/chunk_store.py), built on first use.')
+    parser.add_argument('--channels', type=int, nargs='+', default=None,
+                        help='Indices of the input channels to train on (default: all); sets --num_in.')
+    parser.add_argument('--num_workers', type=int, default=8, help='Number of dataloader worker processes.')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='Batches prefetched by each worker.')
+    parser.add_argument('--pin_memory', action=argparse.BooleanOptionalAction, default=True,
+                        help='Use page-locked host memory for faster host-to-device copies.')
+    parser.add_argument('--persistent_workers', action=argparse.BooleanOptionalAction, default=True,
+                        help='Keep the dataloader workers alive across epochs.')
+    parser.add_argument('--augment', type=str, default='none', choices=['none', 'worker', 'device'],
+                        help="Spatial augmentation of the training volumes: 'worker' runs it in the dataloader workers, "
+                             "'device' batch-wise on the training device.")
+    parser.add_argument('--augment_backend', type=str, default='torch', choices=['torch', 'scipy'],
+                        help='Resampling of the augmentation: grid_sample (trilinear) or map_coordinates (cubic).')
+    parser.add_argument('--amp', action='store_true',
+                        help='Mixed-precision training: float16 autocast with loss scaling on CUDA, bfloat16 on the CPU.')
+    parser.add_argument('--grad_checkpoint', action='store_true',
+                        help='Recompute the UnetL5 conv blocks in the backward pass instead of storing their activations.')
+    parser.add_argument('--distributed', action='store_true',
+                        help='DistributedDataParallel training, one process per device: torchrun --nproc_per_node 2 train_NUCLEI_model.py --distributed ...')
+    parser.add_argument('--dist_backend', type=str, default=None, choices=['nccl', 'gloo'],
+                        help='Process group backend (default: nccl on CUDA, gloo on the CPU).')
     args = parser.parse_args()
+    if args.data_dir is None and args.cache_dir is None:
+        parser.error('--cache_dir with assembled inputs (dataloaders/feature_assembly.py) is required without --data_dir.')
+    device = get_device(args.device)
+    if args.distributed:
+        device = init_distributed(device, args.dist_backend)
+        # different augmentations on every rank; DDP broadcasts the initial weights of rank 0
+        torch.manual_seed(global_seed + get_rank())
+        np.random.seed(global_seed + get_rank())
+    if args.channels is not None:
+        args.num_in = len(args.channels)
 
-    print("=="*50)
-    print("Eight Fold Experiment Split ", args.split)
-    print("=="*50)
+    split_dir = os.path.join(args.out_dir, args.split)
+    checkpoint_dir = os.path.join(split_dir, 'checkpoint')
+    if is_main_process():
+        print("=="*50)
+        print("Eight Fold Experiment Split ", args.split)
+        print("=="*50)
 
-    # creating folders to save results
-    if not os.path.exists(args.out_dir):
-        print('creating:', args.out_dir)
-        os.makedirs(args.out_dir)
+        # creating folders to save results
+        if not os.path.exists(args.out_dir):
+            print('creating:', args.out_dir)
+            os.makedirs(args.out_dir)
 
-    split_dir = os.path.join(args.out_dir, args.split)
-    if not os.path.exists(split_dir):
-        print('creating:', split_dir)
-        os.mkdir(split_dir)
+        if not os.path.exists(split_dir):
+            print('creating:', split_dir)
+            os.mkdir(split_dir)
 
-    checkpoint_dir = os.path.join(split_dir, 'checkpoint')
-    if not os.path.exists(checkpoint_dir):
-        print('creating:', checkpoint_dir)
-        os.mkdir(checkpoint_dir)
+        if not os.path.exists(checkpoint_dir):
+            print('creating:', checkpoint_dir)
+            os.mkdir(checkpoint_dir)
 
     # model, loss, optimizer, scheduler and early stop
-    model = UnetL5(in_dim=args.num_in, out_dim=13, num_filters=4, output_activation=nn.Softmax(dim=1)).to(device)
+    model = UnetL5(in_dim=args.num_in, out_dim=13, num_filters=4, output_activation=nn.Softmax(dim=1),
+                   use_checkpoint=args.grad_checkpoint).to(device)
     lossfn = DiceLoss(num_classes=13, isOneHot=False, gt_values=gt_values, isPlotPerChannelLoss=False)
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.wd)
     scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=5, factor=0.9)
-    save_best_model = SaveBestModel(verbose=True, save_path=split_dir)
+
+    # mixed precision, loss scaling is only needed (and enabled) for float16
+    amp_dtype = autocast_dtype(device) if args.amp else None
+    scaler = torch.amp.GradScaler(device.type, enabled=amp_dtype == torch.float16)
+
+    # device-side augmentation, the details of every sample go to augmentations.log
+    augmentation = None
+    if args.augment == 'device':
+        augmentation = BatchAugmentation(np.random.RandomState(global_seed + get_rank()),
+                                         log_path=os.path.join(split_dir, 'augmentations.log') if is_main_process() else None)
+
+    # full-state checkpoints (model, optimizer, scheduler, scaler, random generators, losses), written in the background
+    random_states = {'augmentation': augmentation.compose.random_state} if augmentation is not None else None
+    checkpoints = CheckpointManager(checkpoint_dir, split_dir, keep_last=args.keep_last if args.keep_last >= 0 else None,
+                                    keep_best=args.keep_best, plot_every=args.plot_every, random_states=random_states)
 
     # whether resume training
     startEpoch = -1
     if args.resume_epoch > 0:
         print("Resume Training from %d" % args.resume_epoch)
         startEpoch = args.resume_epoch
-        resumed_checkpoint = os.path.join(checkpoint_dir, str(args.resume_epoch) + '.pt')
-        resume_state = torch.load(resumed_checkpoint, map_location=device)
-        model.load_state_dict(resume_state['state_dict'])
-        train_losses = resume_state['train_losses']
-        val_losses = resume_state['test_losses']
+        # in distributed training every rank keeps its own random streams
+        train_losses, val_losses = checkpoints.load(args.resume_epoch, model, optimizer, scheduler, scaler,
+                                                    map_location=device, restore_rng=not args.distributed)
     else:
         train_losses, val_losses = [], []
 
+    # checkpoints hold the bare model, without the DDP wrapper
+    model_to_save = model
+    if args.distributed:
+        model = DDP(model, device_ids=[device.index] if device.type == 'cuda' else None)
+
+    # dataloaders are built once and reused by every epoch
+    train_loaders = ThalamusDataloader(data_dir=args.data_dir,
+                                       label_dir=args.label_dir,
+                                       batch_size=args.train_batch_size,
+                                       split=args.split,
+                                       division="train",
+                                       shuffle=True,
+                                       num_workers=args.num_workers,
+                                       cache_dir=args.cache_dir,
+                                       cache_dtype=args.cache_dtype,
+                                       pin_memory=args.pin_memory and device.type == 'cuda',
+                                       prefetch_factor=args.prefetch_factor,
+                                       persistent_workers=args.persistent_workers,
+                                       augment=args.augment == 'worker',
+                                       augment_backend=args.augment_backend,
+                                       chunk_dir=args.chunk_dir,
+                                       channels=args.channels,
+                                       distributed=args.distributed)
+
+    # not sharded: a DistributedSampler pads the small val split with duplicates when the ranks do not divide it, which
+    # would bias the val loss that drives the scheduler and the checkpoint selection. Every rank evaluates all subjects.
+    val_loaders = ThalamusDataloader(data_dir=args.data_dir,
+                                     label_dir=args.label_dir,
+                                     batch_size=args.val_batch_size,
+                                     split=args.split,
+                                     division="val",
+                                     num_workers=args.num_workers,
+                                     cache_dir=args.cache_dir,
+                                     cache_dtype=args.cache_dtype,
+                                     pin_memory=args.pin_memory and device.type == 'cuda',
+                                     prefetch_factor=args.prefetch_factor,
+                                     persistent_workers=args.persistent_workers,
+                                     chunk_dir=args.chunk_dir,
+                                     channels=args.channels)
+
     # start training
     for epoch in range(startEpoch+1, args.epochs):
 
-        train_loaders = ThalamusDataloader(data_dir=args.data_dir,
-                                           label_dir=args.label_dir,
-                                           batch_size=args.train_batch_size,
-                                           split=args.split,
-                                           division="train",
-                                           shuffle=True)
-
-        val_loaders = ThalamusDataloader(data_dir=args.data_dir,
-                                         label_dir=args.label_dir,
-                                         batch_size=args.val_batch_size,
-                                         split=args.split,
-                                         division="val")
+        if args.distributed:
+            train_loaders.sampler.set_epoch(epoch)
 
         # train model
-        train_avg_loss = train(train_loaders, model, lossfn, optimizer, epoch)
+        train_avg_loss = train(train_loaders, model, lossfn, optimizer, epoch, scaler, amp_dtype, augmentation)
         train_losses.append(train_avg_loss)
 
         # test model
-        val_avg_loss = val(val_loaders, model, lossfn, epoch)
+        val_avg_loss = val(val_loaders, model, lossfn, epoch, amp_dtype)
         val_losses.append(val_avg_loss)
 
         # adjust lr
         scheduler.step(val_avg_loss)
 
-        # save model/checkpoint
-        state = {'state_dict': model.state_dict(),
-                 'train_losses': train_losses,
-                 'val_losses': val_losses}
-        torch.save(state, os.path.join(checkpoint_dir, str(epoch) + '.pt'))
-        save_best_model(val_avg_loss, model, train_losses, val_losses, epoch)
-
-        # save train loss and test loss for each epoch
-        np.savez(os.path.join(split_dir, 'train_losses.npz'), train_losses)
-        np.savez(os.path.join(split_dir, 'val_losses.npz'), val_losses)
-
-        # plot training and testing loss
-        fig = plt.figure(figsize=(20, 24))
-        ax1 = fig.add_subplot(311)
-        ax2 = fig.add_subplot(312)
-        ax3 = fig.add_subplot(313)
-
-        ax1.plot(train_losses, color='darkred', marker='o')
-        ax1.set_title('train loss')
-        ax1.set_xlabel('epoch')
-        ax1.set_ylabel('loss')
-
-        ax2.plot(val_losses, color='b', marker='o')
-        ax2.set_title('val loss')
-        ax2.set_xlabel('epoch')
-        ax2.set_ylabel('loss')
-
-        ax3.plot(train_losses, color='darkred', marker='o')
-        ax3.plot(val_losses, color='b', marker='o')
-        ax3.set_title('training and validation loss')
-        ax3.set_xlabel('epoch')
-        ax3.set_ylabel('loss')
-        ax3.legend(['train', 'val'])
-
-        plt.tight_layout()
-        plt.savefig(os.path.join(split_dir, 'losses.png'))
-        plt.close(fig)
+        # checkpoints, losses and plots are written by rank 0 only
+        if not is_main_process():
+            continue
 
+        # full state, best model, losses and plot, written in the background
+        checkpoints.save(epoch, model_to_save, optimizer, scheduler, scaler, train_losses, val_losses)
 
+    checkpoints.close()
+    if augmentation is not None:
+        augmentation.close()
+    cleanup_distributed()
@@ -0,0 +1,269 @@
+"""
+Train the ROI and NUCLEI models of all 8 folds of config_split in one run.
+
+The 24 subjects are decoded and center-cropped once, into shared-memory tensors that every training process reads
+without copying. The 16 jobs (8 folds x 2 models) run in a pool of --jobs processes; job i gets device
+--devices[i % len(devices)] and, on the CPU, --threads_per_job intra-op threads. Every job runs the train/val loops of
+train_ROI_model.py or train_NUCLEI_model.py with their default hyperparameters, and writes
+    out_dir/ROI_model/<fold>/best_checkpoint.pt, train_losses.npz, val_losses.npz, train.log
+    out_dir/NUCLEI_model/<fold>/...
+which is the checkpoint layout read by test.py and predict.py. The wall time and best validation loss of every job go
+to out_dir/cv_summary.json; a failed job does not stop the others and is listed there with its error and log.
+
+--synthetic replaces the data by a small random dataset, e.g. for a quick run on the CPU: 4 channels at 64^3, the smallest
+size whose UnetL5 bridge still has more than one value per channel for BatchNorm at batch size 1.
+
+Usage (run from src):
+    python train_cross_validation.py --data_dir /path/to/data --label_1_dir /path/to/binary/labels \
+                                     --label_2_dir /path/to/labels --out_dir /path/to/output --jobs 4 \
+                                     --devices cuda:0 cuda:1
+    python train_cross_validation.py --synthetic --out_dir /tmp/cv --jobs 4 --devices cpu --epochs 2
+"""
+
+
+import os
+import sys
+import json
+import time
+import argparse
+import importlib
+import traceback
+from contextlib import redirect_stdout, redirect_stderr
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import torch
+import torch.nn as nn
+import numpy as np
+import torch.multiprocessing as mp
+from torch.utils.data import Dataset, DataLoader
+
+sys.path.append('../src')
+from loss import DiceLoss
+from models.unet3d import UnetL5
+from utils.save_best_model import SaveBestModel
+from utils.device import get_device
+from dataloaders.dataloader_train import config_split
+from dataloaders.volume_cache import read_cropped_data, read_cropped_label
+
+# training script, output channels, output activation, label set and training batch size of each model
+MODEL_CONFIGS = {
+    'ROI': {'script': 'train_ROI_model', 'out_dim': 2, 'activation': lambda: nn.Sigmoid(), 'label': 'label_1',
+            'train_batch_size': 4},
+    'NUCLEI': {'script': 'train_NUCLEI_model', 'out_dim': 13, 'activation': lambda: nn.Softmax(dim=1),
+               'label': 'label_2', 'train_batch_size': 1},
+}
+
+# shared subject tensors of a training process, set by init_worker
+SUBJECTS = None
+
+
+class SharedSubjects(Dataset):
+    """ The subjects `indices` of the shared tensors, as (data, label) pairs like dataloader_train.ThalamusDataset. """
+
+    def __init__(self, data, label, indices):
+        super(SharedSubjects, self).__init__()
+        self.data = data
+        self.label = label
+        self.indices = list(indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        index = self.indices[idx]
+        return self.data[index].float(), self.label[index].int()
+
+
+def load_subjects(data_dir, label_1_dir, label_2_dir, crop_size=(96, 96, 96), dtype='float32'):
+    """ Decode the center crops of all subjects once, as shared-memory tensors [N, C, H, W, L] and [N, H, W, L]. """
+    data_fns = sorted(os.listdir(data_dir))
+    label_1_fns = sorted(os.listdir(label_1_dir))
+    label_2_fns = sorted(os.listdir(label_2_dir))
+    # subjects are matched by position, as in dataloader_train.ThalamusDataset
+    assert len(data_fns) == len(label_1_fns) == len(label_2_fns), \
+        '{} data, {} ROI label and {} NUCLEI label files'.format(len(data_fns), len(label_1_fns), len(label_2_fns))
+    for data_fn, label_1_fn, label_2_fn in zip(data_fns, label_1_fns, label_2_fns):
+        assert data_fn.split('_')[0] == label_1_fn.split('_')[0] == label_2_fn.split('_')[0], \
+            'subjects do not match: {}, {}, {}'.format(data_fn, label_1_fn, label_2_fn)
+    data = torch.stack([torch.from_numpy(read_cropped_data(os.path.join(data_dir, fn), crop_size, dtype=dtype))
+                        for fn in data_fns])
+    label_1 = torch.stack([torch.from_numpy(read_cropped_label(os.path.join(label_1_dir, fn), crop_size))
+                           for fn in label_1_fns])
+    label_2 = torch.stack([torch.from_numpy(read_cropped_label(os.path.join(label_2_dir, fn), crop_size))
+                           for fn in label_2_fns])
+    return {'data': data.share_memory_(), 'label_1': label_1.share_memory_(), 'label_2': label_2.share_memory_()}
+
+
+def synthetic_subjects(num_subjects=24, num_in=4, size=64, seed=0):
+    """ Random volumes with a two-sided ROI and 13 nuclei labels inside it, as shared-memory tensors. """
+    rng = np.random.RandomState(seed)
+    grid = np.stack(np.meshgrid(*[np.arange(size)] * 3, indexing='ij'), axis=0)
+    data = np.zeros((num_subjects, num_in, size, size, size), dtype=np.float32)
+    label_1 = np.zeros((num_subjects, size, size, size), dtype=np.int8)
+    label_2 = np.zeros((num_subjects, size, size, size), dtype=np.int8)
+
+    for i in range(num_subjects):
+        for side in (-1, 1):
+            center = np.array([size / 2 + side * size / 6, size / 2, size / 2]) + rng.uniform(-1, 1, size=3)
+            roi = (((grid - center[:, None, None, None]) / (size / 8)) ** 2).sum(axis=0) <= 1
+            label_1[i][roi] = 1
+        # nuclei: slabs of the ROI along the second axis
+        nuclei = np.clip((grid[1] - size // 2 + size // 8) * 13 // (size // 4), 0, 12) + 1
+        label_2[i] = np.where(label_1[i] > 0, nuclei, 0)
+        data[i] = rng.randn(num_in, size, size, size) * 0.1 + label_2[i] / 13.
+
+    return {'data': torch.from_numpy(data).share_memory_(), 'label_1': torch.from_numpy(label_1).share_memory_(),
+            'label_2': torch.from_numpy(label_2).share_memory_()}
+
+
+def init_worker(subjects):
+    global SUBJECTS
+    SUBJECTS = subjects
+
+
+def train_fold(model_name, split, device_name, out_dir, epochs=100, lr=1e-3, wd=1e-4, threads=None):
+    """
+    Train one model of one fold on the shared subjects, in a pool process. The output of the training loops goes to
+    train.log in the job folder. Returns the summary of the job.
+    """
+    config = MODEL_CONFIGS[model_name]
+    job_dir = os.path.join(out_dir, model_name + '_model', split)
+    os.makedirs(job_dir, exist_ok=True)
+    log_path = os.path.join(job_dir, 'train.log')
+    start = time.perf_counter()
+
+    with open(log_path, 'w') as log, redirect_stdout(log), redirect_stderr(log):
+        try:
+            device = get_device(device_name)
+            if threads is not None and device.type == 'cpu':
+                torch.set_num_threads(threads)
+
+            # the train/val loops of the training script, which run on its module-level device
+            script = importlib.import_module(config['script'])
+            script.device = device
+
+            data, label = SUBJECTS['data'], SUBJECTS[config['label']]
+            train_loaders = DataLoader(SharedSubjects(data, label, config_split[split]['train_idxs']),
+                                       batch_size=config['train_batch_size'], shuffle=True)
+            val_loaders = DataLoader(SharedSubjects(data, label, config_split[split]['val_idxs']), batch_size=1)
+
+            model = UnetL5(in_dim=data.shape[1], out_dim=config['out_dim'], num_filters=4,
+                           output_activation=config['activation']()).to(device)
+            lossfn = DiceLoss(num_classes=config['out_dim'], isOneHot=False, gt_values=script.gt_values,
+                              isPlotPerChannelLoss=False)
+            optimizer = torch.optim.Adam(model.parameters(), lr=lr, weight_decay=wd)
+            scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min', patience=5, factor=0.9)
+            save_best_model = SaveBestModel(verbose=True, save_path=job_dir)
+            scaler = torch.amp.GradScaler(device.type, enabled=False)
+
+            train_losses, val_losses = [], []
+            best_epoch = None
+            for epoch in range(epochs):
+                train_losses.append(script.train(train_loaders, model, lossfn, optimizer, epoch, scaler))
+                val_avg_loss = script.val(val_loaders, model, lossfn, epoch)
+                val_losses.append(val_avg_loss)
+                scheduler.step(val_avg_loss)
+                if val_avg_loss < save_best_model.val_loss_min:
+                    best_epoch = epoch
+                save_best_model(val_avg_loss, model, train_losses, val_losses, epoch)
+                np.savez(os.path.join(job_dir, 'train_losses.npz'), train_losses)
+                np.savez(os.path.join(job_dir, 'val_losses.npz'), val_losses)
+        except Exception:
+            # the traceback goes to the job log, the error itself to the summary by run_cross_validation
+            traceback.print_exc()
+            raise
+
+    return {'model': model_name,
+            'fold': split,
+            'device': str(device),
+            'wall_seconds': time.perf_counter() - start,
+            'best_val_loss': float(min(val_losses)),
+            'best_epoch': best_epoch,
+            'epochs': epochs,
+            'log': log_path}
+
+
+def run_cross_validation(subjects, out_dir, jobs, devices, models=('ROI', 'NUCLEI'), folds=None, epochs=100,
+                         threads_per_job=None):
+    """
+    Run all (fold, model) jobs with at most `jobs` at a time; returns their summaries in completion order. A failed job
+    does not stop the others, its summary holds the error and the path of its log instead of the losses.
+    """
+    folds = sorted(config_split) if folds is None else [str(fold) for fold in folds]
+    tasks = [(model_name, split) for split in folds for model_name in models]
+    results = []
+
+    # spawn, so that CUDA can be initialized in every process; the shared tensors are passed by handle, not copied
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=mp.get_context('spawn'), initializer=init_worker,
+                             initargs=(subjects,)) as pool:
+        futures = {pool.submit(train_fold, model_name, split, devices[i % len(devices)], out_dir, epochs,
+                               threads=threads_per_job): (i, model_name, split)
+                   for i, (model_name, split) in enumerate(tasks)}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as error:
+                i, model_name, split = futures[future]
+                result = {'model': model_name,
+                          'fold': split,
+                          'device': devices[i % len(devices)],
+                          'error': '{}: {}'.format(type(error).__name__, error),
+                          'log': os.path.join(out_dir, model_name + '_model', split, 'train.log')}
+                print('{model:6s} fold {fold}  {device:6s}  failed: {error}, see {log}'.format(**result), flush=True)
+            else:
+                print('{model:6s} fold {fold}  {device:6s}  {wall_seconds:8.1f}s  best val loss {best_val_loss:.6f} '
+                      '(epoch {best_epoch})'.format(**result), flush=True)
+            results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Train the ROI and NUCLEI models of all folds concurrently.")
+    parser.add_argument('--data_dir', type=str, default=None, help='Root folder for the data.')
+    parser.add_argument('--label_1_dir', type=str, default=None, help='Root folder for the binary ROI labels.')
+    parser.add_argument('--label_2_dir', type=str, default=None, help='Root folder for the NUCLEI labels.')
+    parser.add_argument('--synthetic', action='store_true', help='Train on a tiny random dataset instead.')
+    parser.add_argument('--out_dir', type=str, required=True, help='Folder to save the training results.')
+    parser.add_argument('--jobs', type=int, default=2, help='Jobs trained concurrently.')
+    parser.add_argument('--devices', type=str, nargs='+', default=['auto'],
+                        help="Devices the jobs are assigned to round-robin, e.g. 'cuda:0 cuda:1' or 'cpu'.")
+    parser.add_argument('--threads_per_job', type=int, default=None, help='Intra-op threads of each CPU job.')
+    parser.add_argument('--models', type=str, nargs='+', default=['ROI', 'NUCLEI'], choices=sorted(MODEL_CONFIGS),
+                        help='Models to train.')
+    parser.add_argument('--folds', type=int, nargs='+', default=None, help='Folds to train (default: all 8).')
+    parser.add_argument('--epochs', type=int, default=100, help='Number of training epochs.')
+    parser.add_argument('--data_dtype', type=str, default='float32', choices=['float32', 'float16'],
+                        help='dtype of the shared data volumes, float16 halves the memory.')
+    args = parser.parse_args()
+    if not args.synthetic and None in (args.data_dir, args.label_1_dir, args.label_2_dir):
+        parser.error('--data_dir, --label_1_dir and --label_2_dir are required without --synthetic.')
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    if args.synthetic:
+        subjects = synthetic_subjects()
+    else:
+        subjects = load_subjects(args.data_dir, args.label_1_dir, args.label_2_dir, dtype=args.data_dtype)
+    load_seconds = time.perf_counter() - start
+    shared_mb = sum(tensor.numel() * tensor.element_size() for tensor in subjects.values()) / 2 ** 20
+    print('Loaded {} subjects into {:.0f} MB of shared memory in {:.1f}s'.format(len(subjects['data']), shared_mb,
+                                                                             load_seconds))
+
+    results = run_cross_validation(subjects, args.out_dir, args.jobs, args.devices, models=args.models,
+                                   folds=args.folds, epochs=args.epochs, threads_per_job=args.threads_per_job)
+    results.sort(key=lambda result: (result['model'], result['fold']))
+    summary = {'load_seconds': load_seconds,
+               'shared_mb': shared_mb,
+               'wall_seconds': time.perf_counter() - start,
+               'jobs': args.jobs,
+               'devices': args.devices,
+               'results': results}
+    with open(os.path.join(args.out_dir, 'cv_summary.json'), 'w') as f:
+        json.dump(summary, f, indent=2)
+    failed = [result for result in results if 'error' in result]
+    print('{} of {} jobs done in {:.1f}s, summary in {}'.format(len(results) - len(failed), len(results),
+                                                             summary['wall_seconds'],
+                                                             os.path.join(args.out_dir, 'cv_summary.json')))
+    if failed:
+        print('Failed: ' + ', '.join('{model} fold {fold} ({log})'.format(**result) for result in failed))
+        raise SystemExit(1)
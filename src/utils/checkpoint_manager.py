@@ -0,0 +1,233 @@
+import os
+import json
+import random
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+from matplotlib.figure import Figure
+
+
+def to_cpu(obj):
+    """ Detached CPU copy of all tensors in a (nested) state dict, so that training can go on while it is written. """
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {key: to_cpu(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(value) for value in obj)
+    return obj
+
+
+def get_rng_state(random_states=None):
+    """ States of the torch, CUDA, numpy and python generators, and of the named np.random.RandomState objects. """
+    state = {'torch': torch.get_rng_state(),
+             'numpy': np.random.get_state(),
+             'python': random.getstate(),
+             'random_states': {name: random_state.get_state() for name, random_state in (random_states or {}).items()}}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state, random_states=None):
+    torch.set_rng_state(state['torch'])
+    np.random.set_state(state['numpy'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+    for name, random_state in (random_states or {}).items():
+        if name in state['random_states']:
+            random_state.set_state(state['random_states'][name])
+
+
+def plot_losses(train_losses, val_losses, path):
+    """ Train, val and combined loss curves. Uses the Figure API, not pyplot, so it is safe off the main thread. """
+    fig = Figure(figsize=(20, 24))
+    ax1 = fig.add_subplot(311)
+    ax2 = fig.add_subplot(312)
+    ax3 = fig.add_subplot(313)
+
+    ax1.plot(train_losses, color='darkred', marker='o')
+    ax1.set_title('train loss')
+    ax1.set_xlabel('epoch')
+    ax1.set_ylabel('loss')
+
+    ax2.plot(val_losses, color='b', marker='o')
+    ax2.set_title('val loss')
+    ax2.set_xlabel('epoch')
+    ax2.set_ylabel('loss')
+
+    ax3.plot(train_losses, color='darkred', marker='o')
+    ax3.plot(val_losses, color='b', marker='o')
+    ax3.set_title('training and validation loss')
+    ax3.set_xlabel('epoch')
+    ax3.set_ylabel('loss')
+    ax3.legend(['train', 'val'])
+
+    fig.tight_layout()
+    fig.savefig(path)
+
+
+class CheckpointManager:
+
+    """
+    Saves the full training state every epoch: model, optimizer, scheduler, grad scaler, random generators and loss
+    history. The state is copied to the CPU on the training thread, everything else (torch.save, best_checkpoint.pt,
+    the loss .npz files and the loss plot) runs on a single background thread, in order.
+
+    Epoch checkpoints go to checkpoint_dir/<epoch>.pt. Only the last `keep_last` and the `keep_best` with the lowest
+    validation loss are kept; checkpoint_dir/index.json holds the validation loss of every retained epoch.
+    The best model is also written to split_dir/best_checkpoint.pt in the format of SaveBestModel (epoch, weights and
+    losses only), which torch.load reads with weights_only=True as the inference code does.
+    """
+
+    def __init__(self, checkpoint_dir, split_dir, keep_last=3, keep_best=1, plot_every=1, random_states=None,
+                 verbose=True):
+        """
+        checkpoint_dir (str): Folder of the epoch checkpoints.
+        split_dir (str): Folder of best_checkpoint.pt, train_losses.npz, val_losses.npz and losses.png.
+        keep_last (int): Number of most recent epoch checkpoints to keep, all if None.
+        keep_best (int): Number of epoch checkpoints with the lowest validation loss to keep as well.
+        plot_every (int): Plot the losses every `plot_every` epochs, never if 0.
+        random_states (dict): Named np.random.RandomState objects saved and restored with the global generators,
+                              e.g. the one of the augmentation.
+        verbose (bool): If True, prints a message for each validation loss improvement.
+        """
+        self.checkpoint_dir = checkpoint_dir
+        self.split_dir = split_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.plot_every = plot_every
+        self.random_states = random_states
+        self.verbose = verbose
+
+        self.index_path = os.path.join(checkpoint_dir, 'index.json')
+        self.index = {}
+        self.val_loss_min = np.inf
+
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='checkpoint')
+        self._pending = []
+
+    def path(self, epoch):
+        return os.path.join(self.checkpoint_dir, str(epoch) + '.pt')
+
+    def save(self, epoch, model, optimizer, scheduler, scaler, train_losses, val_losses):
+        """ Snapshot the state after `epoch` and queue it for writing; the last entry of val_losses ranks it. """
+        self._raise_errors()
+        val_loss = val_losses[-1]
+        state = {'epoch': epoch,
+                 'state_dict': to_cpu(model.state_dict()),
+                 'optimizer': to_cpu(optimizer.state_dict()),
+                 'scheduler': to_cpu(scheduler.state_dict()),
+                 'scaler': scaler.state_dict(),
+                 'rng': get_rng_state(self.random_states),
+                 'train_losses': list(train_losses),
+                 'val_losses': list(val_losses)}
+
+        is_best = val_loss < self.val_loss_min
+        if is_best:
+            if self.verbose:
+                print(f'Validation loss decreased ({self.val_loss_min:.6f} --> {val_loss:.6f}). Saving model ...')
+            self.val_loss_min = val_loss
+        plot = self.plot_every > 0 and (epoch + 1) % self.plot_every == 0
+        self._pending.append(self._pool.submit(self._write, state, val_loss, is_best, plot))
+
+    def load(self, epoch, model, optimizer=None, scheduler=None, scaler=None, map_location=None, restore_rng=True):
+        """
+        Restore the state saved after `epoch` into the given objects; returns (train_losses, val_losses).
+        Checkpoints written before the manager existed hold the model and the losses only, the rest is left as is.
+        """
+        state = torch.load(self.path(epoch), map_location=map_location, weights_only=False)
+        model.load_state_dict(state['state_dict'])
+        for obj, key in [(optimizer, 'optimizer'), (scheduler, 'scheduler'), (scaler, 'scaler')]:
+            if obj is not None and key in state:
+                obj.load_state_dict(state[key])
+        if restore_rng and 'rng' in state:
+            set_rng_state(state['rng'], self.random_states)
+        self.val_loss_min = min(state['val_losses'], default=np.inf)
+
+        # epochs after the resumed one are overwritten by the new run
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = {int(e): val_loss for e, val_loss in json.load(f).items() if int(e) <= epoch}
+        return state['train_losses'], state['val_losses']
+
+    def wait(self):
+        """ Block until everything queued is written; re-raises the first error of the background thread. """
+        for future in self._pending:
+            future.result()
+        self._pending = []
+
+    def close(self):
+        self.wait()
+        self._pool.shutdown()
+
+    def _raise_errors(self):
+        done = [future for future in self._pending if future.done()]
+        self._pending = [future for future in self._pending if not future.done()]
+        for future in done:
+            future.result()
+
+    def _write(self, state, val_loss, is_best, plot):
+        epoch = state['epoch']
+        # written under a temporary name and renamed, so that an interrupted save never leaves a truncated checkpoint
+        save_atomic(state, self.path(epoch))
+        if is_best:
+            save_atomic(best_state(state), os.path.join(self.split_dir, 'best_checkpoint.pt'))
+
+        self.index[epoch] = val_loss
+        self._apply_retention()
+        with open(self.index_path, 'w') as f:
+            json.dump({str(epoch): loss for epoch, loss in sorted(self.index.items())}, f, indent=2)
+
+        np.savez(os.path.join(self.split_dir, 'train_losses.npz'), state['train_losses'])
+        np.savez(os.path.join(self.split_dir, 'val_losses.npz'), state['val_losses'])
+        if plot:
+            plot_losses(state['train_losses'], state['val_losses'], os.path.join(self.split_dir, 'losses.png'))
+
+    def _apply_retention(self):
+        if self.keep_last is None:
+            return
+        epochs = sorted(self.index)
+        keep = set(epochs[-self.keep_last:] if self.keep_last > 0 else [])
+        keep.update(sorted(epochs, key=lambda epoch: self.index[epoch])[:self.keep_best])
+        for epoch in epochs:
+            if epoch not in keep:
+                if os.path.exists(self.path(epoch)):
+                    os.remove(self.path(epoch))
+                del self.index[epoch]
+
+
+def best_state(state):
+    """ The weights-only part of a full state: no optimizer, scheduler or random generator states. """
+    return {key: state[key] for key in ('epoch', 'state_dict', 'train_losses', 'val_losses')}
+
+
+def save_atomic(state, path):
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+if __name__ == '__main__':
+
+    # round trip: a best_checkpoint.pt written by the manager loads through the inference code
+    import sys
+    import tempfile
+    import torch.nn as nn
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+    from models.unet3d import UnetL5
+    from inference.ensemble import load_fold_model
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model = UnetL5(in_dim=4, out_dim=2, num_filters=4, output_activation=nn.Sigmoid())
+        optimizer = torch.optim.Adam(model.parameters())
+        scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, 'min')
+        manager = CheckpointManager(tmp_dir, tmp_dir, plot_every=0, verbose=False,
+                                    random_states={'augmentation': np.random.RandomState(0)})
+        manager.save(0, model, optimizer, scheduler, torch.amp.GradScaler('cpu', enabled=False), [1.], [1.])
+        manager.close()
+        load_fold_model(os.path.join(tmp_dir, 'best_checkpoint.pt'), 4, 2, nn.Sigmoid(), torch.device('cpu'))
+        # the full state of the epoch checkpoint still resumes
+        CheckpointManager(tmp_dir, tmp_dir).load(0, UnetL5(in_dim=4, out_dim=2, num_filters=4), optimizer, scheduler)
+    print('best_checkpoint.pt loads through load_fold_model')
@@ -0,0 +1,31 @@
+import os
+import torch
+
+# Environment variable consulted when no device is given explicitly, e.g. RATNUS_DEVICE=cpu
+DEVICE_ENV_VAR = 'RATNUS_DEVICE'
+
+
+def get_device(name=None):
+    """
+    Resolve the device to run on.
+
+    name (str): 'auto', 'cpu', 'cuda', 'cuda:1', ... If None, the RATNUS_DEVICE environment variable is used and
+                'auto' if that is unset. 'auto' picks CUDA when available and falls back to the CPU.
+    """
+    if name is None:
+        name = os.environ.get(DEVICE_ENV_VAR, 'auto')
+    if name == 'auto':
+        return torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+    device = torch.device(name)
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        raise RuntimeError(f"Device {name} was requested but CUDA is not available.")
+    return device
+
+
+def autocast_dtype(device):
+    """
+    Reduced-precision dtype of mixed-precision (autocast) runs on `device`: float16 on CUDA, where it goes with loss
+    scaling (torch.amp.GradScaler), and bfloat16 on the CPU, whose exponent range needs no loss scaling.
+    """
+    return torch.float16 if device.type == 'cuda' else torch.bfloat16
@@ -0,0 +1,53 @@
+import os
+import torch
+import torch.distributed as dist
+
+
+def init_distributed(device, backend=None):
+    """
+    Join the process group of a torchrun launch (RANK, WORLD_SIZE and LOCAL_RANK in the environment).
+
+    device (torch.device): Device requested for training. On CUDA every rank takes cuda:LOCAL_RANK.
+    backend (str): 'nccl' or 'gloo', by default nccl on CUDA and gloo on the CPU.
+
+    Returns the device of this rank.
+    """
+    if 'RANK' not in os.environ:
+        raise RuntimeError("Distributed training needs a torchrun launch, e.g. torchrun --nproc_per_node 2 <script> ...")
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    if device.type == 'cuda':
+        device = torch.device('cuda', local_rank)
+        torch.cuda.set_device(device)
+    dist.init_process_group(backend=backend or ('nccl' if device.type == 'cuda' else 'gloo'))
+    return device
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    """ Rank 0, or the only process. Checkpoints, plots and logs are written by the main process only. """
+    return get_rank() == 0
+
+
+def average(total, count, device):
+    """ total / count summed over all ranks, e.g. the mean loss of an epoch over the batches of every rank. """
+    if not is_distributed():
+        return total / count
+    values = torch.tensor([total, count], dtype=torch.float64, device=device)
+    dist.all_reduce(values, op=dist.ReduceOp.SUM)
+    return (values[0] / values[1]).item()
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
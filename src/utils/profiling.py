@@ -0,0 +1,251 @@
+"""
+Per-block profile of the networks in models/unet3d.py.
+
+Hooks on every top-level block of the model (down_*, pool_*, bridge, trans_*, up_*, out) record, for one input shape:
+    forward_ms / backward_ms   wall time of the block, median over the repeats (CUDA is synchronized around it)
+    output_shape / output_mb   size of the block output, i.e. the activation kept for the backward pass
+    params                     number of parameters
+    gflops                     analytical forward FLOPs: 2 per multiply-add of the convolutions, 1 per element of
+                               BatchNorm (2), activations and pooling windows; roughly double it for the backward pass
+    peak_mb                    growth of the allocated memory during the forward pass of the block, measured in the
+                               untimed warm-up pass. On CUDA torch.cuda.max_memory_allocated, on the CPU the peak of the
+                               allocations and frees of the operators recorded by the autograd profiler
+                               (profile_memory), including temporaries such as the im2col buffer of the convolutions
+The skip concatenations are plain torch.cat calls, not modules, and are not attributed to any block. With backward,
+the model is in training mode and the gradient of the input is computed as well, so that the first block is timed.
+
+Usage:
+    profiler = BlockProfiler(model)
+    report = profiler.run(torch.rand(1, 68, 96, 96, 96), backward=True, repeats=3)
+    print(format_table(report))
+"""
+
+
+import time
+import statistics
+import torch
+import torch.nn as nn
+
+
+def _sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def profiled_peak(events):
+    """
+    Peak of the running sum of the memory allocated by the profiled operators, in bytes. The self allocations of an
+    operator (excluding its children) are counted at its start, its self frees at its end.
+    """
+    deltas = []
+    for event in events:
+        usage = event.self_cpu_memory_usage
+        if usage > 0:
+            deltas.append((event.time_range.start, usage))
+        elif usage < 0:
+            deltas.append((event.time_range.end, usage))
+    current = peak = 0
+    for _, usage in sorted(deltas, key=lambda delta: delta[0]):
+        current += usage
+        peak = max(peak, current)
+    return peak
+
+
+class _Memory:
+
+    """ Peak memory over a region: CUDA allocator statistics, or the memory events of the profiler on the CPU. """
+
+    def __init__(self, device):
+        self.device = device
+        self.base = 0.
+        self._profiler = None
+
+    def start(self):
+        if self.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.base = torch.cuda.memory_allocated(self.device) / 2 ** 20
+        else:
+            self._profiler = torch.autograd.profiler.profile(profile_memory=True)
+            self._profiler.__enter__()
+
+    def peak_mb(self):
+        if self.device.type == 'cuda':
+            return max(torch.cuda.max_memory_allocated(self.device) / 2 ** 20 - self.base, 0.)
+        return profiled_peak(self.stop()) / 2 ** 20
+
+    def stop(self):
+        """ Ends a CPU measurement, e.g. one left open by an error in the block; returns its profiled events. """
+        if self._profiler is None:
+            return []
+        self._profiler.__exit__(None, None, None)
+        events, self._profiler = self._profiler.function_events, None
+        return events
+
+
+def leaf_flops(module, inputs, output):
+    """ Analytical forward FLOPs of a leaf module from its input and output shapes. """
+    if isinstance(module, nn.Conv3d):
+        kernel = module.in_channels // module.groups * module.kernel_size[0] * module.kernel_size[1] * \
+                 module.kernel_size[2]
+        return 2 * kernel * output.numel() + (output.numel() if module.bias is not None else 0)
+    if isinstance(module, nn.ConvTranspose3d):
+        # every input voxel is scattered into a kernel-sized window of all output channels
+        kernel = module.out_channels // module.groups * module.kernel_size[0] * module.kernel_size[1] * \
+                 module.kernel_size[2]
+        return 2 * kernel * inputs[0].numel() + (output.numel() if module.bias is not None else 0)
+    if isinstance(module, nn.BatchNorm3d):
+        return 2 * output.numel()
+    if isinstance(module, nn.MaxPool3d):
+        kernel = module.kernel_size if isinstance(module.kernel_size, int) else module.kernel_size[0]
+        return kernel ** 3 * output.numel()
+    if isinstance(module, (nn.LeakyReLU, nn.ReLU, nn.Sigmoid, nn.Softmax, nn.Tanh)):
+        return output.numel()
+    return 0
+
+
+class BlockProfiler:
+
+    """
+    Attaches forward and backward hooks to the top-level blocks of `model` and collects their per-block statistics.
+
+    model (nn.Module): UnetL3, UnetL4, UnetL5 or any model whose direct children are its blocks.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        # the activation modules stored on the model are shared by its blocks and not blocks of their own
+        shared = {id(module) for _, child in model.named_children() for module in list(child.modules())[1:]}
+        self.blocks = [(name, child) for name, child in model.named_children() if id(child) not in shared]
+        self._handles = []
+        self._times = {}
+        self._flops = {}
+        self._outputs = {}
+        self._peaks = {}
+        self._current = None
+        self._active = None
+        self._start = {}
+        self._memory = None
+
+    def attach(self, device):
+        self._memory = _Memory(device)
+        for name, block in self.blocks:
+            self._handles.append(block.register_forward_pre_hook(self._pre_hook(name, 'forward', device)))
+            self._handles.append(block.register_forward_hook(self._post_hook(name, 'forward', device)))
+            self._handles.append(block.register_full_backward_pre_hook(self._pre_hook(name, 'backward', device)))
+            self._handles.append(block.register_full_backward_hook(self._post_hook(name, 'backward', device)))
+        # once per leaf, shared leaves are attributed to the block running them
+        leaves = {id(leaf): leaf for _, block in self.blocks for leaf in block.modules() if not list(leaf.children())}
+        for leaf in leaves.values():
+            self._handles.append(leaf.register_forward_hook(self._flops_hook))
+
+    def detach(self):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
+
+    def _pre_hook(self, name, phase, device):
+        def hook(*_):
+            _sync(device)
+            if phase == 'forward':
+                if self._current is not None:
+                    self._memory.start()
+                self._active = name
+            self._start[name, phase] = time.perf_counter()
+        return hook
+
+    def _post_hook(self, name, phase, device):
+        def hook(module, _, output):
+            _sync(device)
+            self._times.setdefault((name, phase), []).append(time.perf_counter() - self._start[name, phase])
+            if phase == 'forward':
+                if self._current is not None:
+                    self._peaks[name] = self._memory.peak_mb()
+                self._outputs[name] = (list(output.shape), output.numel() * output.element_size())
+                self._active = None
+        return hook
+
+    def _flops_hook(self, module, inputs, output):
+        if self._current is not None and self._active is not None:
+            self._current[self._active] = self._current.get(self._active, 0) + leaf_flops(module, inputs, output)
+
+    def run(self, data, backward=False, repeats=3):
+        """
+        Profile `repeats` passes on `data` after one warm-up pass; returns the report, a dict with the rows per block
+        and the totals.
+        """
+        device = data.device
+        # with an input that requires grad, the backward hooks of the first block see its input gradient as well
+        data = data.detach().requires_grad_(backward)
+        self.model.train(backward)
+        self.attach(device)
+        try:
+            for i in range(repeats + 1):
+                if i == 1:
+                    # the warm-up pass is not timed, it counts the FLOPs and measures the memory instead
+                    self._times = {}
+                self._current = {} if i == 0 else None
+                with torch.set_grad_enabled(backward):
+                    output = self.model(data)
+                    if backward:
+                        output.float().mean().backward()
+                if i == 0:
+                    self._flops = self._current
+                self._current = None
+                self.model.zero_grad(set_to_none=True)
+        finally:
+            self.detach()
+            self._memory.stop()
+            self._current = None
+
+        rows = []
+        for name, block in self.blocks:
+            if name not in self._outputs:
+                continue
+            output_shape, output_bytes = self._outputs[name]
+            rows.append({'block': name,
+                         'output_shape': output_shape,
+                         'output_mb': output_bytes / 2 ** 20,
+                         'params': sum(param.numel() for param in block.parameters()),
+                         'gflops': self._flops.get(name, 0) / 1e9,
+                         'forward_ms': 1e3 * statistics.median(self._times[name, 'forward']),
+                         'backward_ms': 1e3 * statistics.median(self._times[name, 'backward'])
+                         if (name, 'backward') in self._times else None,
+                         'peak_mb': self._peaks.get(name)})
+        self._outputs, self._peaks = {}, {}
+
+        totals = {key: sum(row[key] for row in rows if row[key] is not None)
+                  for key in ('output_mb', 'params', 'gflops', 'forward_ms', 'backward_ms')}
+        totals['backward_ms'] = totals['backward_ms'] if backward else None
+        totals['peak_mb'] = max((row['peak_mb'] for row in rows if row['peak_mb'] is not None), default=None)
+        return {'model': type(self.model).__name__,
+                'input_shape': list(data.shape),
+                'device': str(device),
+                'threads': torch.get_num_threads(),
+                'backward': backward,
+                'blocks': rows,
+                'total': totals}
+
+
+def profile_model(model, input_shape, device=torch.device('cpu'), backward=False, repeats=3):
+    """ Per-block report of `model` on a random input of `input_shape` [N, C, H, W, L]. """
+    model = model.to(device)
+    data = torch.rand(*input_shape, device=device)
+    return BlockProfiler(model).run(data, backward=backward, repeats=repeats)
+
+
+def _fmt(value, spec):
+    return '-' if value is None else format(value, spec)
+
+
+def format_table(report):
+    """ The per-block rows and the totals of a report as a text table. """
+    header = '{:10s} {:>22s} {:>10s} {:>10s} {:>9s} {:>11s} {:>11s} {:>9s}'.format(
+        'block', 'output', 'out MB', 'params', 'GFLOPs', 'fwd ms', 'bwd ms', 'peak MB')
+    lines = ['{} {} ({} threads, {})'.format(report['model'], 'x'.join(map(str, report['input_shape'])),
+                                            report['threads'], report['device']), header, '-' * len(header)]
+    for row in report['blocks'] + [dict(report['total'], block='total', output_shape=None)]:
+        shape = 'x'.join(map(str, row['output_shape'])) if row['output_shape'] else ''
+        lines.append('{:10s} {:>22s} {:>10.1f} {:>10d} {:>9.2f} {:>11s} {:>11s} {:>9s}'.format(
+            row['block'], shape, row['output_mb'], row['params'], row['gflops'], _fmt(row['forward_ms'], '.1f'),
+            _fmt(row['backward_ms'], '.1f'), _fmt(row['peak_mb'], '.1f')))
+    return '\n'.join(lines)
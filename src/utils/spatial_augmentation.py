@@ -0,0 +1,312 @@
+"""
+Single-pass spatial augmentation.
+
+The transforms of utils/augmentation.py each resample every channel separately with cubic splines, so a volume that
+is rotated and then shifted is interpolated twice, channel by channel. Here every transform only describes how it
+moves the voxels. The picked transforms are composed into one coordinate map (for every output voxel, the position to
+read in the input), and the data and the label are resampled once from it. Resampling uses either torch grid_sample
+(trilinear, all channels and a whole batch in one call) or scipy (cubic splines, like the per-channel transforms).
+
+Parameter ranges and augmentation details match RandomRotate, HorizontalFlip, RandomZoom, RandomShift and
+ElasticDeformation. Zoom is about the volume center and keeps the shape, so zoomed volumes can be batched. The elastic
+displacement is drawn on a coarse grid and upsampled, instead of smoothing three full-size noise volumes.
+"""
+
+
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+from scipy.ndimage import map_coordinates, affine_transform, gaussian_filter
+
+
+def identity_grid(shape, device=None):
+    """ Voxel coordinates of a volume of the given shape, [3, H, W, L]. """
+    axes = [torch.arange(size, dtype=torch.float32, device=device) for size in shape]
+    return torch.stack(torch.meshgrid(*axes, indexing='ij'), dim=0)
+
+
+def to_sampling_grid(coords):
+    """ Voxel coordinates [N, 3, H, W, L] to the normalized [N, H, W, L, 3] (x, y, z) grid of grid_sample. """
+    size = torch.tensor(coords.shape[-3:], dtype=coords.dtype, device=coords.device)
+    grid = coords * (2. / (size - 1)).view(1, 3, 1, 1, 1) - 1.
+    return grid.permute(0, 2, 3, 4, 1).flip(-1)
+
+
+class AffineStep:
+    """ Pulls a voxel position p back to matrix @ (p - center) + center + offset, the center being the volume center. """
+
+    def __init__(self, matrix, offset=(0., 0., 0.)):
+        self.matrix = np.asarray(matrix, dtype=np.float32)
+        self.offset = np.asarray(offset, dtype=np.float32)
+
+    def voxel_affine(self, shape):
+        """ The step as q = matrix @ p + offset in voxel coordinates. """
+        center = np.array([(size - 1) / 2. for size in shape])
+        return self.matrix.astype(np.float64), center - self.matrix @ center + self.offset
+
+    def __call__(self, coords):
+        center = torch.tensor([(size - 1) / 2. for size in coords.shape[-3:]], device=coords.device).view(3, 1, 1, 1)
+        matrix = torch.from_numpy(self.matrix).to(coords.device)
+        offset = torch.from_numpy(self.offset).to(coords.device).view(3, 1, 1, 1)
+        return torch.einsum('ij,j...->i...', matrix, coords - center) + center + offset
+
+
+class DisplacementStep:
+    """
+    Pulls a voxel position p back to p + d(p). The displacement d [3, h, w, l] (in voxels) is given on a coarse grid
+    spanning the volume and interpolated trilinearly.
+    """
+
+    def __init__(self, field):
+        self.field = torch.as_tensor(field, dtype=torch.float32)
+
+    def __call__(self, coords):
+        field = self.field.to(coords.device).unsqueeze(0)
+        displacement = F.grid_sample(field, to_sampling_grid(coords.unsqueeze(0)), mode='bilinear',
+                                     padding_mode='border', align_corners=True)
+        return coords + displacement[0]
+
+
+def coordinate_map(steps, shape, device=None):
+    """
+    Compose the steps, in the order they are applied to the volume, into one map [3, H, W, L] from output voxels to
+    input positions.
+    """
+    coords = identity_grid(shape, device=device)
+    # the transform applied last is the first to act on the output coordinates
+    for step in reversed(steps):
+        coords = step(coords)
+    return coords
+
+
+def compose_affine(steps, shape):
+    """ Compose affine steps, in the order they are applied to the volume, into one voxel matrix and offset. """
+    matrix, offset = np.eye(3), np.zeros(3)
+    for step in steps:
+        step_matrix, step_offset = step.voxel_affine(shape)
+        matrix, offset = matrix @ step_matrix, matrix @ step_offset + offset
+    return matrix, offset
+
+
+# Random Rotate
+class Rotate:
+    """ Rotation by a random integer angle in [-angle_spectrum, angle_spectrum) about a randomly picked axis pair. """
+
+    def __init__(self, random_state, angle_spectrum=15, axes=[(1, 0), (2, 1), (2, 0)]):
+        self.random_state = random_state
+        self.angle_spectrum = angle_spectrum
+        self.axes = axes
+
+    def __call__(self, shape):
+        axis = self.axes[self.random_state.randint(len(self.axes))]
+        angle = self.random_state.randint(-self.angle_spectrum, self.angle_spectrum)
+        augmentation_details = f"rotate_angle:{angle}_axis:{axis}"
+
+        # same convention as scipy.ndimage.rotate, which sorts the axis pair
+        a, b = sorted(axis)
+        cos, sin = math.cos(math.radians(angle)), math.sin(math.radians(angle))
+        matrix = np.eye(3)
+        matrix[a, a], matrix[a, b], matrix[b, a], matrix[b, b] = cos, sin, -sin, cos
+        return AffineStep(matrix), augmentation_details
+
+
+# Random Flip
+class Flip:
+    """ Left-right flip along the x-axis. """
+
+    def __init__(self, random_state, axis=0):
+        self.random_state = random_state
+        self.axis = axis
+
+    def __call__(self, shape):
+        matrix = np.eye(3)
+        matrix[self.axis, self.axis] = -1
+        return AffineStep(matrix), "flip_axis:{}".format(self.axis)
+
+
+# Random Zoom
+class Zoom:
+    """ Zoom about the volume center by a random factor within zoom_range. The volume shape is kept. """
+
+    def __init__(self, random_state, zoom_range=(0.85, 1.15)):
+        self.random_state = random_state
+        self.zoom_range = zoom_range
+
+    def __call__(self, shape):
+        zoom_factor = self.random_state.uniform(*self.zoom_range)
+        return AffineStep(np.eye(3) / zoom_factor), "zoom_factor:{}".format(zoom_factor)
+
+
+# Random Shift
+class Shift:
+    """ Shift by a random offset within shift_range along each axis. """
+
+    def __init__(self, random_state, shift_range=(-5, 5)):
+        self.random_state = random_state
+        self.shift_range = shift_range
+
+    def __call__(self, shape):
+        shift_values = [self.random_state.uniform(self.shift_range[0], self.shift_range[1]) for _ in range(3)]
+        return AffineStep(np.eye(3), offset=-np.asarray(shift_values)), "shift_values:{}".format(shift_values)
+
+
+# Elastic Deformation
+class Elastic:
+    """
+    Smooth random displacement: per-voxel Gaussian noise smoothed with sigma and scaled by alpha, as in
+    ElasticDeformation. The noise is drawn on a grid `downsample` times coarser and upsampled. The smoothing sigma is
+    shrunk and the amplitude raised (by the square root of the voxel volume ratio) so that the field has the smoothness
+    and magnitude of the full-size one.
+    """
+
+    def __init__(self, random_state, alpha=2000, sigma=50, downsample=8):
+        self.random_state = random_state
+        self.alpha = alpha
+        self.sigma = sigma
+        self.downsample = downsample
+
+    def __call__(self, shape):
+        augmentation_details = "elastic_alpha:{} sigma:{}".format(self.alpha, self.sigma)
+
+        coarse_shape = [max(2, math.ceil((size - 1) / self.downsample) + 1) for size in shape]
+        spacing = [(size - 1) / (coarse - 1) for size, coarse in zip(shape, coarse_shape)]
+        scale = self.alpha / math.sqrt(np.prod(spacing))
+        field = np.stack([
+            gaussian_filter(self.random_state.randn(*coarse_shape), [self.sigma / s for s in spacing], mode='reflect')
+            * scale for _ in range(3)
+        ], axis=0)
+        return DisplacementStep(field), augmentation_details
+
+
+def resample(volume, coords, mode='bilinear', padding_mode='reflection'):
+    """
+    Resample a batch of volumes [N, C, H, W, L] at the coordinate maps [N, 3, H, W, L] with grid_sample.
+    Use mode='nearest' and padding_mode='border' for labels.
+    """
+    return F.grid_sample(volume, to_sampling_grid(coords), mode=mode, padding_mode=padding_mode, align_corners=True)
+
+
+def resample_scipy(data, label, coords):
+    """
+    Cubic spline resampling of data [C, H, W, L] and nearest-neighbor resampling of label [H, W, L], at a coordinate
+    map [3, H, W, L] or at a voxel affine (matrix, offset).
+    """
+    if isinstance(coords, tuple):
+        matrix, offset = coords
+        data_out = np.stack([affine_transform(c, matrix, offset=offset, order=3, mode='reflect') for c in data], axis=0)
+        label_out = affine_transform(label, matrix, offset=offset, order=0, mode='nearest')
+        return data_out, label_out
+    coords = coords.cpu().numpy()
+    data_out = np.stack([map_coordinates(c, coords, order=3, mode='reflect') for c in data], axis=0)
+    label_out = map_coordinates(label, coords, order=0, mode='nearest')
+    return data_out, label_out
+
+
+class SpatialCompose:
+    """
+    Randomly picks two transformations from the provided list of transformations and applies them with a probability
+    of 0.5 each, as Compose does, but resamples the data and the label only once.
+
+    random_state (np.random.RandomState): Source of all random decisions and transformation parameters.
+    transformations (list): Transformations, all five of this module by default.
+    backend (str): 'torch' (grid_sample, trilinear) or 'scipy' (cubic splines).
+    """
+
+    def __init__(self, random_state, transformations=None, backend='torch'):
+        assert backend in ('torch', 'scipy')
+        self.random_state = random_state
+        self.backend = backend
+
+        if transformations is None:
+            self.transformations = [
+                Rotate(random_state),
+                Flip(random_state),
+                Zoom(random_state),
+                Shift(random_state),
+                Elastic(random_state)
+            ]
+        else:
+            self.transformations = transformations
+
+    def sample(self, shape):
+        """ Draw the steps for one volume of the given spatial shape and their augmentation details. """
+        steps, applied_augmentations = [], []
+        for _ in range(2):
+            transform = self.transformations[self.random_state.randint(len(self.transformations))]
+            if self.random_state.uniform() < 0.5:
+                step, details = transform(shape)
+                steps.append(step)
+                applied_augmentations.append(details)
+        return steps, '|'.join(applied_augmentations)
+
+    def __call__(self, data, label):
+        assert data.ndim == 4 and label.ndim == 3
+        steps, augmentation_details = self.sample(label.shape)
+        if not steps:
+            return data, label, augmentation_details
+
+        if self.backend == 'scipy':
+            # without elastic deformation a single affine transform is enough, which scipy resamples faster
+            if all(isinstance(step, AffineStep) for step in steps):
+                data_out, label_out = resample_scipy(data, label, compose_affine(steps, label.shape))
+            else:
+                data_out, label_out = resample_scipy(data, label, coordinate_map(steps, label.shape))
+            return data_out, label_out, augmentation_details
+
+        coords = coordinate_map(steps, label.shape)
+
+        coords = coords.unsqueeze(0)
+        data_out = resample(torch.from_numpy(np.asarray(data, dtype=np.float32))[None], coords)[0]
+        label_out = resample(torch.from_numpy(label.astype(np.float32))[None, None], coords,
+                             mode='nearest', padding_mode='border')[0, 0]
+        return data_out.numpy(), label_out.numpy().astype(label.dtype), augmentation_details
+
+
+class BatchAugmentation:
+    """
+    Spatial augmentation of a whole batch on the device it already lives on, e.g. right after the host-to-device copy
+    in the training loop. Every sample draws its own transformations (as SpatialCompose), and the batch is resampled
+    with one grid_sample call for the data and one for the labels.
+
+    random_state (np.random.RandomState): Source of all random decisions and transformation parameters.
+    transformations (list): Transformations, all five of this module by default.
+    log_path (str): File the augmentation details of every sample are appended to, one line per sample, prefixed with
+                    the epoch and batch index given to __call__. It is kept open until close().
+    """
+
+    def __init__(self, random_state, transformations=None, log_path=None):
+        self.compose = SpatialCompose(random_state, transformations=transformations)
+        self.log_path = log_path
+        # line buffered, so that the log is complete up to the last batch if training stops
+        self._log_file = open(log_path, 'a', buffering=1) if log_path is not None else None
+
+    def __call__(self, data, label, epoch=None, batch_idx=None):
+        """
+        data [N, C, H, W, L] and label [N, H, W, L] tensors; returns them augmented and the details per sample.
+        epoch and batch_idx of the training loop go to the log lines, so that they can be matched to the training also
+        across a resume.
+        """
+        shape = data.shape[-3:]
+        samples = [self.compose.sample(shape) for _ in range(data.shape[0])]
+        augmentation_details = [details for _, details in samples]
+        self.log(augmentation_details, epoch, batch_idx)
+        if not any(steps for steps, _ in samples):
+            return data, label, augmentation_details
+
+        coords = torch.stack([coordinate_map(steps, shape, device=data.device) for steps, _ in samples], dim=0)
+        data_out = resample(data, coords.to(data.dtype))
+        label_out = resample(label.unsqueeze(1).to(data.dtype), coords.to(data.dtype),
+                             mode='nearest', padding_mode='border').squeeze(1).to(label.dtype)
+        return data_out, label_out, augmentation_details
+
+    def log(self, augmentation_details, epoch=None, batch_idx=None):
+        if self._log_file is not None:
+            self._log_file.writelines(
+                'epoch {} batch {} sample {}: {}\n'.format(epoch, batch_idx, idx, details or 'none')
+                for idx, details in enumerate(augmentation_details))
+
+    def close(self):
+        if self._log_file is not None:
+            self._log_file.close()
+            self._log_file = None
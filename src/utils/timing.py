@@ -0,0 +1,47 @@
+import time
+import torch
+
+
+class DataWaitTimer:
+
+    """ Splits the wall time of an epoch into time spent waiting for the dataloader and time spent computing. """
+
+    def __init__(self, device):
+        """
+        device (torch.device): Device the step runs on. CUDA is synchronized before reading the clock, otherwise
+                               asynchronous kernels would be counted as data-wait time of the next batch.
+        """
+        self.device = device
+        self.data_time = 0.
+        self.compute_time = 0.
+        self.num_steps = 0
+        self._last = None
+
+    def _sync(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def start(self):
+        """ Call right before iterating over the dataloader. """
+        self._sync()
+        self._last = time.perf_counter()
+
+    def data_ready(self):
+        """ Call as soon as a batch has been received from the dataloader. """
+        now = time.perf_counter()
+        self.data_time += now - self._last
+        self._last = now
+
+    def step_done(self):
+        """ Call once the step (forward, backward, optimizer) on the batch has finished. """
+        self._sync()
+        now = time.perf_counter()
+        self.compute_time += now - self._last
+        self.num_steps += 1
+        self._last = now
+
+    def report(self, tag):
+        total = self.data_time + self.compute_time
+        wait_ratio = 100. * self.data_time / total if total > 0 else 0.
+        return '{} data wait: {:.2f}s  compute: {:.2f}s  steps: {}  ({:.1f}% of the time waiting for data)'.format(
+            tag, self.data_time, self.compute_time, self.num_steps, wait_ratio)
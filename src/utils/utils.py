@@ -1,5 +1,35 @@
 import torch
 import numpy as np
+from scipy.ndimage import label
+
+
+def class_indices(gt, gt_values):
+    """
+    Map every voxel of the ground truth to the index of its value in gt_values, -1 for values not in gt_values.
+
+    gt (torch.Tensor): Ground truth labels, with shape [batch_size, H, W, L], integer or float valued.
+    gt_values (list): The values corresponding to the distinct classes, e.g. [1, 2, ..., 13].
+    """
+    values = torch.as_tensor(gt_values, device=gt.device)
+    is_integral = bool(torch.all(values == values.round())) and bool(torch.all(values >= 0))
+
+    if not is_integral:
+        # no lookup table possible, compare against each class value
+        indices = torch.full(gt.shape, -1, dtype=torch.long, device=gt.device)
+        for idx, value in enumerate(gt_values):
+            indices[gt == value] = idx
+        return indices
+
+    # lookup table from label value to class index
+    max_value = int(values.max())
+    lut = torch.full((max_value + 1,), -1, dtype=torch.long, device=gt.device)
+    lut[values.long()] = torch.arange(len(gt_values), device=gt.device)
+
+    gt_long = gt.long()
+    valid = (gt_long >= 0) & (gt_long <= max_value)
+    if gt.is_floating_point():
+        valid &= gt_long == gt
+    return torch.where(valid, lut[gt_long.clamp(0, max_value)], -1)
 
 
 def one_hot_encoding(gt, gt_values, num_classes):
@@ -51,3 +81,35 @@ def pad_to_original_size(pred, original_shape):
 
     return padded_pred
 
+
+# Remove small connected component
+def generate_foreground_mask(data, threshold=50, keep_largest=None, hemisphere_axis=0):
+    """
+    Foreground mask of a binary label map [H, W, L] without its small connected components.
+
+    threshold (int): Components with fewer voxels are removed.
+    keep_largest (int): If set, only the K largest of the remaining components are kept in each hemisphere. A component
+                        belongs to the hemisphere of its centroid, split at the middle of `hemisphere_axis`.
+    hemisphere_axis (int): Left-right axis of the volume.
+    """
+    labeled_data, num_features = label(data)
+    labeled_flat = labeled_data.ravel()
+
+    # voxel count of every component, component 0 is the background
+    areas = np.bincount(labeled_flat, minlength=num_features + 1)
+    keep = areas >= threshold
+    keep[0] = False
+
+    if keep_largest is not None:
+        size = data.shape[hemisphere_axis]
+        position = np.arange(size).reshape([-1 if axis == hemisphere_axis else 1 for axis in range(data.ndim)])
+        position = np.broadcast_to(position, data.shape).ravel()
+        centroids = np.bincount(labeled_flat, weights=position, minlength=num_features + 1) / np.maximum(areas, 1)
+        right = centroids >= (size - 1) / 2
+        for hemisphere in (~right, right):
+            candidates = np.flatnonzero(keep & hemisphere)
+            smallest_first = candidates[np.argsort(areas[candidates], kind='stable')]
+            keep[smallest_first[:max(len(candidates) - keep_largest, 0)]] = False
+
+    # label-to-keep lookup table applied to the whole label image at once
+    return keep[labeled_data]